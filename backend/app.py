@@ -1,20 +1,44 @@
 # backend/app.py
 import os
-from flask import Flask, redirect, url_for, session, render_template
+import time
+from flask import Flask, Request, g, redirect, url_for, session, render_template, request
+from flask_socketio import emit, join_room
 from backend.config import Config
-from backend.database import engine, Base
 from backend.extensions import socketio
-from backend.routes.auth import auth_bp
-from backend.routes.user import user_bp
-from backend.routes.device import device_bp
-from backend.routes.dashboard import dashboard_bp
-from backend.services.device_manager import DeviceManager
+from backend.services.container import dm
+from backend.services.db_executor import DBBusy
+from backend.services.firmware import firmware_service
+from backend.services.traffic_recorder import traffic_recorder
+from backend.security.rate_limiter import limit_event
+
+_app = None
+
+
+class AppRequest(Request):
+    """MAX_CONTENT_LENGTH (2MB) cho mọi route, riêng upload firmware (stream) dùng FIRMWARE_MAX_SIZE."""
+
+    @property
+    def max_content_length(self):
+        if self.endpoint == "device.upload_firmware":
+            return Config.FIRMWARE_MAX_SIZE
+        return super().max_content_length
 
-dm = DeviceManager()
 
 def create_app():
+    # Import route/blueprint ở đây: import backend.app không kéo theo toàn bộ app
+    from backend.routes.auth import auth_bp, login_manager
+    from backend.routes.user import user_bp
+    from backend.routes.device import device_bp
+    from backend.routes.dashboard import dashboard_bp
+
+    from backend.serializer import JSONProvider
+
     app = Flask(__name__)
+    app.request_class = AppRequest
     app.config.from_object(Config)
+    app.json = JSONProvider(app)
+
+    login_manager.init_app(app)
 
     # Blueprints
     app.register_blueprint(auth_bp)
@@ -22,6 +46,33 @@ def create_app():
     app.register_blueprint(device_bp)
     app.register_blueprint(dashboard_bp)
 
+    from backend.database import engine, read_engine, pin_writer, remove_sessions
+    app.teardown_appcontext(remove_sessions)
+    if read_engine is not engine:
+        # Read-your-writes: session vừa ghi (POST/PUT/DELETE) → các đọc "read" của
+        # request kế tiếp vẫn đi writer trong DB_READ_YOUR_WRITES_SECONDS
+        @app.before_request
+        def _route_reads():
+            wrote = session.get("db_wrote_at")
+            pin_writer(wrote is not None and time.time() - wrote < Config.DB_READ_YOUR_WRITES_SECONDS)
+
+        @app.after_request
+        def _mark_writes(response):
+            if request.method in ("POST", "PUT", "PATCH", "DELETE") and response.status_code < 400 and "user" in session:
+                session["db_wrote_at"] = time.time()
+            return response
+
+    if traffic_recorder.enabled:
+        @app.before_request
+        def _record_start():
+            g.record_t0 = time.perf_counter()
+
+        @app.after_request
+        def _record_http(response):
+            if traffic_recorder.wants(request.endpoint) and "record_t0" in g:
+                _record_request(response)
+            return response
+
     # Root → redirect dashboard
     @app.route("/")
     def home():
@@ -32,39 +83,246 @@ def create_app():
     # SocketIO init
     socketio.init_app(app, cors_allowed_origins="*")
 
-    # DB create tables if not exist
-    Base.metadata.create_all(bind=engine)
+    # Soak test / replay dưới lỗi giả lập (FAULT_INJECTION=1 + FAULT_SPEC)
+    if Config.FAULT_INJECTION and Config.FAULT_SPEC:
+        from backend.services.faults import fault_injector
+        fault_injector.install(Config.FAULT_SPEC)
+        print(f"⚠️ fault injection enabled: {Config.FAULT_SPEC}")
+
+    # DB create tables if not exist (production: SKIP_SCHEMA_CHECK=1, schema đã deploy)
+    if not Config.SKIP_SCHEMA_CHECK:
+        from backend.database import Base, ensure_indexes
+        Base.metadata.create_all(bind=engine)
+        ensure_indexes()
+
+    # Warm-up cache song song ở background, không chặn lúc khởi động
+    if Config.WARMUP_ON_START:
+        from backend.services.container import warm_up
+        socketio.start_background_task(warm_up)
 
     return app
 
 
-app = create_app()
+def _record_request(response):
+    """Một HTTP call vào traffic log (không header/cookie); device_id → uid để replay map lại."""
+    body = None
+    if request.content_length and request.content_length <= traffic_recorder.max_body:
+        body = request.get_json(silent=True)
+        if body is None and request.form:
+            body = request.form.to_dict()
+    device_id = (request.view_args or {}).get("device_id")
+    if device_id is None and isinstance(body, dict):
+        device_id = body.get("device_id")
+    st = None
+    try:
+        st = dm.device_state(int(device_id)) if device_id is not None else None
+    except (TypeError, ValueError):
+        pass
+    traffic_recorder.record(
+        "http", request.method, request.endpoint, request.path, request.query_string.decode(), body,
+        response.status_code, round((time.perf_counter() - g.record_t0) * 1000, 3),
+        st.device_uid if st else None,
+    )
+
+
+def __getattr__(name):
+    # `backend.app:app` (gunicorn, ...) → tạo app lười ở lần truy cập đầu tiên
+    global _app
+    if name == "app":
+        if _app is None:
+            _app = create_app()
+        return _app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 # ---- Socket.IO Events ----
 @socketio.on("connect")
-def on_connect():
-    print("⚡ client connected")
+def on_connect(auth=None):
+    auth = auth or {}
+    uid = auth.get("device_uid")
+    if not uid:
+        # Client không phải thiết bị (dashboard, ...)
+        print("⚡ client connected")
+        return
+
+    conn = dm.authenticate_device(request.sid, uid, auth.get("token"))
+    if conn is None:
+        print(f"⛔ device {uid} rejected")
+        return False
+    print(f"⚡ device {uid} connected ({conn.namespace})")
+
+    fmt = auth.get("wire", "json")
+    traffic_recorder.record("connect", uid, fmt)
+    handle = dm.wire.bind(request.sid, uid, fmt) if fmt != "json" else None
+    if handle is not None:
+        # Wire protocol nhị phân: cấp handle + join room binary của kênh FDMA
+        join_room(f"{conn.namespace}:{fmt}")
+        emit("wire_config", {"format": fmt, "handle": handle})
+    else:
+        if fmt != "json":
+            emit("wire_config", {"format": "json"})
+        join_room(conn.namespace)
+
+    # Drain các command pending tích luỹ khi thiết bị offline
+    dm.schedule_replay(conn)
+    # Firmware đang chờ / truyền dở → offer lại (thiết bị resume từ file .part)
+    socketio.start_background_task(firmware_service.resume, conn)
 
 @socketio.on("disconnect")
 def on_disconnect():
     print("⚡ client disconnected")
+    dm.wire.unbind(request.sid)
+    conn = dm.disconnect_device(request.sid)
+    if conn is not None:
+        traffic_recorder.record("disconnect", conn.device_uid)
+
+def _device_key():
+    """Key rate limit: thiết bị đã bind → uid, ngược lại IP."""
+    conn = dm.connections.by_sid(request.sid)
+    return f"device:{conn.device_uid}" if conn else f"ip:{request.remote_addr}"
 
 @socketio.on("device_heartbeat")
-def on_device_heartbeat(data):
-    uid = (data or {}).get("device_uid")
-    if uid:
-        dm.handle_heartbeat(uid)
+@limit_event("device_heartbeat", _device_key)
+def on_device_heartbeat(data=None):
+    conn = dm.connections.by_sid(request.sid)
+    if conn:
+        traffic_recorder.record("hb", conn.device_uid)
+    if conn and dm.handle_heartbeat(conn):
+        _push_heartbeat_config(conn)
 
 @socketio.on("device_command_ack")
+@limit_event("device_ack", _device_key)
 def on_device_command_ack(data):
-    cid = (data or {}).get("command_id")
+    conn = dm.connections.by_sid(request.sid)
+    if conn is None:
+        return
+    data = data or {}
+    traffic_recorder.record("ack", conn.device_uid, data.get("command_id"))
+    try:
+        _handle_ack(conn, data)
+    except DBBusy:
+        print(f"⚠️ ack from {conn.device_uid} dropped: DB busy")
+    _piggyback_heartbeat(conn, data)
+
+@socketio.on("device_telemetry")
+@limit_event("device_telemetry", _device_key)
+def on_device_telemetry(data):
+    conn = dm.connections.by_sid(request.sid)
+    if conn is None:
+        return
+    data = data or {}
+    _handle_telemetry(conn, data)
+    _piggyback_heartbeat(conn, data)
+
+@socketio.on("device_batch")
+@limit_event("device_batch", _device_key)
+def on_device_batch(data):
+    """Outbox replay từ client: nhiều ack/telemetry trong một frame (limit tính theo frame)."""
+    conn = dm.connections.by_sid(request.sid)
+    if conn is None:
+        return {"ok": False, "error": "unbound"}
+    data = data or {}
+    handlers = {
+        "device_command_ack": _handle_ack,
+        "device_telemetry": _handle_telemetry,
+    }
+    processed = 0
+    _piggyback_heartbeat(conn, data)
+    for item in data.get("events") or []:
+        handler = handlers.get(item.get("event"))
+        if not handler:
+            continue
+        if handler is _handle_ack:
+            traffic_recorder.record("ack", conn.device_uid, (item.get("data") or {}).get("command_id"))
+        try:
+            handler(conn, item.get("data") or {})
+        except DBBusy:
+            # Client giữ lại outbox và gửi lại sau
+            return {"ok": False, "error": "busy", "processed": processed}
+        processed += 1
+    return {"ok": True, "processed": processed}
+
+def _handle_ack(conn, data):
+    cid = data.get("command_id")
     if cid:
-        dm.mark_command_ack(int(cid))
+        dm.mark_command_ack(int(cid), conn.device_id)
+
+def _handle_telemetry(conn, data):
+    socketio.emit(
+        "device_telemetry",
+        {"uid": conn.device_uid, "data": data.get("data"), "ts": data.get("ts")},
+        namespace="/",
+    )
+
+@socketio.on("device_bin")
+def on_device_bin(frame):
+    """Frame nhị phân (msgpack/struct) → dispatch qua các handler JSON ở trên."""
+    from backend.services.wire_codec import CodecError, message_to_event
+    codec = dm.wire.codec_for(request.sid)
+    if codec is None or not isinstance(frame, (bytes, bytearray)):
+        return
+    try:
+        msg = codec.decode(bytes(frame))
+    except CodecError:
+        return
+    uid = dm.wire.uid_for(request.sid, msg.get("handle", 0))
+    if not uid:
+        return
+    event, data = message_to_event(msg, uid)
+    handler = {
+        "device_heartbeat": on_device_heartbeat,
+        "device_command_ack": on_device_command_ack,
+        "device_batch": on_device_batch,
+    }.get(event)
+    if handler:
+        if event != "device_heartbeat":
+            data["heartbeat"] = True  # frame binary nào cũng tính là heartbeat
+        return handler(data)
+
+@socketio.on("firmware_chunk")
+@limit_event("device_firmware", _device_key)
+def on_firmware_chunk(data):
+    """Thiết bị kéo từng chunk (call/ack): {sha256, index} → {ok, index, data: bytes}."""
+    conn = dm.connections.by_sid(request.sid)
+    if conn is None:
+        return {"ok": False, "error": "unbound"}
+    return firmware_service.serve_chunk(conn, data or {})
+
+@socketio.on("firmware_verified")
+def on_firmware_verified(data):
+    conn = dm.connections.by_sid(request.sid)
+    if conn is None:
+        return {"ok": False, "error": "unbound"}
+    try:
+        ok = firmware_service.verified(conn, data or {})
+    except DBBusy:
+        return {"ok": False, "error": "busy"}  # thiết bị báo lại sau
+    if ok:
+        print(f"✅ firmware verified on {conn.device_uid}")
+    return {"ok": ok}
+
+@socketio.on("firmware_failed")
+def on_firmware_failed(data):
+    conn = dm.connections.by_sid(request.sid)
+    if conn is not None:
+        print(f"⚠️ firmware failed on {conn.device_uid}: {(data or {}).get('reason')}")
+        firmware_service.failed(conn, data or {})
+
+def _piggyback_heartbeat(conn, data):
+    """Gói tin có cờ heartbeat được tính như một heartbeat (khỏi gửi riêng)."""
+    if data.get("heartbeat") and dm.handle_heartbeat(conn):
+        _push_heartbeat_config(conn)
+
+def _push_heartbeat_config(conn):
+    """Gửi heartbeat interval (adaptive) về thiết bị khi lần đầu kết nối hoặc khi đổi."""
+    interval = dm.next_heartbeat_interval(conn.device_uid)
+    if interval is not None:
+        emit("heartbeat_config", {"interval": interval})
 
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 5000))
     print(f"🚀 IoT Lab running: http://0.0.0.0:{port}")
     print("http://192.168.2.11:5000/auth/login")
-    socketio.run(app, host="0.0.0.0", port=port, debug=True)
+    socketio.run(create_app(), host="0.0.0.0", port=port, debug=True)
     
@@ -20,6 +20,10 @@ class Config:
     )
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SQLALCHEMY_ENGINE_OPTIONS = {"pool_pre_ping": True}
+    # Read replica (trống = dùng chung writer); snapshot / báo cáo đọc từ đây
+    DATABASE_READ_URL = os.getenv("DATABASE_READ_URL", "")
+    # Vừa ghi trong N giây → đọc writer (read-your-writes khi replica còn lag)
+    DB_READ_YOUR_WRITES_SECONDS = float(os.getenv("DB_READ_YOUR_WRITES_SECONDS", "2"))
 
     # Socket.IO namespaces for FDMA-like separation
     SOCKETIO_CHANNELS = ["/ch0", "/ch1", "/ch2", "/ch3"]
@@ -32,12 +36,128 @@ class Config:
     WATCHDOG_TIMEOUT = int(os.getenv("WATCHDOG_TIMEOUT", "30"))  # seconds
     WATCHDOG_GRACE = int(os.getenv("WATCHDOG_GRACE", "5"))
 
+    # Thiết bị phải gửi token (HMAC của uid) khi connect Socket.IO
+    DEVICE_AUTH_REQUIRED = bool_env("DEVICE_AUTH_REQUIRED", True)
+
+    # Adaptive heartbeat: server gửi interval xuống thiết bị, tổng heartbeat/s <= budget
+    HEARTBEAT_RATE_BUDGET = float(os.getenv("HEARTBEAT_RATE_BUDGET", "50"))
+    HEARTBEAT_MIN_INTERVAL = float(os.getenv("HEARTBEAT_MIN_INTERVAL", "2"))
+    HEARTBEAT_MAX_INTERVAL = float(os.getenv("HEARTBEAT_MAX_INTERVAL", "60"))
+
     # Session / login
     REMEMBER_COOKIE_DURATION = timedelta(days=1)
 
+    # Cache principal (id, username, role) + token ký cho route không cần DB
+    USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "300"))  # seconds
+    USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "1024"))
+    AUTH_TOKEN_TTL = int(os.getenv("AUTH_TOKEN_TTL", "3600"))  # seconds
+
+    # Password hashing: chạy trong process pool, không chặn event loop Socket.IO
+    PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")  # werkzeug method string
+    PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+    PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "16"))  # admission limit
+    PASSWORD_HASH_TIMEOUT = float(os.getenv("PASSWORD_HASH_TIMEOUT", "10"))  # seconds
+
     # Rate limiting for user endpoints (per IP)
     RATELIMIT_DEFAULT = "20 per minute"
 
+    # Token bucket theo policy: limit ("N per second|minute|hour"), burst, action (drop|delay|disconnect)
+    RATELIMIT_POLICIES = {
+        "http_default": {"limit": RATELIMIT_DEFAULT, "action": "drop"},
+        "device_heartbeat": {"limit": "2 per second", "burst": 5, "action": "drop"},
+        "device_ack": {"limit": "20 per second", "burst": 50, "action": "delay", "max_delay": 0.5},
+        "device_telemetry": {"limit": "10 per second", "burst": 20, "action": "drop"},
+        "device_batch": {"limit": "5 per second", "burst": 10, "action": "disconnect"},
+        "command_user": {"limit": "10 per second", "burst": 30, "action": "drop"},  # quota command / user
+        "device_firmware": {"limit": "100 per second", "burst": 50, "action": "delay", "max_delay": 0.5},
+    }
+    RATELIMIT_IDLE_TTL = int(os.getenv("RATELIMIT_IDLE_TTL", "600"))  # seconds
+
+    # Coalescing command pending theo thiết bị:
+    # "supersede" → command mới huỷ pending cũ cùng group; "dedupe" → bỏ command trùng
+    COMMAND_COALESCE_RULES = {
+        "power": {"commands": ["start", "stop"], "mode": "supersede"},
+        "led": {"commands": ["LED_ON", "LED_OFF"], "mode": "supersede"},
+        "watchdog": {"commands": ["watchdog_reset"], "mode": "dedupe"},
+    }
+
+    # Lập lịch command: class ưu tiên (thứ tự = ưu tiên tuyệt đối) + fair queuing giữa user
+    COMMAND_PRIORITY_CLASSES = ["safety", "instructor", "student"]
+    COMMAND_SAFETY_COMMANDS = ["stop", "emergency_stop", "estop"]  # so sánh lowercase
+    COMMAND_INSTRUCTOR_ROLES = ["admin", "instructor", "teacher"]
+    COMMAND_ROLE_WEIGHTS = {"admin": 2.0, "instructor": 2.0, "teacher": 2.0}  # weight WFQ, mặc định 1
+    COMMAND_DISPATCH_RATE = float(os.getenv("COMMAND_DISPATCH_RATE", "100"))  # command/s toàn server
+    COMMAND_USER_MAX_QUEUED = int(os.getenv("COMMAND_USER_MAX_QUEUED", "100"))
+    COMMAND_USER_MAX_INFLIGHT = int(os.getenv("COMMAND_USER_MAX_INFLIGHT", "10"))  # sent chưa ack
+    COMMAND_INFLIGHT_TIMEOUT = float(os.getenv("COMMAND_INFLIGHT_TIMEOUT", "30"))  # s, hết hạn giữ chỗ in-flight
+
+    # Replay queue khi thiết bị online lại
+    REPLAY_MAX_AGE = int(os.getenv("REPLAY_MAX_AGE", "3600"))  # TTL (s): pending cũ hơn → expired
+    REPLAY_MAX_BACKLOG = int(os.getenv("REPLAY_MAX_BACKLOG", "200"))  # chỉ replay N command gần nhất
+    REPLAY_MAX_BATCH = int(os.getenv("REPLAY_MAX_BATCH", "50"))
+    REPLAY_DEFAULT_ACK_RATE = float(os.getenv("REPLAY_DEFAULT_ACK_RATE", "5"))  # ack/s khi chưa đo được
+    REPLAY_RETRY_LIMIT = int(os.getenv("REPLAY_RETRY_LIMIT", "5"))  # lỗi DB liên tiếp trước khi bỏ replay
+    REPLAY_RETRY_BASE = float(os.getenv("REPLAY_RETRY_BASE", "0.2"))  # s, backoff = base * 2^n (+ jitter)
+
+    # Device state machine: trạng thái in-memory, snapshot + journal ghi DB theo chu kỳ
+    STATE_SNAPSHOT_INTERVAL = float(os.getenv("STATE_SNAPSHOT_INTERVAL", "5"))
+    STATE_JOURNAL_MAX = int(os.getenv("STATE_JOURNAL_MAX", "500"))  # journal đầy → flush sớm
+    STATE_NEGATIVE_TTL = float(os.getenv("STATE_NEGATIVE_TTL", "30"))  # s, nhớ id/uid không có trong DB
+    STATE_NEGATIVE_MAX = int(os.getenv("STATE_NEGATIVE_MAX", "4096"))
+    STATE_LAST_SEEN_RESOLUTION = float(os.getenv("STATE_LAST_SEEN_RESOLUTION", "30"))  # s, heartbeat → ETag đổi
+
+    # GET /devices: keyset pagination (cursor), không OFFSET
+    DEVICE_LIST_DEFAULT_LIMIT = int(os.getenv("DEVICE_LIST_DEFAULT_LIMIT", "50"))
+    DEVICE_LIST_MAX_LIMIT = int(os.getenv("DEVICE_LIST_MAX_LIMIT", "500"))
+
+    # DB executor: query đồng bộ chạy trên OS thread pool (eventlet tpool / gevent / threads)
+    DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", "8"))
+    DB_EXECUTOR_MAX_QUEUE = int(os.getenv("DB_EXECUTOR_MAX_QUEUE", "256"))
+    DB_EXECUTOR_TIMEOUT = float(os.getenv("DB_EXECUTOR_TIMEOUT", "30"))  # chỉ áp dụng ở threading mode
+
+    # Khởi động: bỏ create_all khi schema đã được deploy (production), warm-up cache song song
+    SKIP_SCHEMA_CHECK = bool_env("SKIP_SCHEMA_CHECK", False)
+    WARMUP_ON_START = bool_env("WARMUP_ON_START", True)
+
+    # JSON encoder cho Flask + Socket.IO: auto (orjson nếu có) | orjson | stdlib
+    JSON_ENCODER = os.getenv("JSON_ENCODER", "auto")
+
+    # Firmware: store content-addressed trên đĩa, phát theo chunk qua Socket.IO (delta kiểu rsync)
+    FIRMWARE_DIR = os.getenv("FIRMWARE_DIR", os.path.join(BASE_DIR, "firmware_store"))
+    FIRMWARE_MAX_SIZE = int(os.getenv("FIRMWARE_MAX_SIZE", str(64 * 1024 * 1024)))  # chỉ áp dụng cho route upload
+    FIRMWARE_CHUNK_SIZE = int(os.getenv("FIRMWARE_CHUNK_SIZE", str(32 * 1024)))
+    FIRMWARE_DELTA_BLOCK = int(os.getenv("FIRMWARE_DELTA_BLOCK", "2048"))
+    FIRMWARE_DELTA_MAX_SIZE = int(os.getenv("FIRMWARE_DELTA_MAX_SIZE", str(4 * 1024 * 1024)))  # lớn hơn → gửi full
+    FIRMWARE_DELTA_MIN_SAVING = float(os.getenv("FIRMWARE_DELTA_MIN_SAVING", "0.2"))  # delta phải nhỏ hơn >= 20%
+    FIRMWARE_DELTA_WORKERS = int(os.getenv("FIRMWARE_DELTA_WORKERS", "1"))  # process riêng, không dùng db_executor
+    FIRMWARE_DELTA_MAX_PENDING = int(os.getenv("FIRMWARE_DELTA_MAX_PENDING", "4"))  # cặp đang tính, đầy → gửi full
+    FIRMWARE_DELTA_TIMEOUT = float(os.getenv("FIRMWARE_DELTA_TIMEOUT", "60"))  # chờ lâu hơn → gửi full
+
+    # Fleet analytics: heartbeat log dạng cột (segment trên đĩa) + báo cáo NumPy cache theo window
+    ANALYTICS_DIR = os.getenv("ANALYTICS_DIR", os.path.join(BASE_DIR, "analytics_data"))
+    ANALYTICS_HEARTBEAT_BUFFER = int(os.getenv("ANALYTICS_HEARTBEAT_BUFFER", "262144"))  # heartbeat / segment
+    ANALYTICS_SPILL_INTERVAL = float(os.getenv("ANALYTICS_SPILL_INTERVAL", "300"))  # seconds
+    ANALYTICS_RETENTION_DAYS = float(os.getenv("ANALYTICS_RETENTION_DAYS", "14"))
+    ANALYTICS_CACHE_BUCKET = float(os.getenv("ANALYTICS_CACHE_BUCKET", "60"))  # mốc cuối window làm tròn (s)
+    ANALYTICS_MAX_WINDOW = float(os.getenv("ANALYTICS_MAX_WINDOW", str(30 * 86400)))
+    ANALYTICS_FLAP_PER_HOUR = float(os.getenv("ANALYTICS_FLAP_PER_HOUR", "4"))  # >= N lần up↔offline / giờ → flapping
+    ANALYTICS_UPTIME_SLO = float(os.getenv("ANALYTICS_UPTIME_SLO", "0.99"))
+    ANALYTICS_WORKERS = int(os.getenv("ANALYTICS_WORKERS", "1"))  # thread riêng, không dùng db_executor
+    ANALYTICS_TIMEOUT = float(os.getenv("ANALYTICS_TIMEOUT", "300"))  # seconds
+
+    # Ghi traffic để replay (traffic_recorder.py / traffic_replay.py); trống = tắt
+    TRAFFIC_RECORD_PATH = os.getenv("TRAFFIC_RECORD_PATH", "")
+    TRAFFIC_RECORD_ENDPOINTS = [e.strip() for e in os.getenv(
+        "TRAFFIC_RECORD_ENDPOINTS", "dashboard.dashboard_control,dashboard.dashboard_status,device.*"
+    ).split(",") if e.strip()]
+    TRAFFIC_RECORD_FLUSH_INTERVAL = float(os.getenv("TRAFFIC_RECORD_FLUSH_INTERVAL", "5"))
+    TRAFFIC_RECORD_MAX_BODY = int(os.getenv("TRAFFIC_RECORD_MAX_BODY", "4096"))  # body lớn hơn → không ghi body
+
+    # Fault injection (chỉ cho soak test / replay, services/faults.py): tắt ở production
+    FAULT_INJECTION = bool_env("FAULT_INJECTION", False)
+    FAULT_SPEC = os.getenv("FAULT_SPEC", "")  # vd "db.latency=0.2:0.05,emit.drop=0.01"
+    FAULT_SEED = int(os.getenv("FAULT_SEED")) if os.getenv("FAULT_SEED") else None
+
     # Allowed device types
     ALLOWED_DEVICE_TYPES = {"raspberry_pi", "arduino_uno"}
 
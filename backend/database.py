@@ -1,19 +1,140 @@
-from sqlalchemy import create_engine
+import contextvars
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Dict, Optional
+
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, scoped_session
 from .config import Config
 from .models import Base   # ✅ import Base from models.py
 
-# --- Engine ---
+# --- Engines: writer (primary) + reader (replica) ---
+# DATABASE_READ_URL trống → reader dùng chung engine với writer.
+# Chạy local: replica giả = cùng file SQLite mở read-only, vd
+#   DATABASE_READ_URL="sqlite:///file:/path/iotlab.db?mode=ro&uri=true"
 engine = create_engine(
     Config.SQLALCHEMY_DATABASE_URI,
     future=True,
     **Config.SQLALCHEMY_ENGINE_OPTIONS
 )
+read_engine = (
+    create_engine(Config.DATABASE_READ_URL, future=True, **Config.SQLALCHEMY_ENGINE_OPTIONS)
+    if Config.DATABASE_READ_URL
+    else engine
+)
 
 # --- Session factory ---
 SessionLocal = scoped_session(
     sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True)
 )
+ReadSessionLocal = scoped_session(
+    sessionmaker(bind=read_engine, autoflush=False, autocommit=False, future=True)
+) if read_engine is not engine else SessionLocal
+
+
+def _read_only(session, flush_context, instances) -> None:
+    raise RuntimeError("read-only session: use SessionLocal / session_for('write') for mutations")
+
+
+if ReadSessionLocal is not SessionLocal:
+    event.listen(ReadSessionLocal.session_factory, "before_flush", _read_only)
+
+
+# ========= INTENT ROUTING =========
+# Pin về writer cho context hiện tại (request vừa ghi → đọc lại thấy ngay).
+# db_executor chạy job trong bản copy context nên pin theo sang worker thread.
+_pin_writer: contextvars.ContextVar[bool] = contextvars.ContextVar("db_pin_writer", default=False)
+
+
+def session_for(intent: str = "write", wrote_at: Optional[float] = None):
+    """
+    Session theo intent: "read" (snapshot, export, báo cáo) → reader,
+    "write" → writer. Read-your-writes: context đang pin, hoặc dữ liệu vừa đổi
+    (wrote_at, epoch seconds) trong DB_READ_YOUR_WRITES_SECONDS → vẫn đọc writer.
+    """
+    if intent != "read" or read_engine is engine or _pin_writer.get():
+        return SessionLocal()
+    if wrote_at is not None and time.time() - wrote_at < Config.DB_READ_YOUR_WRITES_SECONDS:
+        return SessionLocal()
+    return ReadSessionLocal()
+
+
+@contextmanager
+def read_your_writes():
+    """Trong khối này mọi session "read" đi writer."""
+    token = _pin_writer.set(True)
+    try:
+        yield
+    finally:
+        _pin_writer.reset(token)
+
+
+def pin_writer(active: bool = True) -> None:
+    """Pin cho phần còn lại của context hiện tại (gọi ở before_request)."""
+    _pin_writer.set(active)
+
+
+# ========= PER-ENGINE METRICS =========
+class EngineMetrics:
+    """Độ trễ từng câu lệnh (cursor execute) của một engine: count / lỗi / p50 / p99."""
+
+    def __init__(self, name: str, eng) -> None:
+        self.name = name
+        self.url = eng.url.render_as_string(hide_password=True)
+        self.statements = 0
+        self.errors = 0
+        self._times: deque = deque(maxlen=2048)
+        self._lock = threading.Lock()
+        event.listen(eng, "before_cursor_execute", self._before)
+        event.listen(eng, "after_cursor_execute", self._after)
+        event.listen(eng, "handle_error", self._error)
+
+    @staticmethod
+    def _before(conn, cursor, statement, parameters, context, executemany) -> None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        with self._lock:
+            self.statements += 1
+            self._times.append(elapsed)
+
+    def _error(self, ctx) -> None:
+        stack = ctx.connection.info.get("query_start") if ctx.connection is not None else None
+        if stack:
+            stack.pop()
+        with self._lock:
+            self.errors += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            s = sorted(self._times)
+            count, errors = self.statements, self.errors
+        pct = lambda q: round(s[min(len(s) - 1, int(q * len(s)))] * 1000, 3) if s else None
+        return {"url": self.url, "statements": count, "errors": errors,
+                "latency_ms": {"p50": pct(0.5), "p99": pct(0.99), "max": pct(1.0)}}
+
+
+engine_metrics = {"writer": EngineMetrics("writer", engine)}
+if read_engine is not engine:
+    engine_metrics["reader"] = EngineMetrics("reader", read_engine)
+
+
+def engine_stats() -> Dict[str, Any]:
+    return {name: m.stats() for name, m in engine_metrics.items()}
+
+
+def ensure_indexes() -> None:
+    """
+    create_all không thêm index vào bảng đã tồn tại → DB cũ (vd iotlab.db)
+    thiếu index mới. Tạo index còn thiếu (checkfirst = IF NOT EXISTS), chạy lại vô hại.
+    """
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
 
 # --- Dependency for DB session ---
 def get_db():
@@ -24,6 +145,20 @@ def get_db():
         db.close()
 
 # --- Cleanup ---
+def remove_sessions(exception=None):
+    """
+    Teardown mỗi request: trả session thread-local về pool. Route dùng
+    next(get_db()) rồi bắt exception không đóng kịp session (traceback giữ
+    generator) → thread werkzeug kế tiếp (keep-alive) dính transaction lỗi.
+    """
+    SessionLocal.remove()
+    if ReadSessionLocal is not SessionLocal:
+        ReadSessionLocal.remove()
+
+
 def shutdown_session(exception=None):
     SessionLocal.remove()
     engine.dispose()
+    if read_engine is not engine:
+        ReadSessionLocal.remove()
+        read_engine.dispose()
@@ -1,3 +1,6 @@
 from flask_socketio import SocketIO
 
-socketio = SocketIO(cors_allowed_origins="*")
+from backend import serializer
+
+# json=serializer: gói tin Socket.IO dùng cùng encoder với Flask (orjson nếu có, datetime OK)
+socketio = SocketIO(cors_allowed_origins="*", json=serializer)
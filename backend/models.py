@@ -3,7 +3,7 @@ from datetime import datetime
 from typing import Optional, List
 
 from flask_login import UserMixin
-from sqlalchemy import String, Integer, Text, DateTime, ForeignKey, Boolean, Index
+from sqlalchemy import String, Integer, Text, DateTime, ForeignKey, Boolean, Index, UniqueConstraint
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 
@@ -39,8 +39,8 @@ class Device(Base):
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     device_uid: Mapped[str] = mapped_column(String(64), unique=True, index=True, nullable=False)  # hardware UID
-    # slot vật lý/ logic (string cho linh hoạt), có index để TDMA/FDMA
-    slot: Mapped[Optional[str]] = mapped_column(String(32), nullable=True, index=True)
+    # slot vật lý/ logic (string cho linh hoạt), index (slot, id) ở dưới cho TDMA/FDMA
+    slot: Mapped[Optional[str]] = mapped_column(String(32), nullable=True)
 
     name: Mapped[str] = mapped_column(String(128), nullable=False)
     type: Mapped[str] = mapped_column(String(64), nullable=False)  # "arduino_uno" | "raspberry_pi"
@@ -56,10 +56,19 @@ class Device(Base):
 
     logs: Mapped[List["Log"]] = relationship("Log", back_populates="device", cascade="all, delete-orphan")
     commands: Mapped[List["CommandQueue"]] = relationship("CommandQueue", back_populates="device", cascade="all, delete-orphan")
+    tags: Mapped[List["DeviceTag"]] = relationship("DeviceTag", back_populates="device", cascade="all, delete-orphan")
 
     def __repr__(self) -> str:
         return f"<Device id={self.id} uid={self.device_uid} name={self.name} type={self.type} status={self.status} uploaded={self.code_uploaded}>"
 
+# Keyset pagination cho GET /devices: (cột filter/sort, id) → WHERE + ORDER BY + LIMIT chạy trên index
+Index("ix_devices_owner_id", Device.owner_id, Device.id)
+Index("ix_devices_status_id", Device.status, Device.id)
+Index("ix_devices_type_id", Device.type, Device.id)
+Index("ix_devices_slot_id", Device.slot, Device.id)
+Index("ix_devices_name_id", Device.name, Device.id)
+Index("ix_devices_last_seen_id", Device.last_seen, Device.id)
+
 
 # === COMMAND QUEUE MODEL ===
 class CommandQueue(Base):
@@ -83,6 +92,93 @@ class CommandQueue(Base):
 
 Index("ix_command_status", CommandQueue.status)
 
+
+# === DEVICE TAG (nhóm thiết bị, vd "room-b") ===
+class DeviceTag(Base):
+    __tablename__ = "device_tags"
+    __table_args__ = (UniqueConstraint("device_id", "tag", name="uq_device_tag"),)
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    tag: Mapped[str] = mapped_column(String(64), nullable=False, index=True)
+    device_id: Mapped[int] = mapped_column(ForeignKey("devices.id", ondelete="CASCADE"), index=True)
+
+    device: Mapped["Device"] = relationship("Device", back_populates="tags")
+
+    def __repr__(self) -> str:
+        return f"<DeviceTag device_id={self.device_id} tag={self.tag}>"
+
+
+# === BROADCAST (1 command fan-out tới một nhóm thiết bị) ===
+class CommandBroadcast(Base):
+    __tablename__ = "command_broadcasts"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    command: Mapped[str] = mapped_column(Text, nullable=False)
+    selector: Mapped[str] = mapped_column(Text, nullable=False)  # JSON filter nhóm
+    target_count: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), index=True)
+
+    def __repr__(self) -> str:
+        return f"<CommandBroadcast id={self.id} command={self.command} targets={self.target_count}>"
+
+
+class BroadcastItem(Base):
+    __tablename__ = "broadcast_items"
+
+    broadcast_id: Mapped[int] = mapped_column(ForeignKey("command_broadcasts.id", ondelete="CASCADE"), primary_key=True)
+    command_id: Mapped[int] = mapped_column(ForeignKey("command_queue.id", ondelete="CASCADE"), primary_key=True)
+
+
+# === DEVICE TRANSITION (journal chuyển trạng thái, ghi theo batch) ===
+class DeviceTransition(Base):
+    __tablename__ = "device_transitions"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    from_status: Mapped[str] = mapped_column(String(32), nullable=False)
+    to_status: Mapped[str] = mapped_column(String(32), nullable=False)
+    source: Mapped[str] = mapped_column(String(32), nullable=False)  # heartbeat|watchdog|api|socket
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+    device_id: Mapped[int] = mapped_column(ForeignKey("devices.id", ondelete="CASCADE"), index=True)
+
+    def __repr__(self) -> str:
+        return f"<DeviceTransition device_id={self.device_id} {self.from_status}->{self.to_status} source={self.source}>"
+
+
+# === FIRMWARE (artifact content-addressed theo sha256, file nằm ở FIRMWARE_DIR) ===
+class FirmwareArtifact(Base):
+    __tablename__ = "firmware_artifacts"
+
+    sha256: Mapped[str] = mapped_column(String(64), primary_key=True)
+    size: Mapped[int] = mapped_column(Integer, nullable=False)
+    filename: Mapped[str] = mapped_column(String(255), nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+    uploaded_by: Mapped[Optional[int]] = mapped_column(ForeignKey("users.id", ondelete="SET NULL"), nullable=True)
+
+    def __repr__(self) -> str:
+        return f"<FirmwareArtifact sha256={self.sha256[:12]} size={self.size} filename={self.filename}>"
+
+
+class DeviceFirmware(Base):
+    __tablename__ = "device_firmware"
+
+    device_id: Mapped[int] = mapped_column(ForeignKey("devices.id", ondelete="CASCADE"), primary_key=True)
+    current_sha: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)  # bản thiết bị đã verify
+    target_sha: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+    status: Mapped[str] = mapped_column(String(16), default="idle")  # idle|pending|transferring|verified|failed
+    encoding: Mapped[Optional[str]] = mapped_column(String(8), nullable=True)  # full|delta
+    chunks_sent: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    chunks_total: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    error: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self) -> str:
+        return f"<DeviceFirmware device_id={self.device_id} status={self.status} target={(self.target_sha or '')[:12]}>"
+
+
 # === LOG MODEL ===
 class Log(Base):
     __tablename__ = "logs"
@@ -1,11 +1,14 @@
 from flask import Blueprint, request, jsonify, render_template, request, redirect, url_for, session, flash
-from werkzeug.security import generate_password_hash, check_password_hash
-from flask_login import LoginManager, login_user, logout_user, login_required, current_user
+from flask_login import LoginManager, login_user, logout_user
 from typing import cast
 
+from backend.config import Config
 from backend.database import get_db
 from backend.models import User
 from backend.security.sanitizer import sanitize_str
+from backend.security.identity import principal_cache, issue_token, current_principal, principal_required
+from backend.security.passwords import HashingBusy, hash_password, verify_password
+from backend.security.rate_limiter import rate_limit
 
 auth_bp = Blueprint("auth", __name__, url_prefix="/auth")
 
@@ -19,18 +22,18 @@ def unauthorized_callback():
 
 @login_manager.user_loader
 def load_user(user_id):
-    db = next(get_db())
-    return db.get(User, int(user_id))
+    # Principal bất biến từ cache (TTL + LRU), chỉ chạm DB khi miss
+    return principal_cache.get_by_id(int(user_id))
 
 
 # === REGISTER ===
 @auth_bp.route("/register", methods=["POST"])
+@rate_limit()
 def register():
     data = request.get_json() or {}
 
     username = sanitize_str(data.get("username"), default="", max_length=64)
     password = data.get("password")
-    role = sanitize_str(data.get("role"), default="user", max_length=16)
 
     if not username or not password:
         return jsonify({"error": "Missing username or password"}), 400
@@ -40,23 +43,51 @@ def register():
     if existing:
         return jsonify({"error": "User already exists"}), 400
 
-    hashed_pw = generate_password_hash(password)
-    user = User(username=username, password_hash=hashed_pw, role=role)
+    # Hash ở process pool: không chặn event loop Socket.IO (heartbeat thiết bị)
+    try:
+        hashed_pw = hash_password(password)
+    except (HashingBusy, TimeoutError):
+        return jsonify({"error": "Server busy, try again"}), 503, {"Retry-After": "1"}
+    # Tự đăng ký luôn là "user": role (class / weight scheduler, admin) chỉ gán phía server
+    user = User(username=username, password_hash=hashed_pw, role="user")
     db.add(user)
     db.commit()
 
     return jsonify({"message": "User registered successfully"}), 201
 
 
+def _authenticate(username: str, password: str) -> bool:
+    """
+    So mật khẩu với hash trong DB (verify ở process pool, không chặn event loop).
+    Tài khoản dashboard mặc định (admin/1234) được tạo dòng User ở lần đăng nhập
+    đầu, từ đó đi qua verify_password như mọi user khác.
+    """
+    db = next(get_db())
+    user = db.query(User).filter_by(username=username).first()
+    if user is None:
+        if username != "admin" or password != "1234":
+            return False
+        db.add(User(username=username, password_hash=hash_password(password), role="admin"))
+        db.commit()
+        return True
+    return verify_password(user.password_hash, password)
+
+
 # === LOGIN ===
 @auth_bp.route("/login", methods=["GET", "POST"])
+@rate_limit()
 def login():
     if request.method == "POST":
-        username = request.form.get("username")
-        password = request.form.get("password")
+        username = sanitize_str(request.form.get("username"), default="", max_length=64)
+        password = request.form.get("password") or ""
 
-        # TODO: Replace with real authentication
-        if username == "admin" and password == "1234":
+        try:
+            ok = bool(username) and _authenticate(username, password)
+        except (HashingBusy, TimeoutError):
+            flash("Server busy, try again", "danger")
+            return redirect(url_for("auth.login"))
+        if ok:
+            # Session chỉ giữ username → current_principal() tra lại dòng User
             session["user"] = username
             flash("Login successful!", "success")
             return redirect(url_for("home"))
@@ -76,14 +107,26 @@ def logout():
     return redirect(url_for("auth.login"))
 
 
+# === ISSUE TOKEN ===
+@auth_bp.route("/token", methods=["POST"])
+@rate_limit()
+@principal_required
+def token():
+    """Token ký tự chứa (id, username, role): gửi kèm `Authorization: Bearer ...`."""
+    principal = current_principal()
+    return jsonify({"token": issue_token(principal), "expires_in": Config.AUTH_TOKEN_TTL})
+
+
 # === GET CURRENT USER ===
 @auth_bp.route("/me", methods=["GET"])
-@login_required
+@principal_required
 def me():
+    principal = current_principal()
+    created_at = getattr(principal, "created_at", None)
     return jsonify({
-        "id": current_user.id,
-        "username": current_user.username,
-        "role": current_user.role,
-        "created_at": current_user.created_at.isoformat() if current_user.created_at else None
+        "id": principal.id,
+        "username": principal.username,
+        "role": principal.role,
+        "created_at": created_at.isoformat() if created_at else None
     })
 
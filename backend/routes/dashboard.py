@@ -1,27 +1,40 @@
 # backend/routes/dashboard.py
 from flask import Blueprint, render_template, session, redirect, url_for, request, jsonify, flash
-from backend.services.device_manager import DeviceManager
-from backend.database import SessionLocal
-from backend.models import Device, User
+from backend.services.container import dm
+from backend.database import engine_stats
+from backend.models import Device
 from backend.security.sanitizer import sanitize_str
+from backend.security.identity import admin_required, principal_cache
+from backend.security.rate_limiter import rate_limit, limiter
+from backend.services.command_scheduler import CommandRejected, command_scheduler
+from backend.services.db_executor import db_executor
+from backend.services.device_listing import device_lister
+from backend.services.response_cache import conditional_stats, status_cache, status_summary_cache
 
 dashboard_bp = Blueprint("dashboard", __name__, url_prefix="/dashboard")
-dm = DeviceManager()
+
+def _rejected(e: CommandRejected):
+    return jsonify({"error": "command quota exceeded", "reason": e.reason}), 429, {"Retry-After": str(max(1, round(e.retry_after)))}
 
 @dashboard_bp.route("/", methods=["GET"])
 def dashboard_home():
     if "user" not in session:
         return redirect(url_for("auth.login"))
-    snap = dm.get_status_snapshot()
-    return render_template("dashboard.html", snapshot=snap)
+    # Trang chỉ là khung: users/queue qua /dashboard/status, thiết bị theo trang qua GET /devices
+    return render_template("dashboard.html")
 
 @dashboard_bp.route("/status", methods=["GET"])
 def dashboard_status():
     if "user" not in session:
         return jsonify({"error": "unauthorized"}), 401
-    return jsonify(dm.get_status_snapshot())
+    # ETag theo change counter: không đổi → 304, không query DB; body cache theo version
+    if request.args.get("devices") == "0":
+        # Dashboard phân trang thiết bị qua GET /devices: snapshot chỉ còn users/queue
+        return status_summary_cache.respond(request, lambda: dm.get_status_snapshot_json(include_devices=False))
+    return status_cache.respond(request, dm.get_status_snapshot_json)
 
 @dashboard_bp.route("/control", methods=["POST"])
+@rate_limit()
 def dashboard_control():
     if "user" not in session:
         return jsonify({"error": "unauthorized"}), 401
@@ -34,22 +47,19 @@ def dashboard_control():
     if not device_id or not action:
         return jsonify({"error": "missing action/device_id"}), 400
 
-    # user id demo (nếu bạn đã có login thật thì lấy từ DB theo session["user"])
-    with SessionLocal() as db:
-        u = db.query(User).filter(User.username == session["user"]).first()
-        user_id = u.id if u else 0
-
-    # Queue + phát lệnh
-    if action in ("start", "stop", "watchdog_reset"):
-        dm.enqueue_command(device_id, user_id, action)
-        dm.dispatch_pending_for_device(device_id)
-        return jsonify({"ok": True, "queued": action})
-    elif action.startswith("cmd:"):
+    # user id từ cache principal (không query DB mỗi action)
+    principal = principal_cache.get_by_username(session["user"])
+    user_id = principal.id if principal else 0
+
+    # Queue qua scheduler (ưu tiên + fair-share), phát theo lượt
+    if action in ("start", "stop", "watchdog_reset") or action.startswith("cmd:"):
         # cmd tuỳ ý: "cmd:LED_ON"
-        cmd = action.split("cmd:", 1)[1]
-        dm.enqueue_command(device_id, user_id, cmd)
-        dm.dispatch_pending_for_device(device_id)
-        return jsonify({"ok": True, "queued": cmd})
+        cmd = action.split("cmd:", 1)[1] if action.startswith("cmd:") else action
+        try:
+            _, coalesced = dm.queue_command(device_id, user_id, cmd)
+        except CommandRejected as e:
+            return _rejected(e)
+        return jsonify({"ok": True, "queued": cmd, "coalesced": coalesced})
     elif action == "mark_uploaded":
         dm.mark_code_uploaded(device_id, True)
         return jsonify({"ok": True, "uploaded": True})
@@ -58,3 +68,129 @@ def dashboard_control():
         return jsonify({"ok": True, "uploaded": False})
 
     return jsonify({"error": "unknown action"}), 400
+
+
+@dashboard_bp.route("/broadcast", methods=["POST"])
+@rate_limit()
+def dashboard_broadcast():
+    """
+    Gửi 1 command tới cả nhóm thiết bị, vd:
+    {"command": "stop", "tag": "room-b", "type": "arduino_uno"}
+    Filter: tag / type / owner_id / slot (kết hợp AND, cần ít nhất 1).
+    """
+    if "user" not in session:
+        return jsonify({"error": "unauthorized"}), 401
+
+    data = request.get_json(silent=True) or {}
+    command = sanitize_str(data.get("command"), max_length=64)
+    selector = {
+        k: sanitize_str(str(data[k]), max_length=64)
+        for k in ("tag", "type", "owner_id", "slot")
+        if data.get(k) not in (None, "")
+    }
+    if not command or not selector:
+        return jsonify({"error": "missing command/selector"}), 400
+
+    principal = principal_cache.get_by_username(session["user"])
+    user_id = principal.id if principal else 0
+
+    try:
+        progress = dm.broadcast_command(user_id, command, selector)
+    except CommandRejected as e:
+        return _rejected(e)
+    if progress is None:
+        return jsonify({"error": "no device matches selector"}), 404
+    return jsonify(progress), 202
+
+
+@dashboard_bp.route("/broadcast/<int:broadcast_id>", methods=["GET"])
+def dashboard_broadcast_progress(broadcast_id):
+    if "user" not in session:
+        return jsonify({"error": "unauthorized"}), 401
+    progress = dm.broadcast_progress(broadcast_id)
+    if progress is None:
+        return jsonify({"error": "not found"}), 404
+    return jsonify(progress)
+
+
+@dashboard_bp.route("/coalesce", methods=["GET"])
+def dashboard_coalesce():
+    """Số command pending đã bị gộp/huỷ theo từng group coalescing."""
+    if "user" not in session:
+        return jsonify({"error": "unauthorized"}), 401
+    return jsonify(dm.coalesce_stats())
+
+
+@dashboard_bp.route("/ratelimit", methods=["GET"])
+def dashboard_ratelimit():
+    """Bộ đếm từ chối của rate limiter (top key bị chặn nhiều nhất)."""
+    if "user" not in session:
+        return jsonify({"error": "unauthorized"}), 401
+    return jsonify(limiter.stats())
+
+
+@dashboard_bp.route("/db", methods=["GET"])
+def dashboard_db():
+    """Metrics của DB executor (in-flight, hàng đợi, chờ/chạy) + độ trễ từng engine writer/reader."""
+    if "user" not in session:
+        return jsonify({"error": "unauthorized"}), 401
+    return jsonify({**db_executor.stats(), "engines": engine_stats()})
+
+
+@dashboard_bp.route("/cache", methods=["GET"])
+def dashboard_cache():
+    """Số lần render / dùng lại cache / trả 304 của /dashboard/status (summary: ?devices=0)."""
+    if "user" not in session:
+        return jsonify({"error": "unauthorized"}), 401
+    return jsonify({**status_cache.stats(), "summary": status_summary_cache.stats()})
+
+
+@dashboard_bp.route("/devices/stats", methods=["GET"])
+def dashboard_devices_stats():
+    """GET /devices: số trang phục vụ từ secondary index in-memory / từ SQL, số lần trả 304."""
+    if "user" not in session:
+        return jsonify({"error": "unauthorized"}), 401
+    return jsonify({**device_lister.stats(), "http": conditional_stats()})
+
+
+@dashboard_bp.route("/scheduler", methods=["GET"])
+def dashboard_scheduler():
+    """Scheduler command: hàng đợi / in-flight / histogram thời gian chờ theo user và class."""
+    if "user" not in session:
+        return jsonify({"error": "unauthorized"}), 401
+    return jsonify(command_scheduler.stats())
+
+
+@dashboard_bp.route("/analytics", methods=["GET"])
+@admin_required
+def dashboard_analytics():
+    """
+    Báo cáo sức khoẻ fleet: uptime, flapping, jitter heartbeat, độ trễ ACK.
+    ?window=24h|7d|<giây>&sort=uptime|flaps|jitter|gap|ack_p95&limit=100
+    """
+    # numpy chỉ nạp khi admin mở báo cáo, không nằm trên đường khởi động
+    from backend.services.analytics import SORT_KEYS, parse_window, run_report
+
+    try:
+        window = parse_window(request.args.get("window"))
+        limit = max(1, min(int(request.args.get("limit", 100)), 10000))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    sort = request.args.get("sort", "uptime")
+    if sort not in SORT_KEYS:
+        return jsonify({"error": f"sort must be one of {sorted(SORT_KEYS)}"}), 400
+    devices = [(st.device_id, st.device_uid, st.status) for st in dm.states.all()]
+    try:
+        report = run_report(window, devices)
+    except TimeoutError:
+        return jsonify({"error": "analytics report timed out, try again"}), 503, {"Retry-After": "5"}
+    return jsonify(report.to_dict(sort, limit))
+
+
+@dashboard_bp.route("/analytics/stats", methods=["GET"])
+@admin_required
+def dashboard_analytics_stats():
+    """Số lần tính / dùng cache báo cáo và trạng thái heartbeat log."""
+    from backend.services.analytics import fleet_analytics
+
+    return jsonify(fleet_analytics.stats())
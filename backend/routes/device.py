@@ -1,19 +1,40 @@
 # backend/routes/device.py
 
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, session
 from flask_login import login_required, current_user
 from flask_jwt_extended import jwt_required, get_jwt_identity
+from werkzeug.exceptions import RequestEntityTooLarge
 
+from backend.config import Config
 from backend.database import get_db
 from backend.models import Device
+from backend.security.identity import current_principal, principal_required
 from backend.security.sanitizer import sanitize_str
-from backend.services.device_manager import DeviceManager
+from backend.services.command_scheduler import CommandRejected
+from backend.services.container import dm as device_manager
+from backend.services.device_listing import device_lister, parse_query
+from backend.services.device_state import TRANSITIONS, InvalidTransition
+from backend.services.firmware import FirmwareError, FirmwareTooLarge, firmware_service
+from backend.services.response_cache import conditional
 from backend.extensions import socketio
+from backend.security.rate_limiter import rate_limit
 
 device_bp = Blueprint("device", __name__)
 
-# Service manager với socketio
-device_manager = DeviceManager()
+def _try_set_status(device_id: int, status: str) -> str:
+    """Chuyển status nếu hợp lệ (vd offline → running thì giữ offline). Trả về status hiện tại."""
+    try:
+        device_manager.set_status(device_id, status, source="api")
+    except InvalidTransition:
+        pass
+    st = device_manager.device_state(device_id)
+    return st.status if st else status
+
+
+def _rejected(e: CommandRejected):
+    """Vượt quota command của user → 429 + Retry-After."""
+    return jsonify({"error": "Command quota exceeded", "reason": e.reason}), 429, {"Retry-After": str(max(1, round(e.retry_after)))}
+
 
 @device_bp.route("/test", methods=["GET"])
 def test_device():
@@ -21,6 +42,30 @@ def test_device():
     return jsonify({"status": "ok"})
 
 
+@device_bp.route("/devices", methods=["GET"])
+def list_devices():
+    """
+    Danh sách thiết bị: filter + sort + keyset pagination, vd
+    /devices?status=online&type=arduino_uno&sort=-last_seen&limit=50&cursor=<next_cursor>
+    Dashboard (session) xem tất cả; principal không phải admin chỉ thấy thiết bị của mình.
+    """
+    principal = None
+    if "user" not in session:
+        principal = current_principal()
+        if principal is None:
+            return jsonify({"error": "Unauthorized"}), 401
+    try:
+        q = parse_query(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if principal is not None and principal.role != "admin":
+        if q.owner not in (None, principal.id):
+            return jsonify({"error": "Forbidden"}), 403
+        q = q._replace(owner=principal.id)
+    # ETag theo change counter + query (filter, cursor, scope): dashboard poll 3s → 304 khi không đổi
+    return conditional(request, repr(q), lambda: jsonify(device_lister.list(q)))
+
+
 @device_bp.route("/register", methods=["POST"])
 @jwt_required()
 def register_device():
@@ -41,6 +86,7 @@ def register_device():
         new_device = Device(name=name, type=type, owner_id=user_id)
         db.add(new_device)
         db.commit()
+        device_manager.states.refresh(new_device.id)
 
         return jsonify({"message": "Device registered successfully", "device_id": new_device.id}), 201
 
@@ -48,6 +94,25 @@ def register_device():
         return jsonify({"error": str(e)}), 500
 
 
+@device_bp.route("/<int:device_id>/token", methods=["GET"])
+@principal_required
+def device_token(device_id):
+    """
+    Lấy token để thiết bị xác thực khi connect Socket.IO.
+    """
+    try:
+        user_id = current_principal().id
+        db = next(get_db())
+        device = db.query(Device).filter_by(id=device_id, owner_id=user_id).first()
+        if not device:
+            return jsonify({"error": "Device not found"}), 404
+
+        return jsonify({"device_uid": device.device_uid, "token": device_manager.device_token(device.device_uid)}), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
 @device_bp.route("/<int:device_id>/update", methods=["PUT"])
 @jwt_required()
 def update_device(device_id):
@@ -63,16 +128,50 @@ def update_device(device_id):
             return jsonify({"error": "Device not found"}), 404
 
         data = request.get_json() or {}
+        status = sanitize_str(data["status"], max_length=32) if "status" in data else None
+        if status is not None:
+            if status not in TRANSITIONS:
+                return jsonify({"error": f"Invalid status: {status}"}), 400
+            if not device_manager.can_set_status(device.id, status):
+                current = device_manager.device_state(device.id).status
+                return jsonify({"error": f"Invalid transition {current} → {status}"}), 409
+
         if "name" in data:
             device.name = sanitize_str(data["name"])
         if "type" in data:
             device.type = sanitize_str(data["type"])
-        if "status" in data:
-            device.status = sanitize_str(data["status"])
-
         db.commit()
+        device_manager.states.refresh(device.id)
+
+        # Status do state machine giữ (in-memory), không ghi thẳng vào DB
+        if status is not None:
+            device_manager.set_status(device.id, status, source="api")
         return jsonify({"message": "Device updated successfully"}), 200
 
+    except InvalidTransition as e:
+        return jsonify({"error": f"Invalid transition {e}"}), 409
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@device_bp.route("/<int:device_id>/tags", methods=["PUT"])
+@principal_required
+def set_device_tags(device_id):
+    """
+    Gán nhóm (tag) cho thiết bị, vd {"tags": ["room-b", "group-3"]}.
+    """
+    try:
+        user_id = current_principal().id
+        db = next(get_db())
+        device = db.query(Device).filter_by(id=device_id, owner_id=user_id).first()
+        if not device:
+            return jsonify({"error": "Device not found"}), 404
+
+        data = request.get_json() or {}
+        tags = [sanitize_str(t, max_length=64) for t in data.get("tags") or [] if isinstance(t, str)]
+        return jsonify({"tags": device_manager.set_device_tags(device.id, tags)}), 200
+
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -93,6 +192,7 @@ def delete_device(device_id):
 
         db.delete(device)
         db.commit()
+        device_manager.states.remove(device_id)
         return jsonify({"message": "Device deleted successfully"}), 200
 
     except Exception as e:
@@ -101,6 +201,7 @@ def delete_device(device_id):
 
 @device_bp.route("/<int:device_id>/start", methods=["POST"])
 @jwt_required()
+@rate_limit()
 def start_device(device_id):
     """
     Yêu cầu bật thiết bị.
@@ -112,19 +213,21 @@ def start_device(device_id):
         if not device:
             return jsonify({"error": "Device not found"}), 404
 
-        # Gửi lệnh xuống hardware client
+        # Gửi lệnh xuống hardware client (offline → vẫn queue, replay khi online lại)
         device_manager.send_command(device.id, current_user.id, "START")
 
-        device.status = "running"
-        db.commit()
-        return jsonify({"message": f"Device {device.name} started"}), 200
+        status = _try_set_status(device.id, "running")
+        return jsonify({"message": f"Device {device.name} started", "status": status}), 200
 
+    except CommandRejected as e:
+        return _rejected(e)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
 @device_bp.route("/<int:device_id>/stop", methods=["POST"])
 @jwt_required()
+@rate_limit()
 def stop_device(device_id):
     """
     Yêu cầu dừng thiết bị.
@@ -138,16 +241,18 @@ def stop_device(device_id):
 
         device_manager.send_command(device.id, current_user.id, "STOP")
 
-        device.status = "stopped"
-        db.commit()
-        return jsonify({"message": f"Device {device.name} stopped"}), 200
+        status = _try_set_status(device.id, "stopped")
+        return jsonify({"message": f"Device {device.name} stopped", "status": status}), 200
 
+    except CommandRejected as e:
+        return _rejected(e)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
 @device_bp.route("/<int:device_id>/watchdog/reset", methods=["POST"])
 @jwt_required()
+@rate_limit()
 def reset_watchdog(device_id):
     """
     Reset watchdog timer của thiết bị.
@@ -162,12 +267,15 @@ def reset_watchdog(device_id):
         device_manager.send_command(device.id, current_user.id, "WATCHDOG_RESET")
         return jsonify({"message": "Watchdog reset signal sent"}), 200
 
+    except CommandRejected as e:
+        return _rejected(e)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
 @device_bp.route("/<int:device_id>/command", methods=["POST"])
 @jwt_required()
+@rate_limit()
 def send_custom_command(device_id):
     """
     Gửi command tùy ý xuống thiết bị (ví dụ 'LED_ON', 'LED_OFF').
@@ -188,5 +296,72 @@ def send_custom_command(device_id):
 
         return jsonify({"message": f"Command '{cmd}' sent to {device.name}"}), 200
 
+    except CommandRejected as e:
+        return _rejected(e)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+# ========= FIRMWARE =========
+@device_bp.route("/firmware", methods=["POST"])
+@principal_required
+@rate_limit()
+def upload_firmware():
+    """
+    Upload firmware (body là file nhị phân, stream thẳng xuống store, không buffer).
+    Tên file qua ?filename= hoặc header X-Filename. Trùng nội dung → 200, không lưu lại.
+    """
+    try:
+        filename = sanitize_str(request.args.get("filename") or request.headers.get("X-Filename") or "firmware.bin", max_length=255)
+        artifact, created = firmware_service.register_artifact(request.stream, filename, current_principal().id)
+        return jsonify({**artifact, "deduplicated": not created}), 201 if created else 200
+
+    except (FirmwareTooLarge, RequestEntityTooLarge):
+        return jsonify({"error": f"Firmware larger than {Config.FIRMWARE_MAX_SIZE} bytes"}), 413
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@device_bp.route("/<int:device_id>/firmware", methods=["POST"])
+@principal_required
+@rate_limit()
+def deploy_firmware(device_id):
+    """
+    Gán firmware (sha256 đã upload) cho thiết bị; online thì offer ngay, offline thì lúc connect.
+    """
+    try:
+        user_id = current_principal().id
+        db = next(get_db())
+        device = db.query(Device).filter_by(id=device_id, owner_id=user_id).first()
+        if not device:
+            return jsonify({"error": "Device not found"}), 404
+
+        sha = sanitize_str((request.get_json() or {}).get("sha256")).lower()
+        if not sha:
+            return jsonify({"error": "Missing sha256"}), 400
+
+        return jsonify(firmware_service.deploy(device.id, sha)), 202
+
+    except FirmwareError as e:
+        return jsonify({"error": str(e)}), 404
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@device_bp.route("/<int:device_id>/firmware", methods=["GET"])
+@principal_required
+def firmware_status(device_id):
+    """
+    Trạng thái phát firmware của thiết bị (pending / transferring / verified / failed + tiến độ).
+    """
+    try:
+        user_id = current_principal().id
+        db = next(get_db())
+        device = db.query(Device).filter_by(id=device_id, owner_id=user_id).first()
+        if not device:
+            return jsonify({"error": "Device not found"}), 404
+
+        return jsonify(firmware_service.status(device.id)), 200
+
     except Exception as e:
         return jsonify({"error": str(e)}), 500
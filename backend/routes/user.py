@@ -1,13 +1,14 @@
 from flask import Blueprint, jsonify 
-from flask_login import login_required, current_user
+from backend.security.identity import current_principal, principal_required
 
 user_bp = Blueprint('user', __name__)   # <-- rename to user_bp
 
 @user_bp.route('/me')
-@login_required
+@principal_required
 def me():
+    principal = current_principal()
     return jsonify({
-        'id': current_user.id,
-        'username': current_user.username,
-        'role': getattr(current_user, 'role', 'student')
+        'id': principal.id,
+        'username': principal.username,
+        'role': getattr(principal, 'role', 'student')
     })
@@ -0,0 +1,221 @@
+# backend/security/identity.py
+"""
+Định danh người dùng không cần chạm DB ở đường nóng:
+- UserPrincipal: bản sao bất biến (id, username, role) của User
+- PrincipalCache: cache TTL + LRU, tự invalidate khi User đổi/xoá
+- Token ký (JWT, HS256) tự chứa principal → route xác thực không cần DB
+"""
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from functools import wraps
+from typing import Any, Callable, Optional
+
+import jwt
+from flask import g, jsonify, request, session
+from flask_login import current_user
+from sqlalchemy import event
+
+from backend.config import Config
+from backend.database import SessionLocal
+from backend.models import User
+
+
+class UserPrincipal:
+    """Principal bất biến, dùng được làm user cho Flask-Login."""
+
+    __slots__ = ("id", "username", "role", "created_at")
+
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def __init__(self, id: int, username: str, role: str, created_at: Optional[datetime] = None) -> None:
+        object.__setattr__(self, "id", id)
+        object.__setattr__(self, "username", username)
+        object.__setattr__(self, "role", role)
+        object.__setattr__(self, "created_at", created_at)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("UserPrincipal is immutable")
+
+    def get_id(self) -> str:
+        return str(self.id)
+
+    @classmethod
+    def from_user(cls, u: User) -> "UserPrincipal":
+        return cls(u.id, u.username, u.role, u.created_at)
+
+    def __repr__(self) -> str:
+        return f"<UserPrincipal id={self.id} username={self.username} role={self.role}>"
+
+
+class PrincipalCache:
+    """Cache TTL + LRU cho principal, tra theo id hoặc username."""
+
+    def __init__(self, ttl: float, maxsize: int) -> None:
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._by_id: "OrderedDict[int, tuple]" = OrderedDict()
+        self._id_by_username: dict = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, user_id: int) -> Optional[UserPrincipal]:
+        with self._lock:
+            entry = self._by_id.get(user_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, principal = entry
+            if expires < time.monotonic():
+                self._drop(user_id)
+                self.misses += 1
+                return None
+            self._by_id.move_to_end(user_id)
+            self.hits += 1
+            return principal
+
+    def _put(self, principal: UserPrincipal) -> None:
+        with self._lock:
+            self._by_id[principal.id] = (time.monotonic() + self.ttl, principal)
+            self._by_id.move_to_end(principal.id)
+            self._id_by_username[principal.username] = principal.id
+            while len(self._by_id) > self.maxsize:
+                _, (_, old) = self._by_id.popitem(last=False)
+                self._id_by_username.pop(old.username, None)
+
+    def _drop(self, user_id: int) -> None:
+        entry = self._by_id.pop(user_id, None)
+        if entry is not None:
+            self._id_by_username.pop(entry[1].username, None)
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            self._drop(user_id)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._by_id.clear()
+            self._id_by_username.clear()
+
+    def warm(self, limit: int) -> int:
+        """Nạp trước principal của các user hoạt động gần đây (lúc khởi động)."""
+        with SessionLocal() as db:
+            users = (
+                db.query(User)
+                .order_by(User.last_seen.desc(), User.id.desc())
+                .limit(limit)
+                .all()
+            )
+            principals = [UserPrincipal.from_user(u) for u in users]
+        for principal in principals:
+            self._put(principal)
+        return len(principals)
+
+    def get_by_id(self, user_id: int) -> Optional[UserPrincipal]:
+        principal = self._get(user_id)
+        if principal is not None:
+            return principal
+        with SessionLocal() as db:
+            u = db.get(User, user_id)
+            if not u:
+                return None
+            principal = UserPrincipal.from_user(u)
+        self._put(principal)
+        return principal
+
+    def get_by_username(self, username: str) -> Optional[UserPrincipal]:
+        user_id = self._id_by_username.get(username)
+        if user_id is not None:
+            principal = self._get(user_id)
+            if principal is not None:
+                return principal
+        with SessionLocal() as db:
+            u = db.query(User).filter(User.username == username).first()
+            if not u:
+                return None
+            principal = UserPrincipal.from_user(u)
+        self._put(principal)
+        return principal
+
+
+principal_cache = PrincipalCache(Config.USER_CACHE_TTL, Config.USER_CACHE_SIZE)
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _invalidate_user(mapper, connection, target) -> None:
+    principal_cache.invalidate(target.id)
+
+
+# ========= SIGNED TOKENS =========
+def issue_token(principal: UserPrincipal, ttl: Optional[int] = None) -> str:
+    now = int(time.time())
+    payload = {
+        "sub": str(principal.id),
+        "username": principal.username,
+        "role": principal.role,
+        "iat": now,
+        "exp": now + (ttl or Config.AUTH_TOKEN_TTL),
+    }
+    if principal.created_at is not None:
+        payload["created_at"] = principal.created_at.isoformat()
+    return jwt.encode(payload, Config.JWT_SECRET_KEY, algorithm="HS256")
+
+
+def verify_token(token: str) -> Optional[UserPrincipal]:
+    """Giải mã token → principal, không truy vấn DB."""
+    try:
+        payload = jwt.decode(token, Config.JWT_SECRET_KEY, algorithms=["HS256"])
+        created_at = payload.get("created_at")
+        return UserPrincipal(int(payload["sub"]), payload["username"], payload.get("role", "user"),
+                             datetime.fromisoformat(created_at) if created_at else None)
+    except (jwt.PyJWTError, KeyError, ValueError, TypeError):
+        return None
+
+
+def current_principal() -> Optional[UserPrincipal]:
+    """
+    Principal của request hiện tại: Bearer token → Flask-Login → session["user"].
+    Kết quả được giữ trong g cho cả request.
+    """
+    if "principal" in g:
+        return g.principal
+    principal = None
+    header = request.headers.get("Authorization", "")
+    if header.startswith("Bearer "):
+        principal = verify_token(header[7:].strip())
+    elif current_user and current_user.is_authenticated:
+        principal = current_user
+    else:
+        username = session.get("user")
+        if username:
+            principal = principal_cache.get_by_username(username)
+    g.principal = principal
+    return principal
+
+
+def principal_required(fn: Callable[..., Any]) -> Callable[..., Any]:
+    """Thay cho @login_required: nhận cả Bearer token (không cần DB) lẫn session."""
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if current_principal() is None:
+            return jsonify({"error": "Unauthorized"}), 401
+        return fn(*args, **kwargs)
+    return wrapper
+
+
+def admin_required(fn: Callable[..., Any]) -> Callable[..., Any]:
+    """Chỉ admin: principal role "admin" hoặc session của tài khoản admin dashboard."""
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        principal = current_principal()
+        if principal is None and session.get("user") is None:
+            return jsonify({"error": "Unauthorized"}), 401
+        if session.get("user") != "admin" and getattr(principal, "role", None) != "admin":
+            return jsonify({"error": "Forbidden"}), 403
+        return fn(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,82 @@
+# backend/security/passwords.py
+"""
+Hash / verify mật khẩu trong process pool có giới hạn.
+
+generate_password_hash tốn CPU; chạy inline trên server Socket.IO (eventlet)
+sẽ chặn event loop → heartbeat của mọi thiết bị bị trễ. Ở đây:
+- công việc chạy ở process riêng (ProcessPoolExecutor, PASSWORD_HASH_WORKERS)
+- request chờ kết quả bằng socketio.sleep → nhường event loop
+- tối đa PASSWORD_HASH_MAX_PENDING job cùng lúc, vượt quá → HashingBusy (503)
+
+Benchmark độ trễ heartbeat khi đăng ký dồn dập: benchmarks/password_storm.py.
+"""
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Optional
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from backend.config import Config
+from backend.extensions import socketio
+
+
+class HashingBusy(RuntimeError):
+    """Pool hash đã đủ job đang chờ, client nên thử lại sau."""
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+_admission = threading.BoundedSemaphore(Config.PASSWORD_HASH_MAX_PENDING)
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ProcessPoolExecutor(max_workers=Config.PASSWORD_HASH_WORKERS)
+    return _pool
+
+
+def _hash(password: str, method: str) -> str:
+    return generate_password_hash(password, method=method)
+
+
+def _wait(fut: Future, timeout: float):
+    """Chờ future mà không chặn event loop (socketio.sleep nhường cho greenlet khác)."""
+    sleep = socketio.sleep if socketio.server is not None else time.sleep
+    deadline = time.monotonic() + timeout
+    delay = 0.002
+    while not fut.done():
+        if time.monotonic() > deadline:
+            fut.cancel()
+            raise TimeoutError("password hashing timed out")
+        sleep(delay)
+        delay = min(delay * 2, 0.02)
+    return fut.result()
+
+
+def _run(fn, *args):
+    if not _admission.acquire(blocking=False):
+        raise HashingBusy("too many pending password operations")
+    try:
+        return _wait(_get_pool().submit(fn, *args), Config.PASSWORD_HASH_TIMEOUT)
+    finally:
+        _admission.release()
+
+
+def hash_password(password: str) -> str:
+    return _run(_hash, password, Config.PASSWORD_HASH_METHOD)
+
+
+def verify_password(pwhash: str, password: str) -> bool:
+    return _run(check_password_hash, pwhash, password)
+
+
+def shutdown() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
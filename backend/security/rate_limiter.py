@@ -0,0 +1,162 @@
+# backend/security/rate_limiter.py
+"""
+Token bucket in-memory cho route HTTP và event Socket.IO.
+
+- Mỗi (policy, key) có một bucket; key là device_uid / user / IP
+- check() O(1): refill lười theo thời gian trôi qua, không có timer
+- Bucket nhàn rỗi quá RATELIMIT_IDLE_TTL bị dọn dần (amortized), kèm bộ đếm từ chối của nó
+- Hành động khi vượt ngưỡng: "drop" | "delay" | "disconnect" (theo policy)
+- Đếm số lần bị từ chối theo (policy, key) → stats() để tìm thiết bị "ồn"
+"""
+import re
+import threading
+import time
+from collections import Counter
+from functools import wraps
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from flask import jsonify, request, session
+from flask_socketio import disconnect
+
+from backend.config import Config
+from backend.extensions import socketio
+
+_UNITS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+_LIMIT_RE = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*(?:per|/)\s*(second|minute|hour|day)s?\s*$")
+
+ACTIONS = ("drop", "delay", "disconnect")
+
+
+def parse_limit(limit: str) -> Tuple[float, float]:
+    """'20 per minute' → (rate token/s, capacity mặc định = 20)."""
+    m = _LIMIT_RE.match(limit)
+    if not m:
+        raise ValueError(f"invalid rate limit: {limit!r}")
+    count = float(m.group(1))
+    return count / _UNITS[m.group(2)], count
+
+
+class Policy:
+    __slots__ = ("name", "rate", "burst", "action", "max_delay")
+
+    def __init__(self, name: str, limit: str, burst: Optional[float] = None,
+                 action: str = "drop", max_delay: float = 1.0) -> None:
+        if action not in ACTIONS:
+            raise ValueError(f"invalid rate limit action: {action!r}")
+        self.name = name
+        self.rate, default_burst = parse_limit(limit)
+        self.burst = float(burst) if burst else default_burst
+        self.action = action
+        self.max_delay = max_delay
+
+
+class RateLimiter:
+    SWEEP_EVERY = 1024  # dọn bucket nhàn rỗi sau mỗi N lần check
+
+    def __init__(self, policies: Dict[str, Dict[str, Any]], idle_ttl: float) -> None:
+        self.policies = {name: Policy(name, **cfg) for name, cfg in policies.items()}
+        self.idle_ttl = idle_ttl
+        # key → [tokens, last_refill]
+        self._buckets: Dict[Tuple[str, str], List[float]] = {}
+        self._lock = threading.Lock()
+        self._checks = 0
+        self.rejections: Counter = Counter()
+
+    def check(self, policy_name: str, key: str, now: Optional[float] = None, cost: float = 1.0) -> float:
+        """
+        Lấy `cost` token. Trả về 0 nếu được phép, ngược lại số giây cần chờ.
+        Policy "delay": nếu thời gian chờ <= max_delay thì token được giữ chỗ
+        trước (bucket âm) → caller ngủ đúng bấy nhiêu rồi xử lý tiếp.
+        cost > burst (vd broadcast cả nhóm): chỉ cần bucket đầy là qua, phần
+        vượt thành nợ (bucket âm) → các lần sau chờ tới khi trả xong.
+        """
+        policy = self.policies[policy_name]
+        now = now if now is not None else time.monotonic()
+        bk = (policy_name, key)
+        with self._lock:
+            self._checks += 1
+            if self._checks % self.SWEEP_EVERY == 0:
+                self._sweep(now)
+            bucket = self._buckets.get(bk)
+            if bucket is None:
+                bucket = self._buckets[bk] = [policy.burst, now]
+            else:
+                bucket[0] = min(policy.burst, bucket[0] + (now - bucket[1]) * policy.rate)
+                bucket[1] = now
+            need = min(cost, policy.burst)
+            if bucket[0] >= need:
+                bucket[0] -= cost
+                return 0.0
+            wait = (need - bucket[0]) / policy.rate
+            if policy.action == "delay" and wait <= policy.max_delay:
+                bucket[0] -= cost
+            else:
+                self.rejections[bk] += 1
+            return wait
+
+    def admits_after_delay(self, policy_name: str, wait: float) -> bool:
+        policy = self.policies[policy_name]
+        return policy.action == "delay" and wait <= policy.max_delay
+
+    def _sweep(self, now: float) -> None:
+        horizon = now - self.idle_ttl
+        stale = [k for k, b in self._buckets.items() if b[1] < horizon]
+        for k in stale:
+            del self._buckets[k]
+            self.rejections.pop(k, None)  # key đã nhàn rỗi → bỏ luôn bộ đếm, không phình theo số key từng gặp
+
+    def stats(self, top: int = 20) -> Dict[str, Any]:
+        with self._lock:
+            noisy = self.rejections.most_common(top)
+            return {
+                "buckets": len(self._buckets),
+                "rejections_total": sum(self.rejections.values()),
+                "top": [{"policy": p, "key": k, "rejected": n} for (p, k), n in noisy],
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._buckets.clear()
+            self.rejections.clear()
+
+
+limiter = RateLimiter(Config.RATELIMIT_POLICIES, Config.RATELIMIT_IDLE_TTL)
+
+
+def _http_key() -> str:
+    user = session.get("user")
+    return f"user:{user}" if user else f"ip:{request.remote_addr}"
+
+
+def rate_limit(policy_name: str = "http_default", key_func: Callable[[], str] = _http_key):
+    """Decorator cho route HTTP. "disconnect" với HTTP được xử lý như "drop" (429)."""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            wait = limiter.check(policy_name, key_func())
+            if wait and limiter.admits_after_delay(policy_name, wait):
+                socketio.sleep(wait)
+            elif wait:
+                return jsonify({"error": "Too many requests"}), 429, {"Retry-After": str(max(1, round(wait)))}
+            return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def limit_event(policy_name: str, key_func: Callable[[], str]):
+    """Decorator cho handler Socket.IO: drop / delay / disconnect khi vượt ngưỡng."""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            wait = limiter.check(policy_name, key_func())
+            if wait:
+                if limiter.admits_after_delay(policy_name, wait):
+                    socketio.sleep(wait)
+                elif limiter.policies[policy_name].action == "disconnect":
+                    disconnect()
+                    return None
+                else:
+                    return None
+            return fn(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,86 @@
+# backend/serializer.py
+"""
+Lớp JSON dùng chung cho response Flask và gói tin Socket.IO.
+
+- Encoder nhanh (orjson) nếu có cài, fallback về json stdlib
+  (JSON_ENCODER=auto|orjson|stdlib)
+- datetime / date / set / object có __json__ đều encode được → emit
+  thẳng datetime không còn lỗi "not JSON serializable"
+- Module này có dumps/loads nên dùng trực tiếp làm `json=` cho SocketIO
+- JSONProvider cho Flask: app.json = JSONProvider(app)
+
+Benchmark serialize snapshot 10k thiết bị: benchmarks/serializer.py.
+"""
+import json as _stdlib_json
+from datetime import date, datetime
+from typing import Any
+
+from flask.json.provider import DefaultJSONProvider
+
+from backend.config import Config
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+
+def _default(o: Any) -> Any:
+    if isinstance(o, (datetime, date)):
+        return o.isoformat()
+    if isinstance(o, (set, frozenset)):
+        return list(o)
+    if hasattr(o, "__json__"):
+        return o.__json__()
+    raise TypeError(f"Object of type {o.__class__.__name__} is not JSON serializable")
+
+
+def _select_backend(name: str) -> str:
+    if name == "orjson" and orjson is None:
+        raise RuntimeError("JSON_ENCODER=orjson but orjson is not installed")
+    if name == "auto":
+        return "orjson" if orjson is not None else "stdlib"
+    return name
+
+
+BACKEND = _select_backend(Config.JSON_ENCODER)
+
+if BACKEND == "orjson":
+    _OPTS = orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj: Any, **kwargs) -> str:
+        # kwargs (separators, indent, ...) của API stdlib bị bỏ qua: orjson luôn compact
+        return orjson.dumps(obj, default=_default, option=_OPTS).decode()
+
+    def dumps_bytes(obj: Any) -> bytes:
+        return orjson.dumps(obj, default=_default, option=_OPTS)
+
+    def loads(s: Any, **kwargs) -> Any:
+        return orjson.loads(s)
+else:
+    def dumps(obj: Any, **kwargs) -> str:
+        kwargs.setdefault("separators", (",", ":"))
+        kwargs.setdefault("ensure_ascii", False)
+        return _stdlib_json.dumps(obj, default=_default, **kwargs)
+
+    def dumps_bytes(obj: Any) -> bytes:
+        return dumps(obj).encode()
+
+    def loads(s: Any, **kwargs) -> Any:
+        return _stdlib_json.loads(s, **kwargs)
+
+
+class JSONProvider(DefaultJSONProvider):
+    """JSON provider của Flask dùng dumps/loads ở trên (jsonify, request.get_json)."""
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        if self.sort_keys and BACKEND == "stdlib":
+            kwargs.setdefault("sort_keys", True)
+        return dumps(obj, **kwargs)
+
+    def loads(self, s: Any, **kwargs: Any) -> Any:
+        return loads(s, **kwargs)
+
+    def response(self, *args: Any, **kwargs: Any):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps_bytes(obj), mimetype=self.mimetype)
@@ -0,0 +1,440 @@
+# backend/services/analytics.py
+"""
+Báo cáo sức khoẻ cả fleet, tính dạng cột bằng NumPy (không duyệt từng row ORM).
+
+Nguồn dữ liệu (nạp thành mảng cột):
+- heartbeat: HeartbeatLog (segment .seg + buffer hiện tại), đọc từng segment
+  qua HeartbeatAccumulator → nhiều ngày dữ liệu không phải nằm hết trong RAM
+- ack: command_queue (device_id, sent_at, ack_time) → độ trễ ack
+- trạng thái: device_transitions (from/to) → uptime, flapping
+
+Chỉ số mỗi thiết bị, tính cho cả fleet cùng lúc (bincount / sort theo group):
+uptime %, số lần flap (up ↔ offline) và cờ flapping, heartbeat interval
+mean / jitter (std) / p95 / gap lớn nhất, ack latency p50 / p95 / max.
+
+Kết quả cache theo (window, mốc cuối làm tròn ANALYTICS_CACHE_BUCKET giây).
+Tính báo cáo trên thread riêng (run_report, ANALYTICS_WORKERS), không chiếm
+db_executor dùng chung: window 7d có thể chạy lâu hơn DB_EXECUTOR_TIMEOUT.
+
+Benchmark 10k thiết bị: benchmarks/analytics.py.
+"""
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import case, func, select
+
+from backend.config import Config
+from backend.database import read_engine, session_for
+from backend.extensions import socketio
+from backend.models import CommandQueue, DeviceTransition
+from backend.services.heartbeat_log import HeartbeatLog, heartbeat_log
+
+SORT_KEYS = {
+    # key → (cột, giảm dần?) — "tệ nhất" lên đầu
+    "uptime": ("uptime", False),
+    "flaps": ("flaps", True),
+    "jitter": ("hb_jitter_ms", True),
+    "gap": ("hb_max_gap_s", True),
+    "ack_p95": ("ack_p95_ms", True),
+}
+
+
+# ========= LOADERS (mảng cột) =========
+def _epoch(col):
+    """Cột DateTime (UTC naive) → epoch seconds, tính trong SQL."""
+    if read_engine.dialect.name == "sqlite":
+        return (func.julianday(col) - 2440587.5) * 86400.0
+    return func.extract("epoch", col)
+
+
+def _fetch_matrix(stmt, width: int) -> np.ndarray:
+    with session_for("read") as db:
+        rows = db.execute(stmt).all()
+    flat = np.fromiter(itertools.chain.from_iterable(rows), dtype=np.float64, count=len(rows) * width)
+    return flat.reshape(len(rows), width)
+
+
+def load_acks(t0: float, t1: float) -> Tuple[np.ndarray, np.ndarray]:
+    """(device_id, latency giây) của command được ack trong [t0, t1]."""
+    ack = _epoch(CommandQueue.ack_time)
+    m = _fetch_matrix(
+        select(CommandQueue.device_id, _epoch(CommandQueue.sent_at), ack)
+        .where(CommandQueue.status == "ack", CommandQueue.sent_at.isnot(None),
+               ack >= t0, ack <= t1),
+        3,
+    )
+    return m[:, 0].astype(np.int64), m[:, 2] - m[:, 1]
+
+
+def load_transitions(t0: float) -> Tuple[np.ndarray, ...]:
+    """(device_id, ts, up trước, up sau) của mọi transition từ t0 tới giờ."""
+    ts = _epoch(DeviceTransition.created_at)
+    m = _fetch_matrix(
+        select(
+            DeviceTransition.device_id,
+            ts,
+            case((DeviceTransition.from_status == "offline", 0), else_=1),
+            case((DeviceTransition.to_status == "offline", 0), else_=1),
+        ).where(ts >= t0),
+        4,
+    )
+    return m[:, 0].astype(np.int64), m[:, 1], m[:, 2], m[:, 3]
+
+
+def iter_heartbeats(log: HeartbeatLog, t0: float, t1: float) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    (device_id, ts) heartbeat trong [t0, t1] theo từng segment (memmap) rồi tới
+    buffer chưa spill, theo thứ tự thời gian → bộ nhớ chỉ tốn cỡ một segment.
+    """
+    for path, n in log.segments(t0, t1):
+        dev = np.memmap(path, dtype=np.int32, mode="r", shape=(n,))
+        ts = np.memmap(path, dtype=np.float64, mode="r", offset=4 * n, shape=(n,))
+        keep = (ts >= t0) & (ts <= t1)
+        yield np.asarray(dev[keep], dtype=np.int64), np.asarray(ts[keep])
+    dev_b, ts_b = log.snapshot()
+    dev = np.frombuffer(dev_b, dtype=np.int32)
+    ts = np.frombuffer(ts_b, dtype=np.float64)
+    keep = (ts >= t0) & (ts <= t1)
+    yield dev[keep].astype(np.int64), ts[keep]
+
+
+# ========= VECTORIZED METRICS =========
+def _dense(ids: np.ndarray, dev: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """device_id → index 0..N-1 theo `ids` (đã sort); trả về (index, mask thiết bị còn tồn tại)."""
+    if len(ids) == 0:
+        return np.zeros(len(dev), np.int64), np.zeros(len(dev), bool)
+    # id là autoincrement → bảng tra trực tiếp (gather) thay vì searchsorted
+    lut = np.full(int(ids[-1]) + 2, -1, np.int64)
+    lut[ids] = np.arange(len(ids))
+    idx = lut[np.clip(dev, 0, len(lut) - 1)]
+    ok = idx >= 0
+    return np.where(ok, idx, 0), ok
+
+
+def _group_order(g: np.ndarray, n: int) -> np.ndarray:
+    """argsort ổn định theo group; n <= 65536 → key uint16 (numpy dùng radix sort)."""
+    if n <= 1 << 16:
+        return np.argsort(g.astype(np.uint16), kind="stable")
+    return np.argsort(g, kind="stable")
+
+
+def _group_quantiles(g: np.ndarray, v: np.ndarray, n: int, qs) -> Tuple[np.ndarray, List[np.ndarray]]:
+    """Quantile của v theo từng group g (0..n-1): sort một lần theo (g, v)."""
+    order = np.lexsort((v, g))
+    vs = v[order]
+    counts = np.bincount(g, minlength=n)
+    starts = np.cumsum(counts) - counts
+    has = counts > 0
+    out = []
+    for q in qs:
+        res = np.full(n, np.nan)
+        pos = starts + np.floor(q * np.maximum(counts - 1, 0)).astype(np.int64)
+        res[has] = vs[pos[has]]
+        out.append(res)
+    return counts, out
+
+
+def uptime_and_flaps(g, ts, up_before, up_after, n: int, t0: float, t1: float,
+                     current_up: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Uptime (0..1) và số lần flap trong [t0, t1]. Trạng thái trước transition
+    đầu tiên = from_status của nó; thiết bị không có transition → giữ trạng thái hiện tại.
+    """
+    span = t1 - t0
+    uptime = current_up.astype(np.float64).copy()
+    flaps = np.zeros(n, np.int64)
+    if len(g) == 0:
+        return uptime, flaps
+    order = np.lexsort((ts, g))
+    g, ts, ub, ua = g[order], ts[order], up_before[order], up_after[order]
+    c = np.clip(ts, t0, t1)
+    boundary = g[1:] != g[:-1]
+    first = np.r_[True, boundary]
+    last = np.r_[boundary, True]
+    nxt = np.r_[c[1:], t1]
+    nxt[last] = t1
+    up_time = np.bincount(g, weights=(nxt - c) * ua, minlength=n)
+    up_time += np.bincount(g[first], weights=(c[first] - t0) * ub[first], minlength=n)
+    has = np.bincount(g, minlength=n) > 0
+    uptime[has] = up_time[has] / span
+    flapped = (ts >= t0) & (ts <= t1) & (ua != ub)
+    flaps = np.bincount(g[flapped], minlength=n)
+    return uptime, flaps
+
+
+class HeartbeatAccumulator:
+    """
+    Thống kê interval heartbeat theo thiết bị, cộng dồn từng chunk (theo thứ tự thời gian):
+    count / sum / sum² / gap lớn nhất cộng được qua chunk; p95 lấy từ histogram
+    log-scale mỗi thiết bị (HIST_BINS bin, sai số ~ một bin).
+    """
+
+    HIST_BINS = 96
+    HIST_MIN = 0.01  # s
+
+    def __init__(self, n: int, gap_cutoff: float) -> None:
+        self.n = n
+        self.gap_cutoff = gap_cutoff
+        self.edges = np.geomspace(self.HIST_MIN, gap_cutoff, self.HIST_BINS - 1)
+        self.last = np.full(n, np.nan)
+        self.count = np.zeros(n, np.int64)
+        self.k = np.zeros(n, np.int64)
+        self.s1 = np.zeros(n)
+        self.s2 = np.zeros(n)
+        self.max_gap = np.zeros(n)
+        self.hist = np.zeros(n * self.HIST_BINS, np.int64)
+
+    def add(self, g: np.ndarray, ts: np.ndarray) -> None:
+        if len(g) == 0:
+            return
+        # Chunk đã theo thời gian → chỉ cần sort ổn định theo thiết bị
+        order = _group_order(g, self.n)
+        g, ts = g[order], ts[order]
+        self.count += np.bincount(g, minlength=self.n)
+        boundary = g[1:] != g[:-1]
+        first = np.r_[True, boundary]
+        last = np.r_[boundary, True]
+
+        same = ~boundary
+        gi = g[1:][same]
+        iv = np.diff(ts)[same]
+        # Interval nối với heartbeat cuối của chunk trước
+        gf = g[first]
+        prev = self.last[gf]
+        linked = ~np.isnan(prev)
+        gi = np.concatenate([gi, gf[linked]])
+        iv = np.concatenate([iv, ts[first][linked] - prev[linked]])
+        self.last[g[last]] = ts[last]
+
+        valid = iv >= 0  # spill song song có thể lệch vài ms ở ranh giới segment
+        gi, iv = gi[valid], iv[valid]
+        np.maximum.at(self.max_gap, gi, iv)
+        ok = iv <= self.gap_cutoff  # gap lớn = mất kết nối: vào max_gap, không vào jitter
+        gi, iv = gi[ok], iv[ok]
+        self.k += np.bincount(gi, minlength=self.n)
+        self.s1 += np.bincount(gi, weights=iv, minlength=self.n)
+        self.s2 += np.bincount(gi, weights=iv * iv, minlength=self.n)
+        bins = np.searchsorted(self.edges, iv)
+        self.hist += np.bincount(gi * self.HIST_BINS + bins, minlength=self.n * self.HIST_BINS)
+
+    def quantile(self, q: float) -> np.ndarray:
+        hist = self.hist.reshape(self.n, self.HIST_BINS)
+        cum = np.cumsum(hist, axis=1)
+        target = np.ceil(q * self.k)[:, None]
+        b = np.minimum((cum < target).sum(axis=1), self.HIST_BINS - 1)
+        upper = np.r_[self.edges, self.gap_cutoff][b]
+        return np.where(self.k > 0, upper, np.nan)
+
+    def result(self) -> Dict[str, np.ndarray]:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = self.s1 / self.k
+            std = np.sqrt(np.maximum(self.s2 / self.k - mean * mean, 0.0))
+        return {
+            "hb_count": self.count,
+            "hb_mean_s": mean,
+            "hb_jitter_ms": std * 1000,
+            "hb_p95_s": self.quantile(0.95),
+            "hb_max_gap_s": self.max_gap,
+        }
+
+
+def ack_stats(g, latency, n: int) -> Dict[str, np.ndarray]:
+    count, (p50, p95) = _group_quantiles(g, latency, n, (0.5, 0.95))
+    max_l = np.full(n, np.nan)
+    if len(g):
+        order = _group_order(g, n)
+        gs, ls = g[order], latency[order]
+        starts = np.flatnonzero(np.r_[True, gs[1:] != gs[:-1]])
+        max_l[gs[starts]] = np.maximum.reduceat(ls, starts)
+    return {"ack_count": count, "ack_p50_ms": p50 * 1000, "ack_p95_ms": p95 * 1000, "ack_max_ms": max_l * 1000}
+
+
+# ========= REPORT =========
+class FleetReport:
+    def __init__(self, window: float, t0: float, t1: float, device_ids: np.ndarray, uids: List[str],
+                 columns: Dict[str, np.ndarray], fleet: Dict[str, Any], compute_ms: float) -> None:
+        self.window = window
+        self.t0 = t0
+        self.t1 = t1
+        self.device_ids = device_ids
+        self.uids = uids
+        self.columns = columns
+        self.fleet = fleet
+        self.compute_ms = compute_ms
+
+    def rows(self, sort: str = "uptime", limit: int = 100) -> List[Dict[str, Any]]:
+        col, desc = SORT_KEYS[sort]
+        values = self.columns[col]
+        key = np.where(np.isnan(values), -np.inf if desc else np.inf, values)
+        order = np.argsort(-key if desc else key, kind="stable")[:limit]
+        names = list(self.columns)
+        out = []
+        for i in order:
+            row = {"device_id": int(self.device_ids[i]), "device_uid": self.uids[i]}
+            for name in names:
+                v = self.columns[name][i]
+                if isinstance(v, np.bool_):
+                    row[name] = bool(v)
+                elif np.issubdtype(type(v), np.integer):
+                    row[name] = int(v)
+                else:
+                    row[name] = None if np.isnan(v) else round(float(v), 4)
+            out.append(row)
+        return out
+
+    def to_dict(self, sort: str = "uptime", limit: int = 100) -> Dict[str, Any]:
+        return {
+            "window_seconds": self.window,
+            "from": self.t0,
+            "to": self.t1,
+            "compute_ms": round(self.compute_ms, 1),
+            "fleet": self.fleet,
+            "sort": sort,
+            "devices": self.rows(sort, limit),
+        }
+
+
+class FleetAnalytics:
+    def __init__(self, log: HeartbeatLog, bucket: float, flap_per_hour: float, uptime_slo: float,
+                 gap_cutoff: float, cache_size: int = 8) -> None:
+        self.log = log
+        self.bucket = bucket
+        self.flap_per_hour = flap_per_hour
+        self.uptime_slo = uptime_slo
+        self.gap_cutoff = gap_cutoff
+        self.cache_size = cache_size
+        self._cache: Dict[Tuple[float, float], FleetReport] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.builds = 0
+
+    def window_bounds(self, window: float, now: Optional[float] = None) -> Tuple[float, float]:
+        now = time.time() if now is None else now
+        t1 = (now // self.bucket + 1) * self.bucket  # làm tròn lên → mọi request trong bucket dùng chung
+        return t1 - window, t1
+
+    def report(self, window: float, devices: List[Tuple[int, str, str]]) -> FleetReport:
+        """devices: (device_id, device_uid, status hiện tại) của cả fleet."""
+        t0, t1 = self.window_bounds(window)
+        key = (window, t1)
+        hit = self._cache.get(key)
+        if hit is not None:
+            self.hits += 1
+            return hit
+        with self._lock:  # single-flight: N admin cùng bấm → tính một lần
+            hit = self._cache.get(key)
+            if hit is not None:
+                self.hits += 1
+                return hit
+            started = time.perf_counter()
+            report = self.build(window, t0, t1, devices,
+                                iter_heartbeats(self.log, t0 - self.gap_cutoff, t1),
+                                load_acks(t0, t1), load_transitions(t0))
+            report.compute_ms = (time.perf_counter() - started) * 1000
+            self._cache[key] = report
+            while len(self._cache) > self.cache_size:
+                self._cache.pop(next(iter(self._cache)))
+            self.builds += 1
+            return report
+
+    def build(self, window: float, t0: float, t1: float, devices: List[Tuple[int, str, str]],
+              heartbeats: Iterable[Tuple[np.ndarray, np.ndarray]], acks, transitions) -> FleetReport:
+        devices = sorted(devices)
+        ids = np.fromiter((d[0] for d in devices), dtype=np.int64, count=len(devices))
+        current_up = np.fromiter((d[2] != "offline" for d in devices), dtype=bool, count=len(devices))
+        n = len(ids)
+
+        g, ok = _dense(ids, transitions[0])
+        uptime, flaps = uptime_and_flaps(g[ok], transitions[1][ok], transitions[2][ok], transitions[3][ok],
+                                         n, t0, t1, current_up)
+        hours = max((t1 - t0) / 3600, 1e-9)
+        columns: Dict[str, np.ndarray] = {
+            "uptime": uptime,
+            "flaps": flaps,
+            "flapping": flaps / hours >= self.flap_per_hour,
+        }
+
+        hb = HeartbeatAccumulator(n, self.gap_cutoff)
+        for dev, ts in heartbeats:
+            g, ok = _dense(ids, dev)
+            hb.add(g[ok], ts[ok])
+        columns.update(hb.result())
+
+        g, ok = _dense(ids, acks[0])
+        latency = acks[1][ok]
+        columns.update(ack_stats(g[ok], latency, n))
+
+        def pct(a: np.ndarray, q: float) -> Optional[float]:
+            a = a[~np.isnan(a)]
+            return round(float(np.percentile(a, q)), 3) if len(a) else None
+
+        fleet = {
+            "devices": n,
+            "availability": round(float(uptime.mean()), 5) if n else None,
+            "below_slo": int((uptime < self.uptime_slo).sum()),
+            "uptime_slo": self.uptime_slo,
+            "flapping": int(columns["flapping"].sum()),
+            "heartbeats": int(columns["hb_count"].sum()),
+            "hb_jitter_ms_p50": pct(columns["hb_jitter_ms"], 50),
+            "hb_jitter_ms_p95": pct(columns["hb_jitter_ms"], 95),
+            "acks": int(len(latency)),
+            "ack_ms_p50": pct(latency * 1000, 50),
+            "ack_ms_p95": pct(latency * 1000, 95),
+            "ack_ms_p99": pct(latency * 1000, 99),
+        }
+        return FleetReport(window, t0, t1, ids, [d[1] for d in devices], columns, fleet, 0.0)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"builds": self.builds, "hits": self.hits, "cached_windows": len(self._cache),
+                "heartbeat_log": self.log.stats()}
+
+
+fleet_analytics = FleetAnalytics(
+    heartbeat_log,
+    bucket=Config.ANALYTICS_CACHE_BUCKET,
+    flap_per_hour=Config.ANALYTICS_FLAP_PER_HOUR,
+    uptime_slo=Config.ANALYTICS_UPTIME_SLO,
+    gap_cutoff=Config.WATCHDOG_TIMEOUT,
+)
+
+_pool: Optional[ThreadPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def run_report(window: float, devices: List[Tuple[int, str, str]]) -> FleetReport:
+    """
+    fleet_analytics.report trên thread pool riêng; chờ bằng socketio.sleep
+    để không chặn event loop. Quá ANALYTICS_TIMEOUT → TimeoutError.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(max_workers=Config.ANALYTICS_WORKERS, thread_name_prefix="analytics")
+    fut = _pool.submit(fleet_analytics.report, window, devices)
+    sleep = socketio.sleep if socketio.server is not None else time.sleep
+    deadline = time.monotonic() + Config.ANALYTICS_TIMEOUT
+    delay = 0.005
+    while not fut.done():
+        if time.monotonic() > deadline:
+            fut.cancel()  # đang chạy thì vẫn chạy tiếp và vào cache cho lần sau
+            raise TimeoutError("analytics report timed out")
+        sleep(delay)
+        delay = min(delay * 2, 0.1)
+    return fut.result()
+
+
+def parse_window(value: Optional[str], default: float = 86400) -> float:
+    """"90m" / "24h" / "7d" / số giây → giây (giới hạn ANALYTICS_MAX_WINDOW)."""
+    value = (value or "").strip().lower()
+    if not value:
+        return default
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    seconds = float(value[:-1]) * units[value[-1]] if value[-1] in units else float(value)
+    if not 0 < seconds <= Config.ANALYTICS_MAX_WINDOW:
+        raise ValueError(f"window must be in (0, {Config.ANALYTICS_MAX_WINDOW}] seconds")
+    return seconds
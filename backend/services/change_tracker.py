@@ -0,0 +1,65 @@
+# backend/services/change_tracker.py
+"""
+Bộ đếm thay đổi cho dữ liệu dashboard → version rẻ cho ETag (không hash body).
+
+- state thiết bị in-memory gọi changes.bump() mỗi khi đổi; heartbeat (chỉ
+  last_seen) bump tối đa một lần / STATE_LAST_SEEN_RESOLUTION giây, nếu không
+  fleet gửi heartbeat liên tục thì version luôn đổi và không bao giờ có 304
+- ghi DB vào các bảng trong WATCHED_TABLES (users, command_queue) tự bump
+  qua event after_cursor_execute của engine (cả ORM flush lẫn bulk UPDATE)
+- db_written_at: lần ghi DB gần nhất → đọc replica hay writer (read-your-writes)
+- bảng devices KHÔNG theo dõi: snapshot định kỳ chỉ ghi lại state đã bump rồi
+"""
+import os
+import threading
+import time
+from typing import Tuple
+
+from sqlalchemy import event
+
+from backend.database import engine
+
+WATCHED_TABLES = frozenset({"users", "command_queue"})
+
+
+class ChangeTracker:
+    def __init__(self) -> None:
+        # boot id: version của process khác / lần chạy trước không bao giờ trùng
+        self.boot = f"{os.getpid():x}{int(time.time()):x}"
+        self._version = 0
+        self._modified = time.time()
+        self.db_written_at = 0.0
+        self._lock = threading.Lock()
+
+    def bump(self, min_interval: float = 0.0) -> None:
+        """min_interval > 0: bỏ qua nếu lần đổi gần nhất chưa quá min_interval giây."""
+        with self._lock:
+            now = time.time()
+            if min_interval and now - self._modified < min_interval:
+                return
+            self._version += 1
+            self._modified = now
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def current(self) -> Tuple[str, float]:
+        """(version string, thời điểm đổi gần nhất - epoch seconds)."""
+        with self._lock:
+            return f"{self.boot}-{self._version}", self._modified
+
+
+changes = ChangeTracker()
+
+
+@event.listens_for(engine, "after_cursor_execute")
+def _track_writes(conn, cursor, statement, parameters, context, executemany) -> None:
+    if context is None or not (context.isinsert or context.isupdate or context.isdelete):
+        return
+    if cursor.rowcount == 0:
+        return  # UPDATE/DELETE không trúng dòng nào (vd ack trùng)
+    table = getattr(getattr(context.compiled, "statement", None), "table", None)
+    if table is not None and getattr(table, "name", None) in WATCHED_TABLES:
+        changes.db_written_at = time.time()
+        changes.bump()
@@ -0,0 +1,361 @@
+# backend/services/command_scheduler.py
+"""
+Lập lịch phát command xuống thiết bị: ưu tiên theo class + chia đều giữa user.
+
+- Priority class (COMMAND_PRIORITY_CLASSES, thứ tự = độ ưu tiên tuyệt đối):
+  safety (stop, ...) > instructor (role admin/instructor) > student
+- Trong một class: weighted fair queuing theo user_id (start-time fair
+  queuing, weight theo role) → script spam của một sinh viên chỉ lấy đúng
+  phần của nó, không chặn command của người khác
+- Dispatcher phát tối đa COMMAND_DISPATCH_RATE command/s (thời gian radio);
+  class safety luôn được chọn trước, bỏ qua quota và giới hạn in-flight
+- Quota theo user: policy rate limit "command_user" + tối đa
+  COMMAND_USER_MAX_QUEUED command đang chờ; in-flight (sent, chưa ack)
+  tối đa COMMAND_USER_MAX_INFLIGHT → vượt thì chờ trong queue
+- Role (class + weight) luôn tra từ principal trong DB theo user_id, không
+  nhận từ request
+- Histogram thời gian chờ trong queue theo user (và theo class) → stats()
+
+Mô phỏng 1 user spam vs vài user thường + STOP chen ngang (FIFO vs
+fair-share): benchmarks/command_scheduler.py.
+"""
+import bisect
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional
+
+from backend.config import Config
+from backend.extensions import socketio
+from backend.security.identity import principal_cache
+from backend.security.rate_limiter import limiter
+
+# Bucket histogram (ms), kiểu Prometheus: đếm cộng dồn theo "le"
+WAIT_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+
+class CommandRejected(RuntimeError):
+    """Vượt quota của user (rate / số command đang chờ)."""
+
+    def __init__(self, reason: str, retry_after: float = 1.0) -> None:
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class WaitHistogram:
+    __slots__ = ("counts", "count", "total_ms", "max_ms")
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(WAIT_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms: float) -> None:
+        self.counts[bisect.bisect_left(WAIT_BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Cận trên của bucket chứa quantile q (ms)."""
+        if not self.count:
+            return None
+        rank, seen = q * self.count, 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return float(WAIT_BUCKETS_MS[i]) if i < len(WAIT_BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+    def to_dict(self) -> Dict[str, Any]:
+        le, acc = {}, 0
+        for bound, c in zip(list(WAIT_BUCKETS_MS) + ["+Inf"], self.counts):
+            acc += c
+            le[str(bound)] = acc
+        return {
+            "count": self.count,
+            "sum_ms": round(self.total_ms, 3),
+            "max_ms": round(self.max_ms, 3),
+            "p50_ms": self.quantile(0.5),
+            "p99_ms": self.quantile(0.99),
+            "le": le,
+        }
+
+
+class _Item:
+    __slots__ = ("command_id", "device_id", "user_id", "command", "klass", "enqueued", "start", "finish")
+
+    def __init__(self, command_id: int, device_id: int, user_id: int, command: str, klass: str) -> None:
+        self.command_id = command_id
+        self.device_id = device_id
+        self.user_id = user_id
+        self.command = command
+        self.klass = klass
+        self.enqueued = time.monotonic()
+        self.start = 0.0
+        self.finish = 0.0
+
+
+class _ClassQueue:
+    """Một priority class: FIFO theo user + virtual time (SFQ)."""
+
+    __slots__ = ("users", "last_finish", "vtime")
+
+    def __init__(self) -> None:
+        self.users: Dict[int, Deque[_Item]] = {}
+        self.last_finish: Dict[int, float] = {}
+        self.vtime = 0.0
+
+    def __len__(self) -> int:
+        return sum(len(q) for q in self.users.values())
+
+
+class CommandScheduler:
+    def __init__(self, classes: List[str], safety_commands: List[str], instructor_roles: List[str],
+                 role_weights: Dict[str, float], rate: float, max_queued: int, max_inflight: int,
+                 inflight_timeout: float) -> None:
+        self.classes = list(classes)
+        self.safety_commands = {c.lower() for c in safety_commands}
+        self.instructor_roles = set(instructor_roles)
+        self.role_weights = dict(role_weights)
+        self.rate = rate
+        self.max_queued = max_queued
+        self.max_inflight = max_inflight
+        self.inflight_timeout = inflight_timeout
+
+        self._queues = {k: _ClassQueue() for k in self.classes}
+        self._weights: Dict[int, float] = {}
+        self._queued_ids: Dict[int, _Item] = {}
+        self._queued_by_user: Dict[int, int] = {}
+        self._inflight: Dict[int, Dict[int, float]] = {}  # user → {command_id: sent_at}
+        self._lock = threading.Lock()
+        self._sender: Optional[Callable[[_Item], bool]] = None
+        self._wake = None
+        self._worker_started = False
+
+        self.wait_by_user: Dict[int, WaitHistogram] = {}
+        self.wait_by_class = {k: WaitHistogram() for k in self.classes}
+        self.dispatched: Dict[int, int] = {}
+        self.rejected: Dict[str, int] = {}
+
+    # ========= CLASSIFY / ADMIT =========
+    @staticmethod
+    def role_of(user_id: int) -> Optional[str]:
+        """Role của user theo dòng User trong DB (qua principal_cache)."""
+        principal = principal_cache.get_by_id(user_id) if user_id else None
+        return principal.role if principal else None
+
+    def classify(self, command: str, user_id: int) -> str:
+        if command.lower() in self.safety_commands:
+            return "safety"
+        return "instructor" if self.role_of(user_id) in self.instructor_roles else "student"
+
+    def admit(self, user_id: int, command: str, cost: int = 1) -> str:
+        """
+        Kiểm quota trước khi ghi DB. Trả về class; vượt quota → CommandRejected.
+        cost = số command thật sự phát (broadcast tới N thiết bị → N).
+        """
+        klass = self.classify(command, user_id)
+        self._weights[user_id] = float(self.role_weights.get(self.role_of(user_id) or "", 1.0))
+        if klass == "safety":
+            return klass  # STOP không bao giờ bị chặn
+        wait = limiter.check("command_user", f"user:{user_id}", cost=cost)
+        if wait:
+            self._reject("rate")
+            raise CommandRejected("rate", wait)
+        if self._queued_by_user.get(user_id, 0) + min(cost, self.max_queued) > self.max_queued:
+            self._reject("queue_full")
+            raise CommandRejected("queue_full", self.max_queued / self.rate)
+        return klass
+
+    def _reject(self, reason: str) -> None:
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+
+    # ========= QUEUE =========
+    def bind(self, sender: Callable[[_Item], bool]) -> None:
+        """sender(item) phát command; trả về False nếu thiết bị đã offline (giữ pending cho replay)."""
+        self._sender = sender
+
+    def submit(self, command_id: int, device_id: int, user_id: int, command: str, klass: str) -> bool:
+        with self._lock:
+            if command_id in self._queued_ids:
+                return False  # dedupe trả lại id đã có trong queue
+            item = _Item(command_id, device_id, user_id, command, klass)
+            q = self._queues[klass]
+            item.start = max(q.vtime, q.last_finish.get(user_id, 0.0))
+            item.finish = item.start + 1.0 / self._weights.get(user_id, 1.0)
+            q.last_finish[user_id] = item.finish
+            q.users.setdefault(user_id, deque()).append(item)
+            self._queued_ids[command_id] = item
+            self._queued_by_user[user_id] = self._queued_by_user.get(user_id, 0) + 1
+        self._ensure_worker()
+        if self._wake is not None:
+            self._wake.set()
+        return True
+
+    def discard(self, command_ids) -> int:
+        """Bỏ các command đã bị huỷ (coalescing) khỏi queue."""
+        removed = 0
+        with self._lock:
+            for cid in command_ids:
+                item = self._queued_ids.pop(cid, None)
+                if item is None:
+                    continue
+                dq = self._queues[item.klass].users.get(item.user_id)
+                if dq is not None:
+                    dq.remove(item)
+                    if not dq:
+                        del self._queues[item.klass].users[item.user_id]
+                self._queued_by_user[item.user_id] -= 1
+                removed += 1
+        return removed
+
+    def requeue(self, item: _Item) -> None:
+        """
+        Trả item vừa lấy ra về đầu hàng của user (phát lỗi tạm thời, vd DBBusy):
+        giữ nguyên enqueued / start / finish → không bị xếp lại cuối hàng, không mất lượt.
+        """
+        with self._lock:
+            if item.command_id in self._queued_ids:
+                return
+            q = self._queues[item.klass]
+            q.users.setdefault(item.user_id, deque()).appendleft(item)
+            self._queued_ids[item.command_id] = item
+            self._queued_by_user[item.user_id] = self._queued_by_user.get(item.user_id, 0) + 1
+
+    def track_sent(self, user_id: int, command_ids: Iterable[int]) -> None:
+        """Command phát ngoài dispatcher (broadcast) vẫn chiếm chỗ in-flight của user tới khi ack."""
+        now = time.monotonic()
+        with self._lock:
+            sent = self._inflight.setdefault(user_id, {})
+            for cid in command_ids:
+                sent[cid] = now
+
+    def on_ack(self, command_id: int, user_id: Optional[int] = None) -> None:
+        with self._lock:
+            users = [user_id] if user_id is not None else list(self._inflight)
+            for uid in users:
+                if self._inflight.get(uid, {}).pop(command_id, None) is not None:
+                    break
+            else:
+                return
+        if self._wake is not None:
+            self._wake.set()  # user đang bị chặn bởi in-flight có thể phát tiếp ngay
+
+    def _inflight_count(self, user_id: int, now: float) -> int:
+        sent = self._inflight.get(user_id)
+        if not sent:
+            return 0
+        # Sent quá lâu không ack (thiết bị rớt / mất ack) → không giữ chỗ mãi
+        expired = [cid for cid, at in sent.items() if now - at > self.inflight_timeout]
+        for cid in expired:
+            del sent[cid]
+        return len(sent)
+
+    def _pop_next(self) -> Optional[_Item]:
+        now = time.monotonic()
+        with self._lock:
+            for klass in self.classes:
+                q = self._queues[klass]
+                best = None
+                for uid, dq in q.users.items():
+                    if klass != "safety" and self._inflight_count(uid, now) >= self.max_inflight:
+                        continue
+                    if best is None or dq[0].finish < best.finish:
+                        best = dq[0]
+                if best is None:
+                    continue
+                dq = q.users[best.user_id]
+                dq.popleft()
+                if not dq:
+                    del q.users[best.user_id]
+                q.vtime = max(q.vtime, best.start)
+                del self._queued_ids[best.command_id]
+                self._queued_by_user[best.user_id] -= 1
+                self._inflight.setdefault(best.user_id, {})[best.command_id] = now
+                return best
+        return None
+
+    # ========= DISPATCHER =========
+    def _ensure_worker(self) -> None:
+        if self._worker_started:
+            return
+        with self._lock:
+            if self._worker_started:
+                return
+            self._worker_started = True
+        self._wake = socketio.server.eio.create_event()  # Event theo async mode (thread/eventlet/gevent)
+        socketio.start_background_task(self._run)
+
+    def _run(self) -> None:
+        interval = 1.0 / self.rate
+        next_at = time.monotonic()
+        while True:
+            # Chờ tới lượt phát kế tiếp rồi mới chọn → STOP tới trong lúc chờ vẫn được chọn trước
+            delay = next_at - time.monotonic()
+            if delay > 0:
+                socketio.sleep(delay)
+            item = self._pop_next()
+            if item is None:
+                self._wake.wait(timeout=1.0)
+                self._wake.clear()
+                next_at = max(next_at, time.monotonic())
+                continue
+            next_at = max(next_at, time.monotonic() - interval) + interval
+            self._dispatch(item)
+
+    def _dispatch(self, item: _Item) -> None:
+        waited = (time.monotonic() - item.enqueued) * 1000
+        self.wait_by_user.setdefault(item.user_id, WaitHistogram()).observe(waited)
+        self.wait_by_class[item.klass].observe(waited)
+        try:
+            sent = self._sender(item) if self._sender is not None else False
+        except Exception as e:
+            print(f"⚠️ dispatch of command {item.command_id} failed: {e}")
+            sent = False
+        if sent:
+            self.dispatched[item.user_id] = self.dispatched.get(item.user_id, 0) + 1
+        else:
+            self.on_ack(item.command_id, item.user_id)  # còn pending trong DB → replay khi online
+
+    # ========= STATS =========
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            users = set(self._queued_by_user) | set(self._inflight) | set(self.wait_by_user)
+            per_user = {
+                uid: {
+                    "queued": self._queued_by_user.get(uid, 0),
+                    "inflight": self._inflight_count(uid, now),
+                    "dispatched": self.dispatched.get(uid, 0),
+                    "weight": self._weights.get(uid, 1.0),
+                    "wait": self.wait_by_user[uid].to_dict() if uid in self.wait_by_user else None,
+                }
+                for uid in users
+            }
+            per_class = {
+                k: {"queued": len(self._queues[k]), "wait": self.wait_by_class[k].to_dict()}
+                for k in self.classes
+            }
+        return {
+            "rate": self.rate,
+            "max_queued": self.max_queued,
+            "max_inflight": self.max_inflight,
+            "rejected": dict(self.rejected),
+            "classes": per_class,
+            "users": per_user,
+        }
+
+
+command_scheduler = CommandScheduler(
+    Config.COMMAND_PRIORITY_CLASSES,
+    Config.COMMAND_SAFETY_COMMANDS,
+    Config.COMMAND_INSTRUCTOR_ROLES,
+    Config.COMMAND_ROLE_WEIGHTS,
+    rate=Config.COMMAND_DISPATCH_RATE,
+    max_queued=Config.COMMAND_USER_MAX_QUEUED,
+    max_inflight=Config.COMMAND_USER_MAX_INFLIGHT,
+    inflight_timeout=Config.COMMAND_INFLIGHT_TIMEOUT,
+)
@@ -0,0 +1,97 @@
+import os
+import socket
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional
+
+# Định danh worker hiện tại (host:pid), gắn vào mỗi DeviceConnection.
+# Registry nằm trong memory của process: chỉ biết connection của chính worker
+# này. Server chạy một worker (socketio.run, không message queue; state_store
+# và scheduler cũng in-process) → worker_of trả lời đúng. Chạy nhiều worker
+# thì cần map sid → worker ở store dùng chung, chưa hỗ trợ.
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+class DeviceConnection:
+    """Binding sid → thiết bị, tạo một lần lúc connect (đã xác thực)."""
+
+    __slots__ = ("sid", "device_id", "device_uid", "device_type", "namespace", "slot", "worker", "connected_at")
+
+    def __init__(self, sid: str, device_id: int, device_uid: str, device_type: str, namespace: str,
+                 slot: Optional[str] = None) -> None:
+        self.sid = sid
+        self.device_id = device_id
+        self.device_uid = device_uid
+        self.device_type = device_type
+        self.namespace = namespace
+        self.slot = slot
+        self.worker = WORKER_ID
+        self.connected_at = datetime.utcnow()
+
+    def __repr__(self) -> str:
+        return f"<DeviceConnection sid={self.sid} uid={self.device_uid} worker={self.worker}>"
+
+
+class ConnectionRegistry:
+    """
+    Registry các connection thiết bị đang sống, tra cứu O(1) theo sid / uid / device_id.
+    Mỗi thiết bị chỉ có một connection: connect lại sẽ thay binding cũ.
+    """
+
+    def __init__(self) -> None:
+        self._by_sid: Dict[str, DeviceConnection] = {}
+        self._by_uid: Dict[str, DeviceConnection] = {}
+        self._by_id: Dict[int, DeviceConnection] = {}
+        self._lock = threading.Lock()
+
+    def bind(self, conn: DeviceConnection) -> Optional[DeviceConnection]:
+        """Gắn connection mới; trả về connection cũ của cùng thiết bị (nếu có)."""
+        with self._lock:
+            old = self._by_uid.get(conn.device_uid)
+            if old is not None:
+                self._by_sid.pop(old.sid, None)
+            self._by_sid[conn.sid] = conn
+            self._by_uid[conn.device_uid] = conn
+            self._by_id[conn.device_id] = conn
+            return old
+
+    def unbind(self, sid: str) -> Optional[DeviceConnection]:
+        """Gỡ binding theo sid; chỉ gỡ index uid/id nếu chúng vẫn trỏ tới sid này."""
+        with self._lock:
+            conn = self._by_sid.pop(sid, None)
+            if conn is None:
+                return None
+            if self._by_uid.get(conn.device_uid) is conn:
+                del self._by_uid[conn.device_uid]
+            if self._by_id.get(conn.device_id) is conn:
+                del self._by_id[conn.device_id]
+            return conn
+
+    def by_sid(self, sid: str) -> Optional[DeviceConnection]:
+        return self._by_sid.get(sid)
+
+    def by_uid(self, device_uid: str) -> Optional[DeviceConnection]:
+        return self._by_uid.get(device_uid)
+
+    def by_device_id(self, device_id: int) -> Optional[DeviceConnection]:
+        return self._by_id.get(device_id)
+
+    def is_connected(self, device_uid: str) -> bool:
+        return device_uid in self._by_uid
+
+    def worker_of(self, device_uid: str) -> Optional[str]:
+        """
+        Worker đang giữ connection của thiết bị. Chỉ thấy connection của process
+        này (single worker): None = không nối vào worker này, không phải "offline ở mọi nơi".
+        """
+        conn = self._by_uid.get(device_uid)
+        return conn.worker if conn else None
+
+    def all(self) -> List[DeviceConnection]:
+        return list(self._by_sid.values())
+
+    def __len__(self) -> int:
+        return len(self._by_sid)
+
+
+connection_registry = ConnectionRegistry()
@@ -0,0 +1,80 @@
+# backend/services/container.py
+"""
+Service container: một DeviceManager dùng chung cho app, routes và socket
+handlers, tạo lười ở lần dùng đầu tiên (import module không tốn gì).
+
+- `dm` là LocalProxy → `from backend.services.container import dm` dùng như
+  một DeviceManager bình thường
+- warm_up(): nạp song song các cache (state thiết bị, principal, codec)
+  để request / heartbeat đầu tiên không phải trả giá
+
+Thời gian import và time-to-first-heartbeat (có/không schema check,
+có/không warm-up): benchmarks/container.py.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, Dict, Optional
+
+from werkzeug.local import LocalProxy
+
+from backend.config import Config
+
+if TYPE_CHECKING:
+    from backend.services.device_manager import DeviceManager
+
+_device_manager: Optional["DeviceManager"] = None
+_lock = threading.Lock()
+
+
+def get_device_manager() -> "DeviceManager":
+    global _device_manager
+    if _device_manager is None:
+        with _lock:
+            if _device_manager is None:
+                from backend.services.device_manager import DeviceManager
+                _device_manager = DeviceManager()
+    return _device_manager
+
+
+dm: "DeviceManager" = LocalProxy(get_device_manager)  # type: ignore[assignment]
+
+
+# ========= WARM-UP =========
+def _warm_device_states() -> None:
+    from backend.services.device_state import state_store
+    state_store.load()
+
+
+def _warm_principals() -> None:
+    from backend.security.identity import principal_cache
+    principal_cache.warm(Config.USER_CACHE_SIZE)
+
+
+def _warm_wire_codecs() -> None:
+    from backend.services.wire_codec import wire_registry
+    wire_registry.warm()
+
+
+WARMUP_TASKS: Dict[str, Callable[[], None]] = {
+    "device_states": _warm_device_states,
+    "principals": _warm_principals,
+    "wire_codecs": _warm_wire_codecs,
+}
+
+
+def warm_up() -> Dict[str, float]:
+    """Chạy các task warm-up song song; trả về thời gian (ms) từng task, -1 nếu lỗi."""
+    def timed(fn: Callable[[], None]) -> float:
+        t0 = time.perf_counter()
+        try:
+            fn()
+        except Exception as e:
+            print(f"⚠️ warm-up {fn.__name__} failed: {e}")
+            return -1.0
+        return round((time.perf_counter() - t0) * 1000, 2)
+
+    get_device_manager()
+    with ThreadPoolExecutor(max_workers=len(WARMUP_TASKS), thread_name_prefix="warmup") as pool:
+        futures = {name: pool.submit(timed, fn) for name, fn in WARMUP_TASKS.items()}
+        return {name: f.result() for name, f in futures.items()}
@@ -0,0 +1,150 @@
+# backend/services/db_executor.py
+"""
+Chạy công việc DB (SQLAlchemy đồng bộ) trên pool OS thread thật.
+
+Dưới eventlet/gevent, một câu query chậm (fsync, lock SQLite) chạy inline
+trong handler Socket.IO sẽ chặn hub → mọi thiết bị bị trễ heartbeat. Ở đây:
+- eventlet → eventlet.tpool (OS thread, greenlet gọi chờ cooperative)
+- gevent   → threadpool của hub
+- threading → ThreadPoolExecutor (handler vốn đã là thread riêng)
+- tối đa DB_EXECUTOR_WORKERS job chạy song song, hàng đợi tối đa
+  DB_EXECUTOR_MAX_QUEUE, vượt quá → DBBusy
+- stats(): in-flight / queued / peak + thời gian chờ & chạy (p50/p99)
+
+Hàm đưa vào run() chỉ nên làm việc DB thuần, KHÔNG emit Socket.IO
+(emit từ OS thread không an toàn dưới eventlet) → emit sau khi run() trả về.
+
+Độ trễ event loop khi có query chậm: tests/test_db_executor.py (hub eventlet
+nếu đã cài, và threading).
+"""
+import contextvars
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from backend.config import Config
+from backend.extensions import socketio
+
+
+class DBBusy(RuntimeError):
+    """Hàng đợi DB executor đã đầy."""
+
+
+def _percentile(samples, q: float) -> Optional[float]:
+    if not samples:
+        return None
+    s = sorted(samples)
+    return round(s[min(len(s) - 1, int(q * len(s)))] * 1000, 3)
+
+
+class DBExecutor:
+    def __init__(self, workers: int, max_queue: int, timeout: float) -> None:
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._mode: Optional[str] = None
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._pool_sized = False
+        self._lock = threading.Lock()
+        # Metrics
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.in_flight = 0
+        self.peak_queued = 0
+        self._wait_times: deque = deque(maxlen=1024)
+        self._run_times: deque = deque(maxlen=1024)
+
+    def mode(self) -> str:
+        """Backend theo async_mode của server Socket.IO (quyết định một lần)."""
+        if self._mode is None:
+            server = socketio.server
+            self._mode = getattr(server, "async_mode", None) or "threading"
+        return self._mode
+
+    def _dispatch(self, job: Callable[[], Any]) -> Any:
+        mode = self.mode()
+        if mode == "eventlet":
+            from eventlet import tpool
+            if not self._pool_sized:
+                tpool.set_num_threads(self.workers)  # chỉ có hiệu lực trước lần execute đầu tiên
+                self._pool_sized = True
+            return tpool.execute(job)
+        if mode == "gevent":
+            import gevent
+            pool = gevent.get_hub().threadpool
+            pool.maxsize = self.workers
+            return pool.apply(job)
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="db")
+        return self._pool.submit(job).result(timeout=self.timeout)
+
+    def run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Chạy fn(*args, **kwargs) trên pool, chờ kết quả không chặn event loop."""
+        with self._lock:
+            if self.in_flight >= self.workers + self.max_queue:
+                self.rejected += 1
+                raise DBBusy("too many pending database operations")
+            self.submitted += 1
+            self.in_flight += 1
+            self.peak_queued = max(self.peak_queued, self.in_flight - self.workers)
+        queued_at = time.perf_counter()
+        timing = {}
+        ctx = contextvars.copy_context()  # contextvar của caller (vd pin writer) theo sang worker
+
+        def job():
+            started = time.perf_counter()
+            timing["wait"] = started - queued_at
+            try:
+                return ctx.run(fn, *args, **kwargs)
+            finally:
+                timing["run"] = time.perf_counter() - started
+
+        try:
+            result = self._dispatch(job)
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                if "wait" in timing:
+                    self._wait_times.append(timing["wait"])
+                if "run" in timing:
+                    self._run_times.append(timing["run"])
+        with self._lock:
+            self.completed += 1
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            waits, runs = list(self._wait_times), list(self._run_times)
+            return {
+                "mode": self.mode(),
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "in_flight": self.in_flight,
+                "queued": max(0, self.in_flight - self.workers),
+                "peak_queued": self.peak_queued,
+                "wait_ms": {"p50": _percentile(waits, 0.5), "p99": _percentile(waits, 0.99)},
+                "run_ms": {"p50": _percentile(runs, 0.5), "p99": _percentile(runs, 0.99)},
+            }
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+
+
+db_executor = DBExecutor(Config.DB_EXECUTOR_WORKERS, Config.DB_EXECUTOR_MAX_QUEUE, Config.DB_EXECUTOR_TIMEOUT)
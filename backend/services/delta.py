@@ -0,0 +1,176 @@
+# backend/services/delta.py
+"""
+Delta kiểu rsync giữa hai phiên bản firmware (chỉ dùng stdlib → copy được
+sang thiết bị cạnh async_client.py giống wire_codec.py).
+
+- Bản cũ chia block cố định BLOCK; mỗi block có checksum yếu (rolling,
+  như rsync) + checksum mạnh (md5)
+- Quét bản mới bằng rolling checksum: block trùng → COPY, còn lại → DATA
+- Server có cả hai bản (content-addressed) nên tự tính delta, thiết bị
+  không phải gửi signature; file đọc qua mmap, không nạp cả file vào heap
+
+Format: b"RDL1" + u32 block_size, rồi các op:
+  b"C" + u32 block đầu + u32 số block   (copy từ bản cũ)
+  b"D" + u32 độ dài + bytes              (dữ liệu mới)
+"""
+import hashlib
+import mmap
+import os
+import struct
+from typing import BinaryIO, Dict, List, Tuple
+
+MAGIC = b"RDL1"
+_U32 = struct.Struct(">I")
+_COPY = struct.Struct(">cII")
+_MOD = 1 << 16
+_LITERAL_FLUSH = 64 * 1024
+
+
+def _weak(data) -> Tuple[int, int]:
+    a = b = 0
+    n = len(data)
+    for i, x in enumerate(data):
+        a += x
+        b += (n - i) * x
+    return a % _MOD, b % _MOD
+
+
+def _map(path: str):
+    """mmap read-only; file rỗng → b"" (mmap không nhận độ dài 0)."""
+    f = open(path, "rb")
+    if os.fstat(f.fileno()).st_size == 0:
+        f.close()
+        return None, b""
+    return f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _signature(old, block: int) -> Dict[int, List[Tuple[int, bytes]]]:
+    index: Dict[int, List[Tuple[int, bytes]]] = {}
+    for i in range(len(old) // block):
+        chunk = old[i * block:(i + 1) * block]
+        a, b = _weak(chunk)
+        index.setdefault(a | (b << 16), []).append((i, hashlib.md5(chunk).digest()))
+    return index
+
+
+class _Writer:
+    """Ghi op ra file, gộp COPY liên tiếp và DATA nhỏ."""
+
+    def __init__(self, out: BinaryIO, block: int) -> None:
+        self.out = out
+        self.literal = bytearray()
+        self.copy_start = -1
+        self.copy_count = 0
+        out.write(MAGIC + _U32.pack(block))
+
+    def data(self, chunk) -> None:
+        self._flush_copy()
+        self.literal += chunk
+        if len(self.literal) >= _LITERAL_FLUSH:
+            self._flush_literal()
+
+    def copy(self, index: int) -> None:
+        self._flush_literal()
+        if self.copy_count and index == self.copy_start + self.copy_count:
+            self.copy_count += 1
+            return
+        self._flush_copy()
+        self.copy_start, self.copy_count = index, 1
+
+    def _flush_literal(self) -> None:
+        if self.literal:
+            self.out.write(b"D" + _U32.pack(len(self.literal)))
+            self.out.write(self.literal)
+            self.literal = bytearray()
+
+    def _flush_copy(self) -> None:
+        if self.copy_count:
+            self.out.write(_COPY.pack(b"C", self.copy_start, self.copy_count))
+            self.copy_count = 0
+
+    def close(self) -> None:
+        self._flush_literal()
+        self._flush_copy()
+
+
+def compute_delta(old_path: str, new_path: str, out_path: str, block: int = 2048) -> int:
+    """Ghi delta (old → new) ra out_path, trả về kích thước delta."""
+    fo, old = _map(old_path)
+    fn, new = _map(new_path)
+    try:
+        index = _signature(old, block)
+        tmp = out_path + ".tmp"
+        with open(tmp, "wb") as out:
+            w = _Writer(out, block)
+            n = len(new)
+            pos = 0
+            if not index:
+                pos = n  # bản cũ rỗng / nhỏ hơn 1 block → toàn bộ là DATA
+            elif n >= block:
+                a, b = _weak(new[0:block])
+            while pos + block <= n:
+                key = a | (b << 16)
+                hit = -1
+                candidates = index.get(key)
+                if candidates:
+                    strong = hashlib.md5(new[pos:pos + block]).digest()
+                    for i, digest in candidates:
+                        if digest == strong:
+                            hit = i
+                            break
+                if hit >= 0:
+                    w.copy(hit)
+                    pos += block
+                    if pos + block <= n:
+                        a, b = _weak(new[pos:pos + block])
+                    continue
+                # Không khớp: phát 1 byte literal, trượt cửa sổ 1 byte (rolling)
+                out_byte = new[pos]
+                w.data(new[pos:pos + 1])
+                if pos + block < n:
+                    in_byte = new[pos + block]
+                    a = (a - out_byte + in_byte) % _MOD
+                    b = (b - block * out_byte + a) % _MOD
+                pos += 1
+            if pos < n:
+                w.data(new[pos:n])
+            w.close()
+        os.replace(tmp, out_path)
+        return os.path.getsize(out_path)
+    finally:
+        for f, m in ((fo, old), (fn, new)):
+            if f is not None:
+                m.close()
+                f.close()
+
+
+def apply_delta(old_path: str, delta_path: str, out_path: str) -> None:
+    """Dựng lại bản mới từ bản cũ + delta (đọc/ghi tuần tự, không nạp cả file)."""
+    with open(delta_path, "rb") as d, open(old_path, "rb") as old, open(out_path, "wb") as out:
+        if d.read(4) != MAGIC:
+            raise ValueError("not a delta file")
+        block = _U32.unpack(d.read(4))[0]
+        while True:
+            op = d.read(1)
+            if not op:
+                break
+            if op == b"C":
+                start, count = struct.unpack(">II", d.read(8))
+                old.seek(start * block)
+                remaining = count * block
+                while remaining:
+                    buf = old.read(min(remaining, 1 << 16))
+                    if not buf:
+                        raise ValueError("delta refers past end of base file")
+                    out.write(buf)
+                    remaining -= len(buf)
+            elif op == b"D":
+                remaining = _U32.unpack(d.read(4))[0]
+                while remaining:
+                    buf = d.read(min(remaining, 1 << 16))
+                    if not buf:
+                        raise ValueError("truncated delta")
+                    out.write(buf)
+                    remaining -= len(buf)
+            else:
+                raise ValueError(f"bad delta op {op!r}")
@@ -0,0 +1,269 @@
+# backend/services/device_listing.py
+"""
+GET /devices: filter + sort + keyset pagination (cursor), không dùng OFFSET.
+
+Filter (AND): owner, type, status, slot, channel (/chN), name_prefix,
+seen_after / seen_before (ISO-8601 hoặc epoch seconds, UTC).
+Sort: id | name | last_seen, thêm "-" phía trước → giảm dần; luôn kèm id làm tie-break.
+
+Hai đường:
+- memory: sort theo id, không name_prefix / khoảng last_seen → giao secondary
+  index status/type/slot của state_store (owner / channel lọc tiếp), không SQL;
+  status / last_seen là bản live
+- sql: WHERE ... AND (cột, id) sau cursor ORDER BY cột, id LIMIT n+1 trên index
+  (cột, id) của bảng devices. Query dựa vào status / last_seen đọc writer;
+  filter status mà còn transition chưa ghi → flush trước. last_seen trong DB
+  trễ tối đa STATE_SNAPSHOT_INTERVAL (không flush mỗi trang: heartbeat làm
+  thiết bị dirty liên tục). Giá trị trả về luôn là bản live in-memory
+
+Cursor = base64url của [sort, giá trị sort của dòng cuối, id]: trang sau seek
+tiếp từ đó nên trang thứ 1000 rẻ như trang đầu.
+"""
+import base64
+import heapq
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import and_, or_, select
+
+from backend.config import Config
+from backend.database import read_engine, read_your_writes, session_for
+from backend.models import Device
+from backend.security.sanitizer import sanitize_str
+from backend.serializer import dumps, loads
+from backend.services.db_executor import db_executor
+from backend.services.device_state import INDEXED_FIELDS, TRANSITIONS, DeviceState, DeviceStateStore, state_store
+
+SORT_KEYS = ("id", "name", "last_seen")
+
+# NULL nhỏ nhất khi sort (SQLite / MySQL) hay lớn nhất (PostgreSQL...) → điều kiện seek cho last_seen
+_NULLS_LOW = read_engine.dialect.name in ("sqlite", "mysql", "mariadb")
+
+
+class DeviceQuery(NamedTuple):
+    owner: Optional[int] = None
+    type: Optional[str] = None
+    status: Optional[str] = None
+    slot: Optional[str] = None
+    channel: Optional[int] = None  # vị trí trong SOCKETIO_CHANNELS (= id % số kênh)
+    name_prefix: Optional[str] = None
+    seen_after: Optional[datetime] = None
+    seen_before: Optional[datetime] = None
+    sort: str = "id"
+    desc: bool = False
+    limit: int = Config.DEVICE_LIST_DEFAULT_LIMIT
+    after: Optional[Tuple[Any, int]] = None  # (giá trị sort, id) của dòng cuối trang trước
+
+    @property
+    def sort_key(self) -> str:
+        return f"-{self.sort}" if self.desc else self.sort
+
+    @property
+    def in_memory(self) -> bool:
+        return (self.sort == "id" and self.name_prefix is None
+                and self.seen_after is None and self.seen_before is None)
+
+
+def _parse_time(value: str) -> datetime:
+    """ISO-8601 hoặc epoch seconds → datetime UTC naive (như Device.last_seen)."""
+    try:
+        return datetime.utcfromtimestamp(float(value))
+    except (OverflowError, OSError):
+        raise ValueError(f"invalid time: {value!r}")
+    except ValueError:
+        pass
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def encode_cursor(sort_key: str, value: Any, device_id: int) -> str:
+    raw = dumps([sort_key, value, device_id]).encode()
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def decode_cursor(cursor: str, q: DeviceQuery) -> Tuple[Any, int]:
+    try:
+        key, value, device_id = loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if q.sort == "last_seen" and value is not None:
+            value = datetime.fromisoformat(value)
+    except Exception:
+        raise ValueError("invalid cursor")
+    if key != q.sort_key or not isinstance(device_id, int):
+        raise ValueError("cursor does not match sort")
+    return value, device_id
+
+
+def parse_query(args, channels: List[str] = Config.SOCKETIO_CHANNELS) -> DeviceQuery:
+    """Query string → DeviceQuery. Raise ValueError (→ 400) nếu tham số sai."""
+    def text(key: str) -> Optional[str]:
+        return sanitize_str(args.get(key), max_length=64) or None
+
+    fields: Dict[str, Any] = {"type": text("type"), "slot": text("slot"), "name_prefix": text("name_prefix")}
+
+    status = text("status")
+    if status is not None and status not in TRANSITIONS:
+        raise ValueError(f"status must be one of {sorted(TRANSITIONS)}")
+    fields["status"] = status
+
+    def integer(key: str, default: Optional[int] = None) -> Optional[int]:
+        value = text(key)
+        if value is None:
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            raise ValueError(f"{key} must be an integer")
+
+    fields["owner"] = integer("owner")
+
+    channel = text("channel")
+    if channel is not None:
+        channel = "/" + channel.lstrip("/")
+        if channel not in channels:
+            raise ValueError(f"channel must be one of {channels}")
+        fields["channel"] = channels.index(channel)
+
+    for key in ("seen_after", "seen_before"):
+        if text(key) is not None:
+            fields[key] = _parse_time(text(key))
+
+    sort = text("sort") or "id"
+    fields["desc"] = sort.startswith("-")
+    fields["sort"] = sort.lstrip("-")
+    if fields["sort"] not in SORT_KEYS:
+        raise ValueError(f"sort must be one of {list(SORT_KEYS)} (prefix '-' for descending)")
+
+    limit = integer("limit", Config.DEVICE_LIST_DEFAULT_LIMIT)
+    fields["limit"] = max(1, min(limit, Config.DEVICE_LIST_MAX_LIMIT))
+
+    q = DeviceQuery(**fields)
+    cursor = (args.get("cursor") or "").strip()
+    if cursor:
+        q = q._replace(after=decode_cursor(cursor, q))
+    return q
+
+
+def _prefix_end(prefix: str) -> str:
+    """Chuỗi nhỏ nhất lớn hơn mọi chuỗi bắt đầu bằng prefix (name >= p AND name < end dùng được index)."""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class DeviceLister:
+    def __init__(self, store: DeviceStateStore, channels: List[str]) -> None:
+        self.states = store
+        self.channels = channels
+        self.served: Counter = Counter()
+
+    def list(self, q: DeviceQuery) -> Dict[str, Any]:
+        source = "memory" if q.in_memory else "sql"
+        rows = self._from_memory(q) if q.in_memory else self._from_sql(q)
+        self.served[source] += 1
+        next_cursor = None
+        if len(rows) > q.limit:
+            rows = rows[:q.limit]
+            value, device_id, _ = rows[-1]
+            next_cursor = encode_cursor(q.sort_key, value, device_id)
+        devices = []
+        for _, device_id, st in rows:
+            st = st or self.states.get(device_id)
+            if st is not None:  # bị xoá giữa chừng
+                devices.append(self.item(st))
+        return {"devices": devices, "next_cursor": next_cursor, "limit": q.limit,
+                "sort": q.sort_key, "source": source}
+
+    def item(self, st: DeviceState) -> Dict[str, Any]:
+        return {
+            "id": st.device_id,
+            "device_uid": st.device_uid,
+            "name": st.name,
+            "type": st.type,
+            "slot": st.slot,
+            "owner_id": st.owner_id,
+            "channel": self.channels[st.device_id % len(self.channels)],
+            "status": st.status,
+            "code_uploaded": st.code_uploaded,
+            "last_seen": st.last_seen.isoformat() if st.last_seen else None,
+        }
+
+    # ========= MEMORY =========
+    def _from_memory(self, q: DeviceQuery) -> List[Tuple[Any, int, Optional[DeviceState]]]:
+        indexed = {f: getattr(q, f) for f in INDEXED_FIELDS if getattr(q, f) is not None}
+        n = len(self.channels)
+        after = q.after[1] if q.after else None
+
+        def keep(st: DeviceState) -> bool:
+            if q.owner is not None and st.owner_id != q.owner:
+                return False
+            if q.channel is not None and st.device_id % n != q.channel:
+                return False
+            if after is not None and (st.device_id >= after if q.desc else st.device_id <= after):
+                return False
+            return True
+
+        pick = heapq.nlargest if q.desc else heapq.nsmallest
+        page = pick(q.limit + 1, filter(keep, self.states.find(**indexed)), key=lambda st: st.device_id)
+        return [(st.device_id, st.device_id, st) for st in page]
+
+    # ========= SQL =========
+    def _from_sql(self, q: DeviceQuery) -> List[Tuple[Any, int, Optional[DeviceState]]]:
+        # status / last_seen trong DB trễ tối đa STATE_SNAPSHOT_INTERVAL so với state in-memory
+        if q.status is None and q.sort != "last_seen" and not q.seen_after and not q.seen_before:
+            return db_executor.run(self._query, q)
+        if q.status is not None and self.states.status_pending():
+            self.states.flush()  # chỉ ghi khi có transition, không phải mỗi trang
+        with read_your_writes():
+            return db_executor.run(self._query, q)
+
+    def _query(self, q: DeviceQuery) -> List[Tuple[Any, int, None]]:
+        col = getattr(Device, q.sort)
+        stmt = select(col, Device.id) if q.sort != "id" else select(Device.id)
+        conds = []
+        if q.owner is not None:
+            conds.append(Device.owner_id == q.owner)
+        for field in INDEXED_FIELDS:
+            if getattr(q, field) is not None:
+                conds.append(getattr(Device, field) == getattr(q, field))
+        if q.channel is not None:
+            conds.append(Device.id % len(self.channels) == q.channel)
+        if q.name_prefix:
+            conds += [Device.name >= q.name_prefix, Device.name < _prefix_end(q.name_prefix)]
+        if q.seen_after:
+            conds.append(Device.last_seen >= q.seen_after)
+        if q.seen_before:
+            conds.append(Device.last_seen < q.seen_before)
+        if q.after:
+            conds.append(self._seek(col, q))
+        if q.desc:
+            order = (Device.id.desc(),) if q.sort == "id" else (col.desc(), Device.id.desc())
+        else:
+            order = (Device.id,) if q.sort == "id" else (col, Device.id)
+        stmt = stmt.where(*conds).order_by(*order).limit(q.limit + 1)
+        with session_for("read") as db:
+            rows = db.execute(stmt).all()
+        if q.sort == "id":
+            return [(r[0], r[0], None) for r in rows]
+        return [(value, device_id, None) for value, device_id in rows]
+
+    @staticmethod
+    def _seek(col, q: DeviceQuery):
+        """Điều kiện "sau cursor" theo (cột, id); NULL của last_seen nằm đầu/cuối tuỳ dialect."""
+        value, device_id = q.after
+        past_id = Device.id < device_id if q.desc else Device.id > device_id
+        if q.sort == "id":
+            return past_id
+        nulls_after = q.sort == "last_seen" and _NULLS_LOW == q.desc
+        if value is None:
+            cond = and_(col.is_(None), past_id)
+            return cond if nulls_after else or_(cond, col.is_not(None))
+        past_value = col < value if q.desc else col > value
+        cond = or_(past_value, and_(col == value, past_id))
+        return or_(cond, col.is_(None)) if nulls_after else cond
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self.served)
+
+
+device_lister = DeviceLister(state_store, Config.SOCKETIO_CHANNELS)
@@ -1,12 +1,28 @@
+import hashlib
+import hmac
+import json
+import random
 import time
+from collections import Counter
 from datetime import datetime, timedelta
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple
 
 from flask_socketio import join_room
+from sqlalchemy import case, func, insert, select, update
+from sqlalchemy.exc import OperationalError
 from backend.config import Config
-from backend.database import SessionLocal
-from backend.models import Device, User, CommandQueue
+from backend.database import SessionLocal, read_your_writes, session_for
+from backend.models import Device, User, CommandQueue, DeviceTag, CommandBroadcast, BroadcastItem
 from backend.extensions import socketio
+from backend.serializer import dumps
+from backend.services.change_tracker import changes
+from backend.services.command_scheduler import command_scheduler
+from backend.services.db_executor import DBBusy, db_executor
+from backend.services.connection_registry import DeviceConnection, connection_registry
+from backend.services.device_state import DeviceState, state_store
+from backend.services.heartbeat_log import heartbeat_log
+from backend.services.heartbeat_policy import HeartbeatPolicy
+from backend.services.wire_codec import wire_registry
 
 
 class DeviceManager:
@@ -16,6 +32,33 @@ class DeviceManager:
         self.slot_seconds = Config.TDMA_SLOT_SECONDS
         self.num_slots = Config.TDMA_NUM_SLOTS
         self.watchdog_timeout = getattr(Config, "WATCHDOG_TIMEOUT", 60)
+        self.heartbeat_policy = HeartbeatPolicy(
+            rate_budget=Config.HEARTBEAT_RATE_BUDGET,
+            min_interval=Config.HEARTBEAT_MIN_INTERVAL,
+            max_interval=Config.HEARTBEAT_MAX_INTERVAL,
+            watchdog_timeout=self.watchdog_timeout,
+            watchdog_grace=getattr(Config, "WATCHDOG_GRACE", 5),
+            slot_seconds=self.slot_seconds,
+        )
+        # Dùng chung giữa các DeviceManager (app / dashboard / device routes)
+        self.wire = wire_registry
+        self.connections = connection_registry
+        self.states = state_store
+        # Phát command: class ưu tiên + fair-share giữa user, dispatcher gọi lại _dispatch_scheduled
+        self.scheduler = command_scheduler
+        self.scheduler.bind(self._dispatch_scheduled)
+
+        # Coalescing: command (lowercase) → (group, mode, các command cùng group)
+        self.coalesce_rules: Dict[str, Tuple[str, str, List[str]]] = {}
+        for group, rule in getattr(Config, "COMMAND_COALESCE_RULES", {}).items():
+            members = [c.lower() for c in rule["commands"]]
+            for c in members:
+                self.coalesce_rules[c] = (group, rule.get("mode", "supersede"), members)
+        self.coalesced = Counter()  # group → số command đã bị gộp/huỷ
+
+        # Ack rate theo thiết bị (EWMA, ack/s) để chia batch khi replay
+        self._ack_rate: Dict[int, float] = {}
+        self._last_ack: Dict[int, float] = {}
 
     # ========= USER PRESENCE =========
     def set_user_online(self, user_id: int) -> None:
@@ -36,69 +79,148 @@ class DeviceManager:
             u.last_seen = datetime.utcnow()
             db.commit()
 
+    # ========= DEVICE AUTH / CONNECTIONS =========
+    def device_token(self, device_uid: str) -> str:
+        """Token thiết bị = HMAC(SECRET_KEY, uid): không cần lưu DB, đổi SECRET_KEY là thu hồi hết."""
+        key = Config.SECRET_KEY.encode()
+        return hmac.new(key, device_uid.encode(), hashlib.sha256).hexdigest()
+
+    def authenticate_device(self, sid: str, device_uid: str, token: Optional[str]) -> Optional[DeviceConnection]:
+        """
+        Xác thực thiết bị một lần lúc connect và bind sid → device.
+        Các event sau đó dùng binding này, không tra DB theo uid nữa.
+        """
+        if Config.DEVICE_AUTH_REQUIRED:
+            if not token or not hmac.compare_digest(token, self.device_token(device_uid)):
+                return None
+        st = self.states.get_by_uid(device_uid)
+        if st is None:
+            return None
+        ns = self.assign_namespace(st)
+        conn = DeviceConnection(sid, st.device_id, st.device_uid, st.type, ns, st.slot)
+        self.connections.bind(conn)
+        return conn
+
+    def disconnect_device(self, sid: str) -> Optional[DeviceConnection]:
+        """Gỡ binding + đánh dấu offline ngay, không chờ watchdog."""
+        conn = self.connections.unbind(sid)
+        if conn is None or self.connections.by_uid(conn.device_uid) is not None:
+            # Không phải thiết bị, hoặc thiết bị đã connect lại bằng sid khác
+            return conn
+        self.heartbeat_policy.forget(conn.device_uid)
+        self.set_status(conn.device_id, "offline", source="socket")
+        return conn
+
+    # ========= DEVICE STATE MACHINE =========
+    def device_state(self, device_id: int) -> Optional[DeviceState]:
+        return self.states.get(device_id)
+
+    def can_set_status(self, device_id: int, status: str) -> bool:
+        st = self.states.get(device_id)
+        return st is not None and self.states.can_transition(st.status, status)
+
+    def set_status(self, device_id: int, status: str, source: str = "api") -> bool:
+        """
+        Đổi status qua state machine (chỉ memory; snapshot ghi DB theo chu kỳ).
+        Raise InvalidTransition nếu chuyển không hợp lệ. Trả về True nếu có thay đổi.
+        """
+        changed = self.states.transition(device_id, status, source)
+        if changed:
+            self._emit_status(self.states.get(device_id))
+        return changed is not None
+
+    def _emit_status(self, st: DeviceState) -> None:
+        socketio.emit(
+            "device_status",
+            {
+                "device_id": st.device_id,
+                "uid": st.device_uid,
+                "type": st.type,
+                "status": st.status,
+                "last_seen": st.last_seen.isoformat() if st.last_seen else None,
+            },
+            namespace="/",
+        )
+
     # ========= DEVICE CRUD HELPERS =========
     def touch_last_seen(self, device_uid: str) -> None:
-        with SessionLocal() as db:
-            d = db.query(Device).filter_by(device_uid=device_uid).first()
-            if d:
-                d.last_seen = datetime.utcnow()
-                db.commit()
+        st = self.states.get_by_uid(device_uid)
+        if st is not None:
+            self.states.touch(st.device_id)
 
     def mark_code_uploaded(self, device_id: int, uploaded: bool) -> None:
+        at = datetime.utcnow() if uploaded else None
         with SessionLocal() as db:
             d = db.get(Device, device_id)
             if d:
                 d.code_uploaded = uploaded
-                d.code_uploaded_at = datetime.utcnow() if uploaded else None
+                d.code_uploaded_at = at
                 db.commit()
+        self.states.set_code_uploaded(device_id, uploaded, at)
 
     # ========= SNAPSHOT for dashboard =========
+    @staticmethod
+    def _snapshot_users_queue() -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """users + 50 command mới nhất (chỉ lấy cột cần); datetime để nguyên cho serializer."""
+        # Đọc replica, trừ khi users/command_queue vừa ghi (không cache body cũ dưới version mới)
+        with session_for("read", wrote_at=changes.db_written_at) as db:
+            users = [
+                dict(r._mapping)
+                for r in db.execute(select(User.id, User.username, User.online, User.last_seen))
+            ]
+            queue = [
+                dict(r._mapping)
+                for r in db.execute(
+                    select(
+                        CommandQueue.id, CommandQueue.device_id, CommandQueue.user_id, CommandQueue.command,
+                        CommandQueue.status, CommandQueue.created_at, CommandQueue.sent_at, CommandQueue.ack_time,
+                    )
+                    .order_by(CommandQueue.created_at.desc())
+                    .limit(50)
+                )
+            ]
+        return users, queue
+
+    def _sorted_states(self) -> List[DeviceState]:
+        return sorted(self.states.all(), key=lambda st: st.device_id)
+
     def get_status_snapshot(self) -> Dict[str, Any]:
-        with SessionLocal() as db:
-            users = db.query(User).all()
-            devices = db.query(Device).all()
-            q = (
-                db.query(CommandQueue)
-                .order_by(CommandQueue.created_at.desc())
-                .limit(50)
-                .all()
-            )
-            return {
-                "users": [
-                    {
-                        "id": u.id,
-                        "username": u.username,
-                        "online": u.online,
-                        "last_seen": u.last_seen.isoformat() if u.last_seen else None,
-                    }
-                    for u in users
-                ],
-                "devices": [
-                    {
-                        "id": d.id,
-                        "device_uid": d.device_uid,
-                        "name": d.name,
-                        "type": d.type,  # ✅ FIX: use .type not .hw_type
-                        "status": d.status,
-                        "code_uploaded": d.code_uploaded,
-                        "last_seen": d.last_seen.isoformat() if d.last_seen else None,
-                    }
-                    for d in devices
-                ],
-                "queue": [
-                    {
-                        "id": c.id,
-                        "device_id": c.device_id,
-                        "user_id": c.user_id,
-                        "command": c.command,
-                        "status": c.status,
-                        "created_at": c.created_at.isoformat(),
-                        "sent_at": c.sent_at.isoformat() if c.sent_at else None,
-                        "ack_time": c.ack_time.isoformat() if c.ack_time else None,
-                    }
-                    for c in q
-                ],
-            }
+        users, queue = db_executor.run(self._snapshot_users_queue)
+        iso = lambda v: v.isoformat() if v else None
+        for u in users:
+            u["last_seen"] = iso(u["last_seen"])
+        for c in queue:
+            for k in ("created_at", "sent_at", "ack_time"):
+                c[k] = iso(c[k])
+        return {
+            "users": users,
+            # Thiết bị đọc từ state in-memory (authoritative), không query DB
+            "devices": [
+                {
+                    "id": d.device_id,
+                    "device_uid": d.device_uid,
+                    "name": d.name,
+                    "type": d.type,  # ✅ FIX: use .type not .hw_type
+                    "status": d.status,
+                    "code_uploaded": d.code_uploaded,
+                    "last_seen": iso(d.last_seen),
+                }
+                for d in self._sorted_states()
+            ],
+            "queue": queue,
+        }
+
+    def get_status_snapshot_json(self, include_devices: bool = True) -> str:
+        """
+        Snapshot đã encode sẵn cho /dashboard/status: thiết bị ghép từ fragment
+        JSON (phần tĩnh encode một lần), users/queue qua serializer.
+        include_devices=False: chỉ users/queue (dashboard lấy thiết bị theo trang qua GET /devices).
+        """
+        users, queue = db_executor.run(self._snapshot_users_queue)
+        if not include_devices:
+            return f'{{"users":{dumps(users)},"queue":{dumps(queue)}}}'
+        devices = ",".join(d.to_json() for d in self._sorted_states())
+        return f'{{"users":{dumps(users)},"devices":[{devices}],"queue":{dumps(queue)}}}'
 
     # ========= TDMA / FDMA =========
     def current_slot(self) -> int:
@@ -120,24 +242,80 @@ class DeviceManager:
         return channels[idx]
 
     def join_fdma_room(self, device_id: int) -> str:
-        with SessionLocal() as db:
-            d = db.get(Device, device_id)
-            if not d:
-                return "/ch0"
-            ns = self.assign_namespace(d)
-            join_room(ns)
-            return ns
+        st = self.states.get(device_id)
+        if st is None:
+            return "/ch0"
+        ns = self.assign_namespace(st)
+        join_room(ns)
+        return ns
 
-    def _get_namespace(self, device_id: int) -> Optional[str]:
-        with SessionLocal() as db:
-            d = db.get(Device, device_id)
-            if not d:
-                return None
-            return self.assign_namespace(d)
+    def _emit_command(self, conn: DeviceConnection, payload: Dict[str, Any]) -> None:
+        """
+        Emit command tới đúng sid của thiết bị đích (không phát cho cả room FDMA):
+        connection binary → frame mang handle của thiết bị, ngược lại device_command JSON.
+        """
+        fmt = self.wire.format_for(conn.sid)
+        handle = self.wire.handle_for(conn.device_uid) if fmt else None
+        if handle is None:
+            socketio.emit("device_command", payload, to=conn.sid)
+            return
+        frame = self.wire.encode(fmt, {
+            "type": "command",
+            "handle": handle,
+            "command_id": payload["id"],
+            "cmd": payload["cmd"],
+        })
+        socketio.emit("device_bin", frame, to=conn.sid)
 
     # ========= CONTROL / QUEUE =========
-    def enqueue_command(self, device_id: int, user_id: int, command: str) -> int:
+    def _coalesce_pending(self, db, device_ids: List[int], command: str) -> int:
+        """
+        Huỷ các command pending cũ cùng group (supersede) cho các thiết bị,
+        bằng một câu UPDATE. Trả về số command bị huỷ.
+        """
+        rule = self.coalesce_rules.get(command.lower())
+        if not rule or not device_ids:
+            return 0
+        group, mode, members = rule
+        targets = members if mode == "supersede" else [command.lower()]
+        cancelled = db.execute(
+            update(CommandQueue)
+            .where(
+                CommandQueue.device_id.in_(device_ids),
+                CommandQueue.status == "pending",
+                func.lower(CommandQueue.command).in_(targets),
+            )
+            .values(status="cancelled")
+            .returning(CommandQueue.id)
+            .execution_options(synchronize_session=False)
+        ).scalars().all()
+        if cancelled:
+            self.coalesced[group] += len(cancelled)
+            self.scheduler.discard(cancelled)  # đang chờ trong scheduler → không phát nữa
+        return len(cancelled)
+
+    def enqueue_coalesced(self, device_id: int, user_id: int, command: str) -> Tuple[int, int]:
+        """
+        Enqueue có coalescing theo COMMAND_COALESCE_RULES:
+        - "supersede": command mới huỷ mọi pending cùng group (vd start/stop)
+        - "dedupe": đã có pending y hệt → giữ cái cũ, không thêm mới
+        Trả về (command_id, số command bị gộp).
+        """
         with SessionLocal() as db:
+            rule = self.coalesce_rules.get(command.lower())
+            if rule and rule[1] == "dedupe":
+                existing = db.execute(
+                    select(CommandQueue.id).where(
+                        CommandQueue.device_id == device_id,
+                        CommandQueue.status == "pending",
+                        func.lower(CommandQueue.command) == command.lower(),
+                    ).limit(1)
+                ).scalar()
+                if existing is not None:
+                    self.coalesced[rule[0]] += 1
+                    return existing, 1
+
+            coalesced = self._coalesce_pending(db, [device_id], command)
             cmd = CommandQueue(
                 device_id=device_id,
                 user_id=user_id,
@@ -146,73 +324,402 @@ class DeviceManager:
             )
             db.add(cmd)
             db.commit()
-            return cmd.id
+            return cmd.id, coalesced
+
+    def enqueue_command(self, device_id: int, user_id: int, command: str) -> int:
+        return self.enqueue_coalesced(device_id, user_id, command)[0]
+
+    def coalesce_stats(self) -> Dict[str, int]:
+        return dict(self.coalesced)
+
+    def queue_command(self, device_id: int, user_id: int, command: str) -> Tuple[int, int]:
+        """
+        Quota của user → ghi pending (có coalescing) → đưa vào scheduler nếu thiết
+        bị đang connect (offline: giữ pending, replay khi online lại).
+        Trả về (command_id, số command bị gộp). Vượt quota → CommandRejected.
+        """
+        klass = self.scheduler.admit(user_id, command)
+        cid, coalesced = self.enqueue_coalesced(device_id, user_id, command)
+        if self.connections.by_device_id(device_id) is not None:
+            self.scheduler.submit(cid, device_id, user_id, command, klass)
+        return cid, coalesced
 
     def send_command(self, device_id: int, user_id: int, command: str) -> bool:
-        """Gửi command ngay lập tức xuống thiết bị + lưu queue."""
-        ns = self._get_namespace(device_id)
-        if not ns:
+        """Queue command qua scheduler. True nếu thiết bị đang connect (phát ngay theo lượt)."""
+        if self.states.get(device_id) is None:
+            return False
+        self.queue_command(device_id, user_id, command)
+        return self.connections.by_device_id(device_id) is not None
+
+    def dispatch_pending_for_device(self, device_id: int) -> int:
+        """Đưa các command pending của thiết bị (đang connect) vào scheduler."""
+        if self.connections.by_device_id(device_id) is None:
+            # Thiết bị chưa connect: giữ pending để còn coalesce được
+            return 0
+        with SessionLocal() as db:
+            pending = db.execute(
+                select(CommandQueue.id, CommandQueue.user_id, CommandQueue.command)
+                .where(CommandQueue.device_id == device_id, CommandQueue.status == "pending")
+                .order_by(CommandQueue.created_at.asc(), CommandQueue.id.asc())
+            ).all()
+        count = 0
+        for cid, user_id, command in pending:
+            klass = self.scheduler.classify(command, user_id)
+            count += self.scheduler.submit(cid, device_id, user_id, command, klass)
+        return count
+
+    def _dispatch_scheduled(self, item) -> bool:
+        """Dispatcher của scheduler gọi: claim pending → sent rồi mới emit (không phát trùng với replay)."""
+        conn = self.connections.by_device_id(item.device_id)
+        if conn is None:
+            return False  # offline trong lúc chờ → còn pending, replay khi online
+        try:
+            claimed = db_executor.run(self._mark_sent, [item.command_id])
+        except DBBusy:
+            self.scheduler.requeue(item)  # giữ nguyên lượt, phát lại ở tick sau
             return False
+        if not claimed:
+            return False  # đã bị huỷ (coalescing / TTL) hoặc replay đã gửi
+        self._emit_command(conn, {"id": item.command_id, "cmd": item.command, "user_id": item.user_id})
+        return True
+
+    # ========= GROUP BROADCAST =========
+    def resolve_group(self, db, selector: Dict[str, Any]) -> List[Any]:
+        """
+        Chọn thiết bị theo nhóm: tag / type / owner_id / slot (kết hợp AND).
+        Trả về các row (id, device_uid).
+        """
+        q = select(Device.id, Device.device_uid)
+        if selector.get("tag"):
+            q = q.join(DeviceTag, DeviceTag.device_id == Device.id).where(DeviceTag.tag == selector["tag"])
+        if selector.get("type"):
+            q = q.where(Device.type == selector["type"])
+        if selector.get("owner_id"):
+            q = q.where(Device.owner_id == int(selector["owner_id"]))
+        if selector.get("slot") is not None:
+            q = q.where(Device.slot == str(selector["slot"]))
+        return db.execute(q.order_by(Device.id)).all()
 
+    def broadcast_command(self, user_id: int, command: str, selector: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Fan-out một command tới cả nhóm thiết bị:
+        - 1 transaction, bulk INSERT CommandQueue cho cả nhóm (1 câu lệnh)
+        - quota: N thiết bị = N command (rate "command_user" + số đang chờ)
+        - command thường: "pending", thiết bị đang connect được đưa vào
+          scheduler như command đơn lẻ (WFQ, dispatch rate, in-flight của user)
+        - class safety (stop...): đang connect → "sent" ngay, emit 1 lần / room
+          FDMA; vẫn chiếm chỗ in-flight tới khi ack
+        """
+        now = datetime.utcnow()
+        channels = Config.SOCKETIO_CHANNELS
         with SessionLocal() as db:
-            cmd = CommandQueue(
-                device_id=device_id,
-                user_id=user_id,
+            targets = self.resolve_group(db, selector)
+        if not targets:
+            return None
+        # Ngoài session: principal_cache dùng chung scoped session
+        klass = self.scheduler.admit(user_id, command, cost=len(targets))
+        immediate = klass == "safety"
+        with SessionLocal() as db:
+            bc = CommandBroadcast(
                 command=command,
-                status="sent",
-                sent_at=datetime.utcnow(),
+                selector=json.dumps(selector, sort_keys=True),
+                target_count=len(targets),
+                user_id=user_id,
+            )
+            db.add(bc)
+            db.flush()
+
+            # Huỷ pending cũ cùng group cho cả nhóm (1 câu UPDATE)
+            coalesced = self._coalesce_pending(db, [device_id for device_id, _ in targets], command)
+
+            rows = []
+            online_ids = set()
+            for device_id, _ in targets:
+                online = self.connections.by_device_id(device_id) is not None
+                if online:
+                    online_ids.add(device_id)
+                sent = immediate and online
+                rows.append({
+                    "device_id": device_id,
+                    "user_id": user_id,
+                    "command": command,
+                    "status": "sent" if sent else "pending",
+                    "sent_at": now if sent else None,
+                    "created_at": now,
+                })
+            inserted = db.execute(
+                insert(CommandQueue).returning(CommandQueue.id, CommandQueue.device_id), rows
+            ).all()
+            cmd_by_device = {device_id: cid for cid, device_id in inserted}
+            db.execute(
+                insert(BroadcastItem),
+                [{"broadcast_id": bc.id, "command_id": cid} for cid, _ in inserted],
             )
-            db.add(cmd)
             db.commit()
+            broadcast_id = bc.id
+
+        if not immediate:
+            for device_id in sorted(online_ids):
+                self.scheduler.submit(cmd_by_device[device_id], device_id, user_id, command, klass)
+        else:
+            self.scheduler.track_sent(user_id, [cmd_by_device[device_id] for device_id in online_ids])
+            # Gom theo room FDMA → mỗi room 1 emit
+            by_room: Dict[str, List[Any]] = {}
+            for device_id, uid in targets:
+                if device_id not in online_ids:
+                    continue
+                ns = channels[device_id % len(channels)]
+                by_room.setdefault(ns, []).append((uid, cmd_by_device[device_id]))
+            for ns, members in by_room.items():
+                self._emit_broadcast(ns, command, members)
 
-            socketio.emit(
-                "device_command",
-                {"id": cmd.id, "cmd": cmd.command, "user_id": user_id},
-                to=ns,
+        with read_your_writes():  # broadcast vừa tạo, replica có thể chưa thấy
+            progress = self.broadcast_progress(broadcast_id)
+        progress["coalesced"] = coalesced
+        return progress
+
+    def _emit_broadcast(self, ns: str, command: str, members: List[Any]) -> None:
+        """1 emit JSON cho cả room + 1 frame batch / format nhị phân (chia chunk 255)."""
+        socketio.emit(
+            "device_broadcast",
+            {"cmd": command, "targets": {uid: cid for uid, cid in members}},
+            to=ns,
+        )
+        for fmt in self.wire.active_formats():
+            msgs = []
+            for uid, cid in members:
+                handle = self.wire.handle_for(uid)
+                if handle is not None:
+                    msgs.append({"type": "command", "handle": handle, "command_id": cid, "cmd": command})
+            for i in range(0, len(msgs), 255):
+                frame = self.wire.encode(fmt, {"type": "batch", "handle": 0, "events": msgs[i:i + 255]})
+                socketio.emit("device_bin", frame, to=f"{ns}:{fmt}")
+
+    def broadcast_progress(self, broadcast_id: int) -> Optional[Dict[str, Any]]:
+        """Tiến độ ack tổng hợp của một broadcast (đếm theo status)."""
+        with session_for("read") as db:
+            bc = db.get(CommandBroadcast, broadcast_id)
+            if not bc:
+                return None
+            counts = dict(
+                db.execute(
+                    select(CommandQueue.status, func.count())
+                    .join(BroadcastItem, BroadcastItem.command_id == CommandQueue.id)
+                    .where(BroadcastItem.broadcast_id == broadcast_id)
+                    .group_by(CommandQueue.status)
+                ).all()
             )
+            acked = counts.get("ack", 0)
+            return {
+                "id": bc.id,
+                "command": bc.command,
+                "selector": json.loads(bc.selector),
+                "targets": bc.target_count,
+                "counts": counts,
+                "acked": acked,
+                "progress": round(acked / bc.target_count, 4) if bc.target_count else 1.0,
+                "created_at": bc.created_at.isoformat(),
+            }
+
+    def set_device_tags(self, device_id: int, tags: List[str]) -> List[str]:
+        with SessionLocal() as db:
+            db.query(DeviceTag).filter_by(device_id=device_id).delete()
+            clean = sorted(set(t for t in tags if t))
+            if clean:
+                db.execute(insert(DeviceTag), [{"device_id": device_id, "tag": t} for t in clean])
+            db.commit()
+            return clean
+
+    def mark_command_ack(self, command_id: int, device_id: Optional[int] = None) -> bool:
+        """
+        Đánh dấu ack. Khi biết device_id (từ binding của connection) thì chỉ
+        ack command của chính thiết bị đó, bằng một câu UPDATE không cần SELECT.
+        """
+        now = datetime.utcnow()
+        device_id = db_executor.run(self._ack_in_db, command_id, device_id, now)
+        if device_id is None:
+            return False
+        self._observe_ack(device_id)
+        self.scheduler.on_ack(command_id)
+
+        socketio.emit(
+            "command_ack",
+            {
+                "command_id": command_id,
+                "device_id": device_id,
+                "status": "ack",
+                "ack_time": now,
+            },
+            namespace="/",
+        )
         return True
 
-    def dispatch_pending_for_device(self, device_id: int) -> int:
-        """Gửi lệnh pending → socket, đổi trạng thái sent + sent_at."""
+    @staticmethod
+    def _ack_in_db(command_id: int, device_id: Optional[int], now: datetime) -> Optional[int]:
+        """Phần DB của mark_command_ack (chạy trên db_executor). Trả về device_id nếu ack được."""
         with SessionLocal() as db:
-            pending = (
-                db.query(CommandQueue)
-                .filter_by(device_id=device_id, status="pending")
-                .order_by(CommandQueue.created_at.asc())
-                .all()
+            if device_id is None:
+                c = db.get(CommandQueue, command_id)
+                if not c:
+                    return None
+                device_id = c.device_id
+            res = db.execute(
+                update(CommandQueue)
+                .where(CommandQueue.id == command_id, CommandQueue.device_id == device_id)
+                .values(status="ack", ack_time=now)
             )
-            count = 0
-            ns = self._get_namespace(device_id)
-            if not ns:
-                return 0
-            for c in pending:
-                socketio.emit("device_command", {"id": c.id, "cmd": c.command}, to=ns)
-                c.status = "sent"
-                c.sent_at = datetime.utcnow()
-                db.commit()
-                count += 1
-            return count
+            db.commit()
+            return device_id if res.rowcount else None
+
+    # ========= OFFLINE REPLAY =========
+    def _observe_ack(self, device_id: int) -> None:
+        now = time.monotonic()
+        last = self._last_ack.get(device_id)
+        self._last_ack[device_id] = now
+        if last is None:
+            return
+        rate = 1.0 / max(now - last, 1e-3)
+        prev = self._ack_rate.get(device_id)
+        self._ack_rate[device_id] = rate if prev is None else 0.8 * prev + 0.2 * rate
+
+    def replay_batch_size(self, device_id: int) -> int:
+        """Số command / batch = số ack thiết bị xử lý được trong một TDMA slot."""
+        rate = self._ack_rate.get(device_id, Config.REPLAY_DEFAULT_ACK_RATE)
+        return max(1, min(Config.REPLAY_MAX_BATCH, int(rate * self.slot_seconds)))
 
-    def mark_command_ack(self, command_id: int) -> bool:
+    def seconds_until_slot(self, slot: Optional[str]) -> float:
+        """Thời gian tới đầu slot TDMA kế tiếp của thiết bị (không có slot → 1 slot)."""
+        try:
+            idx = int(slot) % self.num_slots
+        except (TypeError, ValueError):
+            return float(self.slot_seconds)
+        frame = self.slot_seconds * self.num_slots
+        wait = (idx * self.slot_seconds - time.time() % frame) % frame
+        return wait if wait > 0.01 else frame
+
+    def expire_stale_commands(self, db, device_id: int) -> int:
+        """
+        TTL + giới hạn backlog: pending quá REPLAY_MAX_AGE, hoặc cũ hơn
+        REPLAY_MAX_BACKLOG command gần nhất → "expired".
+        """
+        cutoff = datetime.utcnow() - timedelta(seconds=Config.REPLAY_MAX_AGE)
+        expired = db.execute(
+            update(CommandQueue)
+            .where(
+                CommandQueue.device_id == device_id,
+                CommandQueue.status == "pending",
+                CommandQueue.created_at < cutoff,
+            )
+            .values(status="expired")
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        keep = (
+            select(CommandQueue.id)
+            .where(CommandQueue.device_id == device_id, CommandQueue.status == "pending")
+            .order_by(CommandQueue.created_at.desc())
+            .limit(Config.REPLAY_MAX_BACKLOG)
+        )
+        expired += db.execute(
+            update(CommandQueue)
+            .where(
+                CommandQueue.device_id == device_id,
+                CommandQueue.status == "pending",
+                CommandQueue.id.not_in(keep.scalar_subquery()),
+            )
+            .values(status="expired")
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.commit()
+        return expired
+
+    # Phần DB của replay, chạy trên db_executor (emit ở thread gọi)
+    def _expire_in_db(self, device_id: int) -> int:
+        with SessionLocal() as db:
+            return self.expire_stale_commands(db, device_id)
+
+    @staticmethod
+    def _pending_batch(device_id: int, limit: int) -> List[Tuple[int, str]]:
         with SessionLocal() as db:
-            c = db.get(CommandQueue, command_id)
-            if not c:
-                return False
-            c.status = "ack"
-            c.ack_time = datetime.utcnow()
+            return [tuple(r) for r in db.execute(
+                select(CommandQueue.id, CommandQueue.command)
+                .where(CommandQueue.device_id == device_id, CommandQueue.status == "pending")
+                .order_by(
+                    # STOP (class safety) chen lên trước backlog
+                    case((func.lower(CommandQueue.command).in_(command_scheduler.safety_commands), 0), else_=1),
+                    CommandQueue.created_at.asc(),
+                    CommandQueue.id.asc(),
+                )
+                .limit(limit)
+            ).all()]
+
+    @staticmethod
+    def _mark_sent(command_ids: List[int]) -> List[int]:
+        """pending → sent; trả về các id thực sự chuyển (chưa bị huỷ / gửi bởi đường khác)."""
+        with SessionLocal() as db:
+            claimed = db.execute(
+                update(CommandQueue)
+                .where(CommandQueue.id.in_(command_ids), CommandQueue.status == "pending")
+                .values(status="sent", sent_at=datetime.utcnow())
+                .returning(CommandQueue.id)
+                .execution_options(synchronize_session=False)
+            ).scalars().all()
             db.commit()
+            return claimed
 
-            socketio.emit(
-                "command_ack",
-                {
-                    "command_id": c.id,
-                    "device_id": c.device_id,
-                    "status": c.status,
-                    "ack_time": c.ack_time if c.ack_time else None,
-                },
-                namespace="/",
-            )
-            return True
+    def schedule_replay(self, conn: DeviceConnection) -> None:
+        """Gọi khi thiết bị chuyển sang online: drain queue ở background."""
+        socketio.start_background_task(self.replay_pending, conn)
+
+    def replay_pending(self, conn: DeviceConnection) -> int:
+        """
+        Gửi backlog pending thẳng tới sid của thiết bị, theo batch cỡ
+        replay_batch_size, mỗi batch cách nhau tới slot TDMA kế tiếp.
+        Dừng khi hết pending hoặc connection bị gỡ/thay.
+        DB bận / lỗi (DBBusy, OperationalError) → thử lại với backoff; quá
+        REPLAY_RETRY_LIMIT lần liên tiếp thì bỏ, command còn pending tới lần online sau.
+        """
+        fmt = self.wire.format_for(conn.sid)
+        handle = self.wire.handle_for(conn.device_uid)
+        sent = 0
+        failures = 0
+        expired = False
+        while self.connections.by_sid(conn.sid) is conn:
+            try:
+                if not expired:
+                    db_executor.run(self._expire_in_db, conn.device_id)
+                    expired = True
+                batch = db_executor.run(self._pending_batch, conn.device_id, self.replay_batch_size(conn.device_id))
+                if not batch:
+                    break
+                # Claim trước rồi mới emit: command đã được scheduler phát / bị huỷ thì bỏ qua
+                claimed = set(db_executor.run(self._mark_sent, [cid for cid, _ in batch]))
+            except (DBBusy, OperationalError) as e:
+                failures += 1
+                if failures > Config.REPLAY_RETRY_LIMIT:
+                    print(f"⚠️ replay {conn.device_uid} dừng sau {failures} lỗi DB: {e}")
+                    break
+                delay = Config.REPLAY_RETRY_BASE * 2 ** (failures - 1)
+                socketio.sleep(delay * random.uniform(0.5, 1.0))
+                continue
+            failures = 0
+            batch = [(cid, cmd) for cid, cmd in batch if cid in claimed]
+            if not batch:
+                continue
+            if fmt:
+                frame = self.wire.encode(fmt, {"type": "batch", "handle": 0, "events": [
+                    {"type": "command", "handle": handle, "command_id": cid, "cmd": cmd}
+                    for cid, cmd in batch
+                ]})
+                socketio.emit("device_bin", frame, to=conn.sid)
+            else:
+                socketio.emit(
+                    "device_commands",
+                    {"commands": [{"id": cid, "cmd": cmd} for cid, cmd in batch]},
+                    to=conn.sid,
+                )
+            sent += len(batch)
+            socketio.sleep(self.seconds_until_slot(conn.slot))
+        return sent
 
     def start_device(self, device_id: int) -> bool:
         return self.send_command(device_id, 0, "start")
@@ -221,56 +728,46 @@ class DeviceManager:
         return self.send_command(device_id, 0, "stop")
 
     def reset_watchdog(self, device_id: int) -> bool:
-        with SessionLocal() as db:
-            d = db.get(Device, device_id)
-            if not d:
-                return False
-            d.last_seen = datetime.utcnow()
-            db.commit()
+        if self.states.get(device_id) is None:
+            return False
+        self.states.touch(device_id, source="watchdog_reset")
         return True
 
     # ========= HEARTBEAT & WATCHDOG =========
-    def handle_heartbeat(self, device_uid: str) -> bool:
-        with SessionLocal() as db:
-            d = db.query(Device).filter(Device.device_uid == device_uid).first()
-            if not d:
-                return False
-            d.last_seen = datetime.utcnow()
-            d.status = "online"
-            db.commit()
+    def handle_heartbeat(self, conn: DeviceConnection) -> bool:
+        """
+        Heartbeat từ connection đã bind: chỉ cập nhật state in-memory
+        (offline → online; running/stopped giữ nguyên), snapshot ghi DB sau.
+        """
+        st = self.states.get(conn.device_id)
+        if st is None:
+            return False
+        self.states.touch(conn.device_id)
+        heartbeat_log.record(conn.device_id)
+        self._emit_status(st)
+        return True
 
-            socketio.emit(
-                "device_status",
-                {
-                    "device_id": d.id,
-                    "uid": d.device_uid,
-                    "type": d.type,  # ✅ FIX here too
-                    "status": "online",
-                    "last_seen": d.last_seen if d.last_seen else None,
-                },
-                namespace="/",
-            )
-            return True
+    def next_heartbeat_interval(self, device_uid: str) -> Optional[float]:
+        """Interval mới cần gửi xuống thiết bị (None nếu không đổi)."""
+        return self.heartbeat_policy.observe(device_uid)
 
     def check_watchdog(self) -> None:
         now = datetime.utcnow()
         timeout_delta = timedelta(seconds=self.watchdog_timeout)
 
-        with SessionLocal() as db:
-            devices = db.query(Device).all()
-            for d in devices:
-                if not d.last_seen:
-                    continue
-                if now - d.last_seen > timeout_delta and d.status != "offline":
-                    d.status = "offline"
-                    db.commit()
-                    socketio.emit(
-                        "device_timeout",
-                        {
-                            "device_id": d.id,
-                            "uid": d.device_uid,
-                            "last_seen": d.last_seen.isoformat() if d.last_seen else None,
-                            "status": "offline",
-                        },
-                        namespace="/",
-                    )
+        # Quét state in-memory; chuyển offline đi qua state machine (journal + snapshot)
+        for d in self.states.all():
+            if not d.last_seen:
+                continue
+            if now - d.last_seen > timeout_delta and d.status != "offline":
+                self.states.transition(d.device_id, "offline", source="watchdog")
+                socketio.emit(
+                    "device_timeout",
+                    {
+                        "device_id": d.device_id,
+                        "uid": d.device_uid,
+                        "last_seen": d.last_seen.isoformat() if d.last_seen else None,
+                        "status": "offline",
+                    },
+                    namespace="/",
+                )
@@ -0,0 +1,375 @@
+import atexit
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import insert, update
+
+from backend.config import Config
+from backend.database import SessionLocal
+from backend.extensions import socketio
+from backend.models import Device, DeviceTransition
+from backend.serializer import dumps
+from backend.services.change_tracker import changes
+from backend.services.db_executor import db_executor
+
+# Các chuyển trạng thái hợp lệ: offline|online|running|stopped
+TRANSITIONS = {
+    "offline": {"online"},
+    "online": {"running", "stopped", "offline"},
+    "running": {"stopped", "online", "offline"},
+    "stopped": {"running", "online", "offline"},
+}
+
+# Field có secondary index in-memory (filter hay dùng nhất của GET /devices)
+INDEXED_FIELDS = ("status", "type", "slot")
+
+
+class InvalidTransition(ValueError):
+    """Chuyển trạng thái không hợp lệ cho thiết bị."""
+
+
+class DeviceState:
+    """Bản in-memory (authoritative) của một thiết bị."""
+
+    __slots__ = (
+        "device_id", "device_uid", "name", "type", "slot", "owner_id",
+        "code_uploaded", "code_uploaded_at", "status", "last_seen", "dirty", "_static_json",
+    )
+
+    def __init__(self, d: Device) -> None:
+        self.device_id = d.id
+        self.status = d.status or "offline"
+        self.last_seen = d.last_seen
+        self.dirty = False
+        self.load_static(d)
+
+    @property
+    def id(self) -> int:
+        # Alias để dùng thay Device trong assign_namespace / slot_ok
+        return self.device_id
+
+    def load_static(self, d: Device) -> None:
+        self.device_uid = d.device_uid
+        self.name = d.name
+        self.type = d.type
+        self.slot = d.slot
+        self.owner_id = d.owner_id
+        self.code_uploaded = d.code_uploaded
+        self.code_uploaded_at = d.code_uploaded_at
+        self._static_json = None
+
+    def to_json(self) -> str:
+        """
+        JSON của thiết bị cho snapshot dashboard. Phần tĩnh (id/uid/name/type)
+        encode một lần; phần động (status/code_uploaded/last_seen) qua dumps mỗi lần → luôn được escape.
+        """
+        if self._static_json is None:
+            static = {"id": self.device_id, "device_uid": self.device_uid, "name": self.name, "type": self.type}
+            self._static_json = dumps(static)[:-1]  # bỏ "}" để ghép tiếp
+        dynamic = dumps({"status": self.status, "code_uploaded": bool(self.code_uploaded), "last_seen": self.last_seen})
+        return f"{self._static_json},{dynamic[1:]}"
+
+
+class DeviceStateStore:
+    """
+    State machine thiết bị với trạng thái hiện tại giữ trong memory.
+
+    - Mọi thay đổi status đi qua transition() → kiểm tra TRANSITIONS
+    - last_seen / status chỉ đánh dấu dirty, không ghi DB ngay
+    - flush() định kỳ: snapshot các thiết bị dirty (bulk UPDATE theo PK)
+      + journal chuyển trạng thái (bulk INSERT device_transitions), 1 transaction
+    - secondary index status/type/slot → id, cập nhật cùng lúc với state
+      (find() lọc không cần SQL)
+    - id / uid không có trong DB được nhớ negative_ttl giây (LRU negative_max)
+      → tra id lạ liên tục không thành một round-trip DB mỗi lần
+    """
+
+    def __init__(self, snapshot_interval: float, journal_max: int,
+                 negative_ttl: float = 30.0, negative_max: int = 4096, last_seen_resolution: float = 30.0) -> None:
+        self.snapshot_interval = snapshot_interval
+        self.last_seen_resolution = last_seen_resolution
+        self.journal_max = journal_max
+        self.negative_ttl = negative_ttl
+        self.negative_max = negative_max
+        self._missing: "OrderedDict[Tuple[str, Any], float]" = OrderedDict()  # ("id"|"uid", key) → hạn
+        self._states: Dict[int, DeviceState] = {}
+        self._by_uid: Dict[str, int] = {}
+        self._index: Dict[str, Dict[Any, Set[int]]] = {f: {} for f in INDEXED_FIELDS}
+        self._journal: List[Dict] = []
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._flusher_started = False
+
+    # ========= LOAD / LOOKUP =========
+    # Đọc DB qua db_executor (OS thread), state chỉ được sửa ở thread gọi
+    @staticmethod
+    def _fetch_all() -> List[Device]:
+        with SessionLocal() as db:
+            return db.query(Device).all()
+
+    @staticmethod
+    def _fetch(device_id: Optional[int] = None, device_uid: Optional[str] = None) -> Optional[Device]:
+        with SessionLocal() as db:
+            if device_id is not None:
+                return db.get(Device, device_id)
+            return db.query(Device).filter_by(device_uid=device_uid).first()
+
+    def load(self) -> None:
+        if self._loaded:
+            return
+        devices = db_executor.run(self._fetch_all)
+        with self._lock:
+            if self._loaded:
+                return
+            for d in devices:
+                self._add(d)
+            self._loaded = True
+
+    def _add(self, d: Device) -> DeviceState:
+        st = DeviceState(d)
+        self._states[d.id] = st
+        self._by_uid[d.device_uid] = d.id
+        self._found(d)
+        self._index_add(st)
+        changes.bump()
+        return st
+
+    # ========= NEGATIVE CACHE =========
+    def _is_missing(self, key: Tuple[str, Any]) -> bool:
+        with self._lock:
+            expires = self._missing.get(key)
+            if expires is None:
+                return False
+            if expires < time.monotonic():
+                del self._missing[key]
+                return False
+            return True
+
+    def _mark_missing(self, key: Tuple[str, Any]) -> None:
+        with self._lock:
+            self._missing[key] = time.monotonic() + self.negative_ttl
+            self._missing.move_to_end(key)
+            while len(self._missing) > self.negative_max:
+                self._missing.popitem(last=False)
+
+    def _found(self, d: Device) -> None:
+        """Thiết bị vừa được tạo / sửa → bỏ kết quả "không có" đã nhớ."""
+        self._missing.pop(("id", d.id), None)
+        self._missing.pop(("uid", d.device_uid), None)
+
+    # ========= SECONDARY INDEX =========
+    # Gọi khi đang giữ self._lock
+    def _index_add(self, st: DeviceState) -> None:
+        for field in INDEXED_FIELDS:
+            self._index[field].setdefault(getattr(st, field), set()).add(st.device_id)
+
+    def _index_discard(self, st: DeviceState, field: str, value: Any) -> None:
+        ids = self._index[field].get(value)
+        if ids is not None:
+            ids.discard(st.device_id)
+            if not ids:
+                del self._index[field][value]
+
+    def _index_remove(self, st: DeviceState) -> None:
+        for field in INDEXED_FIELDS:
+            self._index_discard(st, field, getattr(st, field))
+
+    def find(self, **filters: Any) -> List[DeviceState]:
+        """
+        Thiết bị khớp mọi filter (AND) trên INDEXED_FIELDS, vd find(status="online", type="arduino_uno").
+        Giao các tập id từ nhỏ đến lớn; không filter → tất cả.
+        """
+        unknown = set(filters) - set(INDEXED_FIELDS)
+        if unknown:
+            raise ValueError(f"not indexed: {sorted(unknown)}")
+        self.load()
+        with self._lock:
+            if not filters:
+                return list(self._states.values())
+            sets = sorted((self._index[f].get(v, ()) for f, v in filters.items()), key=len)
+            ids = set(sets[0]).intersection(*sets[1:])
+            return [self._states[i] for i in ids]
+
+    def get(self, device_id: int) -> Optional[DeviceState]:
+        self.load()
+        st = self._states.get(device_id)
+        if st is None:
+            # Thiết bị mới đăng ký sau lần load
+            if self._is_missing(("id", device_id)):
+                return None
+            d = db_executor.run(self._fetch, device_id=device_id)
+            if not d:
+                self._mark_missing(("id", device_id))
+                return None
+            with self._lock:
+                st = self._states.get(device_id) or self._add(d)
+        return st
+
+    def get_by_uid(self, device_uid: str) -> Optional[DeviceState]:
+        self.load()
+        device_id = self._by_uid.get(device_uid)
+        if device_id is not None:
+            return self._states.get(device_id)
+        if self._is_missing(("uid", device_uid)):
+            return None
+        d = db_executor.run(self._fetch, device_uid=device_uid)
+        if not d:
+            self._mark_missing(("uid", device_uid))
+            return None
+        with self._lock:
+            return self._states.get(d.id) or self._add(d)
+
+    def refresh(self, device_id: int) -> None:
+        """Đọc lại các field tĩnh (name/type/slot...) sau khi thiết bị được sửa."""
+        d = db_executor.run(self._fetch, device_id=device_id)
+        with self._lock:
+            st = self._states.get(device_id)
+            if d is None:
+                self.remove(device_id)
+            elif st is None:
+                self._add(d)
+            else:
+                self._by_uid.pop(st.device_uid, None)
+                self._index_remove(st)
+                st.load_static(d)
+                self._by_uid[d.device_uid] = device_id
+                self._found(d)
+                self._index_add(st)
+                changes.bump()
+
+    def remove(self, device_id: int) -> None:
+        with self._lock:
+            st = self._states.pop(device_id, None)
+            if st is not None:
+                self._by_uid.pop(st.device_uid, None)
+                self._index_remove(st)
+                changes.bump()
+
+    def all(self) -> List[DeviceState]:
+        self.load()
+        return list(self._states.values())
+
+    # ========= TRANSITIONS =========
+    @staticmethod
+    def can_transition(current: str, new: str) -> bool:
+        return current == new or new in TRANSITIONS.get(current, ())
+
+    def transition(self, device_id: int, new: str, source: str) -> Optional[Tuple[str, str]]:
+        """
+        Đổi status (đã validate). Trả về (cũ, mới) nếu có thay đổi, None nếu giữ nguyên.
+        Raise InvalidTransition nếu không hợp lệ.
+        """
+        st = self.get(device_id)
+        if st is None:
+            raise InvalidTransition(f"device {device_id} not found")
+        with self._lock:
+            old = st.status
+            if old == new:
+                return None
+            if new not in TRANSITIONS.get(old, ()):
+                raise InvalidTransition(f"{old} → {new}")
+            self._index_discard(st, "status", old)
+            st.status = new
+            self._index["status"].setdefault(new, set()).add(device_id)
+            st.dirty = True
+            changes.bump()
+            self._journal.append({
+                "device_id": device_id,
+                "from_status": old,
+                "to_status": new,
+                "source": source,
+                "created_at": datetime.utcnow(),
+            })
+            journal_full = len(self._journal) >= self.journal_max
+        self._ensure_flusher()
+        if journal_full:
+            self.flush()
+        return old, new
+
+    def touch(self, device_id: int, source: str = "heartbeat") -> Optional[Tuple[str, str]]:
+        """Heartbeat: cập nhật last_seen; offline → online nếu cần."""
+        st = self.get(device_id)
+        if st is None:
+            return None
+        with self._lock:
+            st.last_seen = datetime.utcnow()
+            st.dirty = True
+            changes.bump(self.last_seen_resolution)  # đổi status → transition() bump ngay
+            changed = st.status == "offline"
+        self._ensure_flusher()
+        return self.transition(device_id, "online", source) if changed else None
+
+    def set_code_uploaded(self, device_id: int, uploaded: bool, at: Optional[datetime]) -> None:
+        with self._lock:
+            st = self._states.get(device_id)
+            if st is not None:
+                st.code_uploaded = uploaded
+                st.code_uploaded_at = at
+                changes.bump()
+
+    # ========= PERSISTENCE =========
+    def status_pending(self) -> bool:
+        """Có transition chưa ghi DB (status trong bảng devices đang cũ)."""
+        return bool(self._journal)
+
+    def flush(self, inline: bool = False) -> int:
+        """
+        Ghi snapshot thiết bị dirty + journal theo batch. Trả về số thiết bị đã ghi.
+        inline=True: ghi ngay ở thread hiện tại (lúc thoát, pool đã đóng).
+        """
+        with self._lock:
+            dirty = [st for st in self._states.values() if st.dirty]
+            rows = [{"id": st.device_id, "status": st.status, "last_seen": st.last_seen} for st in dirty]
+            journal, self._journal = self._journal, []
+            for st in dirty:
+                st.dirty = False
+        if not rows and not journal:
+            return 0
+        try:
+            if inline:
+                self._write_snapshot(rows, journal)
+            else:
+                db_executor.run(self._write_snapshot, rows, journal)
+        except Exception:
+            # Ghi lỗi → giữ lại để lần flush sau thử lại
+            with self._lock:
+                for st in dirty:
+                    st.dirty = True
+                self._journal = journal + self._journal
+            raise
+        return len(rows)
+
+    @staticmethod
+    def _write_snapshot(rows: List[Dict], journal: List[Dict]) -> None:
+        with SessionLocal() as db:
+            if rows:
+                db.execute(update(Device), rows)
+            if journal:
+                db.execute(insert(DeviceTransition), journal)
+            db.commit()
+
+    def _ensure_flusher(self) -> None:
+        if self._flusher_started:
+            return
+        with self._lock:
+            if self._flusher_started:
+                return
+            self._flusher_started = True
+        socketio.start_background_task(self._flush_loop)
+        atexit.register(self.flush, inline=True)
+
+    def _flush_loop(self) -> None:
+        while True:
+            socketio.sleep(self.snapshot_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"⚠️ device state flush failed: {e}")
+
+
+state_store = DeviceStateStore(Config.STATE_SNAPSHOT_INTERVAL, Config.STATE_JOURNAL_MAX,
+                               Config.STATE_NEGATIVE_TTL, Config.STATE_NEGATIVE_MAX,
+                               Config.STATE_LAST_SEEN_RESOLUTION)
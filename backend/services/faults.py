@@ -0,0 +1,159 @@
+# backend/services/faults.py
+"""
+Fault injection cho soak test / replay (CHỈ dùng khi test: cần FAULT_INJECTION=1).
+
+Spec: "điểm=xác_suất[:giá_trị]" cách nhau bằng dấu phẩy, vd
+    FAULT_SPEC="db.latency=0.2:0.05,db.error=0.01,emit.drop/device_command=0.05,ack.drop=0.1"
+
+Điểm inject:
+- db.latency=p:s        session execute chậm s giây (đĩa chậm)
+- db.commit_latency=p:s commit chậm s giây (fsync chậm)
+- db.error=p            execute lỗi OperationalError "database is locked" (tranh chấp lock)
+- emit.drop=p           bỏ emit Socket.IO (mất gói xuống thiết bị)
+- emit.latency=p:s      emit trễ s giây
+- ack.drop=p            thiết bị giả không ack command (soak.py)
+- ack.latency=p:s       thiết bị giả ack trễ s giây
+- reconnect.storm=p:s   cứ s giây, tỉ lệ p thiết bị giả cùng ngắt rồi connect lại
+
+"điểm/event" chỉ áp cho một event (emit.drop/device_command); luật cụ thể
+được ưu tiên hơn luật chung. Hook vào session factory (SessionLocal +
+ReadSessionLocal) và socketio.emit của instance dùng chung; uninstall() gỡ hết.
+"""
+import random
+import sqlite3
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, NamedTuple, Optional
+
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+
+from backend.config import Config
+from backend.extensions import socketio
+
+POINTS = frozenset({
+    "db.latency", "db.commit_latency", "db.error",
+    "emit.drop", "emit.latency",
+    "ack.drop", "ack.latency",
+    "reconnect.storm",
+})
+
+
+class FaultInjectionDisabled(RuntimeError):
+    """install() khi chưa bật FAULT_INJECTION."""
+
+
+class Fault(NamedTuple):
+    probability: float
+    value: float
+
+
+def parse_spec(spec: str) -> Dict[str, Fault]:
+    rules: Dict[str, Fault] = {}
+    for part in (spec or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        key, _, rhs = part.partition("=")
+        key = key.strip()
+        if key.split("/", 1)[0] not in POINTS:
+            raise ValueError(f"unknown fault point {key!r}")
+        prob, _, value = rhs.partition(":")
+        p = float(prob)
+        if not 0 <= p <= 1:
+            raise ValueError(f"{key}: probability must be in [0, 1]")
+        rules[key] = Fault(p, float(value) if value else 0.0)
+    return rules
+
+
+class FaultInjector:
+    def __init__(self, seed: Optional[int] = None) -> None:
+        self.rules: Dict[str, Fault] = {}
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+        self.injected: Counter = Counter()
+        self.installed = False
+        self._sessions = []
+
+    # ----- rules -----
+    def configure(self, spec: str) -> None:
+        self.rules = parse_spec(spec)
+
+    def rule(self, point: str, name: Optional[str] = None) -> Optional[Fault]:
+        if name is not None:
+            specific = self.rules.get(f"{point}/{name}")
+            if specific is not None:
+                return specific
+        return self.rules.get(point)
+
+    def hit(self, point: str, name: Optional[str] = None) -> Optional[Fault]:
+        """Luật của điểm nếu lần này bị inject (đếm vào injected), ngược lại None."""
+        fault = self.rule(point, name)
+        if fault is None or fault.probability <= 0:
+            return None
+        with self._rng_lock:
+            roll = self._rng.random()
+        if roll >= fault.probability:
+            return None
+        self.injected[point] += 1
+        return fault
+
+    # ----- hooks -----
+    def install(self, spec: Optional[str] = None) -> "FaultInjector":
+        if not Config.FAULT_INJECTION:
+            raise FaultInjectionDisabled("fault injection is test-only: set FAULT_INJECTION=1")
+        if spec is not None:
+            self.configure(spec)
+        if self.installed:
+            return self
+        from backend.database import ReadSessionLocal, SessionLocal
+
+        factories = {id(f): f for f in (SessionLocal.session_factory, ReadSessionLocal.session_factory)}
+        for factory in factories.values():
+            event.listen(factory, "do_orm_execute", self._on_execute)
+            event.listen(factory, "before_commit", self._on_commit)
+            self._sessions.append(factory)
+        socketio.emit = self._wrap_emit(type(socketio).emit.__get__(socketio))
+        self.installed = True
+        return self
+
+    def uninstall(self) -> None:
+        if not self.installed:
+            return
+        for factory in self._sessions:
+            event.remove(factory, "do_orm_execute", self._on_execute)
+            event.remove(factory, "before_commit", self._on_commit)
+        self._sessions = []
+        socketio.__dict__.pop("emit", None)
+        self.installed = False
+
+    def _on_execute(self, orm_execute_state) -> None:
+        fault = self.hit("db.latency")
+        if fault:
+            time.sleep(fault.value)
+        if self.hit("db.error"):
+            raise OperationalError(str(orm_execute_state.statement), None,
+                                   sqlite3.OperationalError("database is locked (injected)"))
+
+    def _on_commit(self, session) -> None:
+        fault = self.hit("db.commit_latency")
+        if fault:
+            time.sleep(fault.value)
+
+    def _wrap_emit(self, emit):
+        def faulty_emit(event_name, *args, **kwargs):
+            if self.hit("emit.drop", event_name):
+                return None
+            fault = self.hit("emit.latency", event_name)
+            if fault:
+                socketio.sleep(fault.value)
+            return emit(event_name, *args, **kwargs)
+        return faulty_emit
+
+    def stats(self) -> Dict[str, Any]:
+        return {"installed": self.installed, "rules": {k: list(v) for k, v in self.rules.items()},
+                "injected": dict(self.injected)}
+
+
+fault_injector = FaultInjector(Config.FAULT_SEED)
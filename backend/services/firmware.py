@@ -0,0 +1,385 @@
+# backend/services/firmware.py
+"""
+Phát firmware xuống thiết bị qua Socket.IO.
+
+- Upload stream thẳng xuống đĩa (đọc từng khối 64KB, vừa ghi vừa hash),
+  lưu content-addressed theo sha256: objects/ab/abcd... → cùng một sketch
+  upload nhiều lần / cho nhiều thiết bị chỉ có một bản trên đĩa
+- Thiết bị đã có bản cũ (current_sha) → gửi delta kiểu rsync (services/delta.py);
+  delta cache theo cặp (base, target) nên cả lớp flash cùng sketch chỉ tính một lần.
+  Delta không nhỏ hơn đáng kể (FIRMWARE_DELTA_MIN_SAVING) → gửi full
+- compute_delta (Python thuần, giữ GIL) chạy ở process pool riêng
+  (FIRMWARE_DELTA_WORKERS), không chiếm db_executor; pool đầy / quá
+  FIRMWARE_DELTA_TIMEOUT → gửi full thay vì chờ
+- Chunk do thiết bị kéo (`firmware_chunk`, trả bytes qua ack) → resume được:
+  thiết bị giữ file .part, kết nối lại thì xin tiếp từ chunk đang dở
+- Thiết bị báo `firmware_verified` với sha256 khớp target → current_sha mới,
+  Device.code_uploaded = True
+
+Kích thước delta / full và dedup: benchmarks/firmware.py.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import datetime
+from typing import Any, BinaryIO, Dict, Optional, Tuple
+
+from sqlalchemy import select, update
+
+from backend.config import Config
+from backend.database import SessionLocal, read_your_writes, session_for
+from backend.extensions import socketio
+from backend.models import Device, DeviceFirmware, FirmwareArtifact
+from backend.services.connection_registry import DeviceConnection, connection_registry
+from backend.services.db_executor import DBBusy, db_executor
+from backend.services.delta import compute_delta
+from backend.services.device_state import state_store
+
+_READ_SIZE = 64 * 1024
+_PROGRESS_EVERY = 16  # ghi tiến độ xuống DB mỗi N chunk
+
+
+class FirmwareError(ValueError):
+    """Artifact không hợp lệ / không tồn tại."""
+
+
+class FirmwareTooLarge(FirmwareError):
+    pass
+
+
+# ========= CONTENT-ADDRESSED STORE =========
+class FirmwareStore:
+    def __init__(self, root: str, chunk_size: int, delta_block: int,
+                 delta_max_size: int, delta_min_saving: float, delta_workers: int = 1,
+                 delta_max_pending: int = 4, delta_timeout: float = 60.0) -> None:
+        self.root = root
+        self.chunk_size = chunk_size
+        self.delta_block = delta_block
+        self.delta_max_size = delta_max_size
+        self.delta_min_saving = delta_min_saving
+        self.delta_workers = delta_workers
+        self.delta_max_pending = delta_max_pending
+        self.delta_timeout = delta_timeout
+        self._delta_pool: Optional[ProcessPoolExecutor] = None
+        self._delta_jobs: Dict[Tuple[str, str], Future] = {}  # cặp đang tính → mọi thiết bị chờ chung
+        self._jobs_guard = threading.Lock()
+        self._ready = False
+
+    def _ensure_dirs(self) -> None:
+        if not self._ready:
+            for sub in ("objects", "deltas", "tmp"):
+                os.makedirs(os.path.join(self.root, sub), exist_ok=True)
+            self._ready = True
+
+    def object_path(self, sha: str) -> str:
+        return os.path.join(self.root, "objects", sha[:2], sha)
+
+    def delta_path(self, base: str, target: str) -> str:
+        return os.path.join(self.root, "deltas", f"{base}-{target}")
+
+    def has(self, sha: str) -> bool:
+        return os.path.isfile(self.object_path(sha))
+
+    def put_stream(self, stream: BinaryIO, max_size: int) -> Tuple[str, int, bool]:
+        """Ghi stream vào store. Trả về (sha256, size, created); created=False nếu đã có (dedup)."""
+        self._ensure_dirs()
+        h = hashlib.sha256()
+        size = 0
+        fd, tmp = tempfile.mkstemp(dir=os.path.join(self.root, "tmp"))
+        try:
+            with os.fdopen(fd, "wb") as out:
+                while True:
+                    buf = stream.read(_READ_SIZE)
+                    if not buf:
+                        break
+                    size += len(buf)
+                    if size > max_size:
+                        raise FirmwareTooLarge(f"artifact exceeds {max_size} bytes")
+                    h.update(buf)
+                    out.write(buf)
+            sha = h.hexdigest()
+            path = self.object_path(sha)
+            if os.path.exists(path):
+                os.remove(tmp)
+                return sha, size, False
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp, path)
+            return sha, size, True
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def _delta_job(self, base: str, target: str, path: str) -> Optional[Future]:
+        """Future tính delta của cặp (dùng chung nếu đang tính); pool đầy → None."""
+        key = (base, target)
+        with self._jobs_guard:
+            fut = self._delta_jobs.get(key)
+            if fut is not None:
+                return fut
+            if len(self._delta_jobs) >= self.delta_max_pending:
+                return None
+            if self._delta_pool is None:
+                self._delta_pool = ProcessPoolExecutor(max_workers=self.delta_workers)
+            fut = self._delta_pool.submit(compute_delta, self.object_path(base), self.object_path(target),
+                                          path, self.delta_block)
+            self._delta_jobs[key] = fut
+        fut.add_done_callback(lambda _: self._forget_job(key))
+        return fut
+
+    def _forget_job(self, key: Tuple[str, str]) -> None:
+        with self._jobs_guard:
+            self._delta_jobs.pop(key, None)
+
+    def _wait(self, fut: Future) -> bool:
+        """Chờ future bằng socketio.sleep (không chặn event loop); quá delta_timeout → False."""
+        sleep = socketio.sleep if socketio.server is not None else time.sleep
+        deadline = time.monotonic() + self.delta_timeout
+        delay = 0.005
+        while not fut.done():
+            if time.monotonic() > deadline:
+                return False  # vẫn tính tiếp, file delta dùng được cho lần offer sau
+            sleep(delay)
+            delay = min(delay * 2, 0.1)
+        fut.result()
+        return True
+
+    def payload_for(self, base: Optional[str], target: str) -> Tuple[str, str, int]:
+        """(encoding "delta"|"full", path, size) của thứ cần gửi để thiết bị có `target`."""
+        full = self.object_path(target)
+        if not os.path.isfile(full):
+            raise FirmwareError(f"unknown artifact {target}")
+        full_size = os.path.getsize(full)
+        if not base or base == target or not self.has(base) or full_size > self.delta_max_size:
+            return "full", full, full_size
+
+        self._ensure_dirs()
+        path = self.delta_path(base, target)
+        if not os.path.exists(path):  # delta ghi atomic (os.replace) → có file là dùng được
+            fut = self._delta_job(base, target, path)
+            if fut is None or not self._wait(fut):
+                return "full", full, full_size  # pool bận → gửi full, không giữ thiết bị chờ
+        size = os.path.getsize(path)
+        if size <= full_size * (1 - self.delta_min_saving):
+            return "delta", path, size
+        return "full", full, full_size
+
+    def read_chunk(self, path: str, index: int) -> bytes:
+        with open(path, "rb") as f:
+            f.seek(index * self.chunk_size)
+            return f.read(self.chunk_size)
+
+
+# ========= DISTRIBUTION =========
+class _Transfer:
+    __slots__ = ("device_id", "sid", "target", "base", "encoding", "path", "size", "chunks", "sent")
+
+    def __init__(self, device_id: int, sid: str, target: str, base: Optional[str],
+                 encoding: str, path: str, size: int, chunk_size: int) -> None:
+        self.device_id = device_id
+        self.sid = sid
+        self.target = target
+        self.base = base
+        self.encoding = encoding
+        self.path = path
+        self.size = size
+        self.chunks = max(1, -(-size // chunk_size))
+        self.sent = 0
+
+
+class FirmwareService:
+    def __init__(self, store: FirmwareStore) -> None:
+        self.store = store
+        self.connections = connection_registry
+        self._transfers: Dict[int, _Transfer] = {}
+        self._lock = threading.Lock()
+        self.stats = {"uploads": 0, "deduplicated": 0, "offers_full": 0, "offers_delta": 0,
+                      "chunks": 0, "bytes": 0, "verified": 0, "failed": 0}
+
+    # ---- upload / deploy (HTTP) ----
+    def register_artifact(self, stream: BinaryIO, filename: str, user_id: Optional[int]) -> Tuple[Dict[str, Any], bool]:
+        sha, size, created = self.store.put_stream(stream, Config.FIRMWARE_MAX_SIZE)
+        with SessionLocal() as db:
+            art = db.get(FirmwareArtifact, sha)
+            if art is None:
+                art = FirmwareArtifact(sha256=sha, size=size, filename=filename, uploaded_by=user_id)
+                db.add(art)
+                db.commit()
+                created = True
+            self.stats["uploads" if created else "deduplicated"] += 1
+            return {"sha256": sha, "size": size, "filename": art.filename}, created
+
+    def deploy(self, device_id: int, sha: str) -> Dict[str, Any]:
+        with SessionLocal() as db:
+            if db.get(FirmwareArtifact, sha) is None or not self.store.has(sha):
+                raise FirmwareError(f"unknown artifact {sha}")
+            row = db.get(DeviceFirmware, device_id)
+            if row is None:
+                row = DeviceFirmware(device_id=device_id)
+                db.add(row)
+            row.target_sha = sha
+            row.status = "verified" if row.current_sha == sha else "pending"
+            row.chunks_sent = row.chunks_total = 0
+            row.encoding = row.error = None
+            db.commit()
+            pending = row.status == "pending"
+        with self._lock:
+            self._transfers.pop(device_id, None)
+        conn = self.connections.by_device_id(device_id)
+        if pending and conn is not None:
+            socketio.start_background_task(self.offer, conn)
+        with read_your_writes():
+            return self.status(device_id)
+
+    def status(self, device_id: int) -> Dict[str, Any]:
+        with session_for("read") as db:
+            row = db.get(DeviceFirmware, device_id)
+        if row is None:
+            return {"device_id": device_id, "status": "idle", "current_sha": None, "target_sha": None}
+        out = {
+            "device_id": device_id,
+            "status": row.status,
+            "current_sha": row.current_sha,
+            "target_sha": row.target_sha,
+            "encoding": row.encoding,
+            "chunks_sent": row.chunks_sent,
+            "chunks_total": row.chunks_total,
+            "error": row.error,
+            "updated_at": row.updated_at,
+        }
+        t = self._transfers.get(device_id)
+        if t is not None and t.target == row.target_sha:
+            out["chunks_sent"] = max(out["chunks_sent"], t.sent)  # tiến độ live, chưa kịp ghi DB
+        return out
+
+    # ---- socket side ----
+    @staticmethod
+    def _load_target(device_id: int) -> Optional[Tuple[Optional[str], str, str]]:
+        with SessionLocal() as db:
+            row = db.execute(
+                select(DeviceFirmware.current_sha, DeviceFirmware.target_sha, DeviceFirmware.status)
+                .where(DeviceFirmware.device_id == device_id)
+            ).first()
+        if row is None or not row.target_sha or row.status not in ("pending", "transferring"):
+            return None
+        return tuple(row)
+
+    @staticmethod
+    def _save_progress(device_id: int, **values: Any) -> None:
+        with SessionLocal() as db:
+            db.execute(update(DeviceFirmware).where(DeviceFirmware.device_id == device_id).values(**values))
+            db.commit()
+
+    def resume(self, conn: DeviceConnection) -> None:
+        """Gọi khi thiết bị kết nối: có bản đang chờ / dở dang → offer lại."""
+        try:
+            if db_executor.run(self._load_target, conn.device_id) is not None:
+                self.offer(conn)
+        except DBBusy:
+            print(f"⚠️ firmware resume for {conn.device_uid} skipped: DB busy")
+
+    def offer(self, conn: DeviceConnection, force_full: bool = False) -> bool:
+        target = db_executor.run(self._load_target, conn.device_id)
+        if target is None:
+            return False
+        current, sha, _ = target
+        base = None if force_full else current
+        try:
+            # Delta tính ở process pool riêng của store; db_executor chỉ dành cho DB
+            encoding, path, size = self.store.payload_for(base, sha)
+        except FirmwareError as e:
+            db_executor.run(self._save_progress, conn.device_id, status="failed", error=str(e)[:255])
+            return False
+        t = _Transfer(conn.device_id, conn.sid, sha, base if encoding == "delta" else None,
+                      encoding, path, size, self.store.chunk_size)
+        with self._lock:
+            self._transfers[conn.device_id] = t
+        db_executor.run(self._save_progress, conn.device_id, status="transferring",
+                        encoding=encoding, chunks_total=t.chunks, error=None)
+        self.stats[f"offers_{encoding}"] += 1
+        if self.connections.by_sid(conn.sid) is not conn:
+            return False  # rớt kết nối trong lúc tính delta → lần connect sau offer lại
+        socketio.emit("firmware_offer", {
+            "sha256": sha,
+            "encoding": encoding,
+            "base": t.base,
+            "size": size,
+            "chunk_size": self.store.chunk_size,
+            "chunks": t.chunks,
+        }, to=conn.sid)
+        return True
+
+    def serve_chunk(self, conn: DeviceConnection, data: Dict[str, Any]) -> Dict[str, Any]:
+        t = self._transfers.get(conn.device_id)
+        if t is None or t.sid != conn.sid or t.target != data.get("sha256"):
+            return {"ok": False, "error": "no_transfer"}
+        try:
+            index = int(data.get("index", -1))
+        except (TypeError, ValueError):
+            index = -1
+        if not 0 <= index < t.chunks:
+            return {"ok": False, "error": "bad_index"}
+        chunk = self.store.read_chunk(t.path, index)
+        self.stats["chunks"] += 1
+        self.stats["bytes"] += len(chunk)
+        if index + 1 > t.sent:
+            t.sent = index + 1
+            if t.sent % _PROGRESS_EVERY == 0:
+                try:
+                    db_executor.run(self._save_progress, t.device_id, chunks_sent=t.sent)
+                except DBBusy:
+                    pass  # chỉ là tiến độ, lần sau ghi tiếp
+        return {"ok": True, "index": index, "data": chunk}
+
+    @staticmethod
+    def _verify_in_db(device_id: int, sha: str, at: datetime) -> bool:
+        with SessionLocal() as db:
+            res = db.execute(
+                update(DeviceFirmware)
+                .where(DeviceFirmware.device_id == device_id, DeviceFirmware.target_sha == sha)
+                .values(current_sha=sha, status="verified", chunks_sent=DeviceFirmware.chunks_total, error=None)
+            )
+            if res.rowcount == 0:
+                return False
+            db.execute(update(Device).where(Device.id == device_id).values(code_uploaded=True, code_uploaded_at=at))
+            db.commit()
+            return True
+
+    def verified(self, conn: DeviceConnection, data: Dict[str, Any]) -> bool:
+        """Thiết bị báo sha256 của bản đã dựng xong; khớp target → code_uploaded."""
+        sha = str(data.get("sha256") or "")
+        at = datetime.utcnow()
+        if not db_executor.run(self._verify_in_db, conn.device_id, sha, at):
+            return False
+        with self._lock:
+            self._transfers.pop(conn.device_id, None)
+        state_store.set_code_uploaded(conn.device_id, True, at)
+        self.stats["verified"] += 1
+        return True
+
+    def failed(self, conn: DeviceConnection, data: Dict[str, Any]) -> None:
+        reason = str(data.get("reason") or "unknown")[:255]
+        t = self._transfers.get(conn.device_id)
+        if t is not None and t.encoding == "delta" and reason in ("base_mismatch", "checksum_mismatch"):
+            # Bản cũ trên thiết bị không như server nghĩ → gửi full
+            socketio.start_background_task(self.offer, conn, True)
+            return
+        with self._lock:
+            self._transfers.pop(conn.device_id, None)
+        self.stats["failed"] += 1
+        db_executor.run(self._save_progress, conn.device_id, status="failed", error=reason)
+
+
+firmware_service = FirmwareService(FirmwareStore(
+    Config.FIRMWARE_DIR,
+    chunk_size=Config.FIRMWARE_CHUNK_SIZE,
+    delta_block=Config.FIRMWARE_DELTA_BLOCK,
+    delta_max_size=Config.FIRMWARE_DELTA_MAX_SIZE,
+    delta_min_saving=Config.FIRMWARE_DELTA_MIN_SAVING,
+    delta_workers=Config.FIRMWARE_DELTA_WORKERS,
+    delta_max_pending=Config.FIRMWARE_DELTA_MAX_PENDING,
+    delta_timeout=Config.FIRMWARE_DELTA_TIMEOUT,
+))
@@ -0,0 +1,125 @@
+# backend/services/heartbeat_log.py
+"""
+Log heartbeat dạng cột cho analytics (không ghi DB: 10k thiết bị × 1 heartbeat/3s).
+
+- record() chỉ append vào 2 array stdlib (device_id int32, ts float64) → rẻ,
+  không kéo numpy vào hot path
+- Đầy buffer hoặc mỗi ANALYTICS_SPILL_INTERVAL giây → ghi một segment:
+  hb-<ts đầu>-<ts cuối>-<n>.seg = int32[n] rồi float64[n] (byte order của máy),
+  analytics đọc bằng np.memmap; segment cũ hơn ANALYTICS_RETENTION_DAYS bị xoá
+"""
+import atexit
+import os
+import threading
+import time
+from array import array
+from typing import List, Tuple
+
+from backend.config import Config
+from backend.extensions import socketio
+
+
+class HeartbeatLog:
+    def __init__(self, directory: str, buffer_size: int, spill_interval: float, retention_days: float) -> None:
+        self.directory = directory
+        self.buffer_size = buffer_size
+        self.spill_interval = spill_interval
+        self.retention = retention_days * 86400
+        self._dev = array("i")
+        self._ts = array("d")
+        self._lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+        self._spiller_started = False
+        self.recorded = 0
+        self.spilled = 0
+
+    def record(self, device_id: int, ts: float = None) -> None:
+        with self._lock:
+            self._dev.append(device_id)
+            self._ts.append(time.time() if ts is None else ts)
+            self.recorded += 1
+            full = len(self._dev) >= self.buffer_size
+        self._ensure_spiller()
+        if full:
+            socketio.start_background_task(self.spill)
+
+    def snapshot(self) -> Tuple[bytes, bytes]:
+        """Bản copy buffer hiện tại (chưa spill) dạng bytes."""
+        with self._lock:
+            return self._dev.tobytes(), self._ts.tobytes()
+
+    def spill(self) -> int:
+        with self._lock:
+            if not self._dev:
+                return 0
+            dev, ts = self._dev, self._ts
+            self._dev, self._ts = array("i"), array("d")
+        with self._spill_lock:
+            os.makedirs(self.directory, exist_ok=True)
+            n = len(dev)
+            name = f"hb-{int(min(ts))}-{int(max(ts)) + 1}-{n}.seg"
+            tmp = os.path.join(self.directory, name + ".tmp")
+            with open(tmp, "wb") as f:
+                dev.tofile(f)
+                ts.tofile(f)
+            os.replace(tmp, os.path.join(self.directory, name))
+            self.spilled += n
+            self._prune()
+        return n
+
+    def _prune(self) -> None:
+        cutoff = time.time() - self.retention
+        for name, _, end, _ in self._list():
+            if end < cutoff:
+                os.remove(os.path.join(self.directory, name))
+
+    def _list(self) -> List[Tuple[str, float, float, int]]:
+        if not os.path.isdir(self.directory):
+            return []
+        out = []
+        for name in os.listdir(self.directory):
+            if name.startswith("hb-") and name.endswith(".seg"):
+                _, start, end, n = name[:-4].split("-")
+                out.append((name, float(start), float(end), int(n)))
+        return out
+
+    def segments(self, t0: float, t1: float) -> List[Tuple[str, int]]:
+        """(path, n) của các segment có dữ liệu giao [t0, t1]."""
+        return [
+            (os.path.join(self.directory, name), n)
+            for name, start, end, n in sorted(self._list(), key=lambda s: s[1])
+            if end >= t0 and start <= t1
+        ]
+
+    def _ensure_spiller(self) -> None:
+        if self._spiller_started:
+            return
+        with self._lock:
+            if self._spiller_started:
+                return
+            self._spiller_started = True
+        socketio.start_background_task(self._spill_loop)
+        atexit.register(self.spill)
+
+    def _spill_loop(self) -> None:
+        while True:
+            socketio.sleep(self.spill_interval)
+            try:
+                self.spill()
+            except Exception as e:
+                print(f"⚠️ heartbeat log spill failed: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            buffered = len(self._dev)
+        segs = self._list()
+        return {"recorded": self.recorded, "buffered": buffered, "spilled": self.spilled,
+                "segments": len(segs), "segment_rows": sum(s[3] for s in segs)}
+
+
+heartbeat_log = HeartbeatLog(
+    Config.ANALYTICS_DIR,
+    buffer_size=Config.ANALYTICS_HEARTBEAT_BUFFER,
+    spill_interval=Config.ANALYTICS_SPILL_INTERVAL,
+    retention_days=Config.ANALYTICS_RETENTION_DAYS,
+)
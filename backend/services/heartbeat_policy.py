@@ -0,0 +1,144 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+
+class _DeviceBeat:
+    __slots__ = ("last", "assigned", "multiplier", "stable_count")
+
+    def __init__(self, now: float) -> None:
+        self.last = now
+        self.assigned = 0.0
+        self.multiplier = 1.0
+        self.stable_count = 0
+
+
+class HeartbeatPolicy:
+    """
+    Tính heartbeat interval cho từng thiết bị.
+
+    Interval cơ sở = fleet_size / rate_budget (tổng heartbeat/s không vượt budget),
+    giãn thêm khi server đang nhận nhiều hơn budget, kẹp trong
+    [min_interval, (watchdog_timeout - grace) / 3] và làm tròn theo TDMA slot.
+    Thiết bị gửi trễ → interval ngắn lại; thiết bị ổn định → interval dài ra.
+    """
+
+    LATE_RATIO = 1.5        # gap > 1.5 * interval → trễ
+    STABLE_RATIO = 1.2
+    STABLE_BEATS = 10       # số heartbeat đúng hạn liên tiếp trước khi giãn interval
+    MIN_MULTIPLIER = 0.5
+    MAX_MULTIPLIER = 2.0
+    CHANGE_RATIO = 0.1      # chỉ push interval mới khi lệch > 10%
+
+    def __init__(
+        self,
+        rate_budget: float,
+        min_interval: float,
+        max_interval: float,
+        watchdog_timeout: float,
+        watchdog_grace: float,
+        slot_seconds: float,
+    ) -> None:
+        self.rate_budget = max(rate_budget, 0.001)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.watchdog_timeout = watchdog_timeout
+        self.watchdog_grace = watchdog_grace
+        self.slot_seconds = slot_seconds
+
+        self._beats: Dict[str, _DeviceBeat] = {}
+        # uid → lần heartbeat cuối, thứ tự theo thời gian: cắt đầu khi quá watchdog_timeout
+        self._recent: "OrderedDict[str, float]" = OrderedDict()
+        self._gap: Optional[float] = None  # EWMA khoảng cách giữa 2 heartbeat liên tiếp (toàn hệ thống)
+        self._last_arrival: Optional[float] = None
+        self._lock = threading.Lock()
+
+    # ========= FLEET / LOAD =========
+    def fleet_size(self, now: Optional[float] = None) -> int:
+        """Số thiết bị có heartbeat trong khoảng watchdog_timeout gần nhất (amortized O(1))."""
+        now = now if now is not None else time.monotonic()
+        horizon = now - self.watchdog_timeout
+        while self._recent:
+            uid, last = next(iter(self._recent.items()))
+            if last >= horizon:
+                break
+            del self._recent[uid]
+        return len(self._recent)
+
+    @property
+    def rate(self) -> float:
+        """Heartbeat/s toàn hệ thống = 1 / EWMA(gap): gap ~0 lẻ tẻ không thổi phồng như EWMA(1/gap)."""
+        return 0.0 if self._gap is None else 1.0 / max(self._gap, 1e-6)
+
+    def load(self) -> float:
+        """Tỉ lệ heartbeat/s hiện tại so với budget (> 1 nghĩa là quá tải)."""
+        return self.rate / self.rate_budget
+
+    def _upper_bound(self) -> float:
+        # Watchdog cần nhận ít nhất ~3 heartbeat trước khi timeout
+        wd_bound = (self.watchdog_timeout - self.watchdog_grace) / 3
+        return max(self.min_interval, min(self.max_interval, wd_bound))
+
+    def _clamp_align(self, interval: float) -> float:
+        hi = self._upper_bound()
+        interval = min(max(interval, self.min_interval), hi)
+        if self.slot_seconds > 0 and self.slot_seconds <= hi:
+            slots = max(1, round(interval / self.slot_seconds))
+            if slots * self.slot_seconds > hi:
+                slots = max(1, math.floor(hi / self.slot_seconds))
+            interval = max(slots * self.slot_seconds, self.min_interval)
+        return round(interval, 1)
+
+    def base_interval(self, now: Optional[float] = None) -> float:
+        interval = max(1, self.fleet_size(now)) / self.rate_budget
+        interval *= max(1.0, self.load())
+        return self._clamp_align(interval)
+
+    # ========= PER DEVICE =========
+    def interval_for(self, device_uid: str) -> float:
+        with self._lock:
+            b = self._beats.get(device_uid)
+            mult = b.multiplier if b else 1.0
+            return self._clamp_align(self.base_interval() * mult)
+
+    def observe(self, device_uid: str, now: Optional[float] = None) -> Optional[float]:
+        """
+        Ghi nhận một heartbeat. Trả về interval mới nếu cần push xuống thiết bị
+        (heartbeat đầu tiên, hoặc interval lệch quá CHANGE_RATIO), ngược lại None.
+        """
+        now = now if now is not None else time.monotonic()
+        with self._lock:
+            if self._last_arrival is not None:
+                gap = max(now - self._last_arrival, 0.0)
+                self._gap = gap if self._gap is None else 0.9 * self._gap + 0.1 * gap
+            self._last_arrival = now
+            self._recent.pop(device_uid, None)
+            self._recent[device_uid] = now
+
+            b = self._beats.get(device_uid)
+            if b is None:
+                b = self._beats[device_uid] = _DeviceBeat(now)
+            elif b.assigned:
+                ratio = (now - b.last) / b.assigned
+                if ratio > self.LATE_RATIO:
+                    b.multiplier = max(self.MIN_MULTIPLIER, b.multiplier * 0.5)
+                    b.stable_count = 0
+                elif ratio <= self.STABLE_RATIO:
+                    b.stable_count += 1
+                    if b.stable_count >= self.STABLE_BEATS:
+                        b.multiplier = min(self.MAX_MULTIPLIER, b.multiplier * 1.25)
+                        b.stable_count = 0
+            b.last = now
+
+            interval = self._clamp_align(self.base_interval(now) * b.multiplier)
+            if b.assigned and abs(interval - b.assigned) <= self.CHANGE_RATIO * b.assigned:
+                return None
+            b.assigned = interval
+            return interval
+
+    def forget(self, device_uid: str) -> None:
+        with self._lock:
+            self._beats.pop(device_uid, None)
+            self._recent.pop(device_uid, None)
@@ -0,0 +1,143 @@
+# backend/services/response_cache.py
+"""
+Cache response theo version của ChangeTracker cho các endpoint polling.
+
+- ETag = version ("<boot>-<counter>"), Last-Modified = lần đổi gần nhất
+- If-None-Match / If-Modified-Since khớp → 304, không render, không query DB
+- Body (và bản gzip) được giữ theo version: N dashboard cùng poll chỉ tốn
+  một lần render; render được khoá single-flight theo từng cache
+- conditional(): endpoint có tham số (vd GET /devices?cursor=...) → ETag =
+  version + hash(key), chỉ trả 304, không giữ body
+"""
+import gzip
+import hashlib
+import threading
+from typing import Callable, Dict, Optional
+
+from flask import Request, Response
+from werkzeug.http import http_date, parse_date
+
+from backend.services.change_tracker import ChangeTracker, changes
+
+
+class _Entry:
+    __slots__ = ("version", "modified", "body", "gzipped")
+
+    def __init__(self, version: str, modified: float, body: bytes) -> None:
+        self.version = version
+        self.modified = modified
+        self.body = body
+        self.gzipped: Optional[bytes] = None
+
+
+class VersionedResponseCache:
+    MIN_GZIP_SIZE = 1024  # body nhỏ hơn không đáng nén
+    RENDER_ATTEMPTS = 3
+
+    def __init__(self, tracker: ChangeTracker = changes, mimetype: str = "application/json") -> None:
+        self.tracker = tracker
+        self.mimetype = mimetype
+        self._entry: Optional[_Entry] = None
+        self._render_lock = threading.Lock()
+        self.renders = 0
+        self.hits = 0
+        self.not_modified = 0
+
+    def _not_modified(self, request: Request, version: str, modified: float) -> bool:
+        inm = request.headers.get("If-None-Match")
+        if inm:
+            tags = {t.strip().removeprefix("W/").strip('"') for t in inm.split(",")}
+            return "*" in tags or version in tags or f"{version}-gz" in tags
+        ims = parse_date(request.headers.get("If-Modified-Since"))
+        return ims is not None and int(modified) <= ims.timestamp()
+
+    def _get_entry(self, render: Callable[[], str]) -> _Entry:
+        version, modified = self.tracker.current()
+        entry = self._entry
+        if entry is not None and entry.version == version:
+            self.hits += 1
+            return entry
+        with self._render_lock:
+            for _ in range(self.RENDER_ATTEMPTS):
+                version, modified = self.tracker.current()
+                entry = self._entry
+                if entry is not None and entry.version == version:
+                    self.hits += 1
+                    return entry
+                body = render()
+                self.renders += 1
+                entry = _Entry(version, modified, body.encode() if isinstance(body, str) else body)
+                # version đổi trong lúc render → body có thể mới hơn version, render lại
+                if self.tracker.current()[0] == version:
+                    self._entry = entry
+                    return entry
+            return entry  # vẫn đổi liên tục: trả bản cuối, ETag cũ → client lấy lại lần sau
+
+    def respond(self, request: Request, render: Callable[[], str]) -> Response:
+        version, modified = self.tracker.current()
+        if self._not_modified(request, version, modified):
+            self.not_modified += 1
+            return self._headers(Response(status=304), version, modified, gz=False)
+
+        entry = self._get_entry(render)
+        use_gzip = "gzip" in request.headers.get("Accept-Encoding", "") and len(entry.body) >= self.MIN_GZIP_SIZE
+        if use_gzip:
+            if entry.gzipped is None:
+                entry.gzipped = gzip.compress(entry.body, compresslevel=5)
+            resp = Response(entry.gzipped, mimetype=self.mimetype)
+            resp.headers["Content-Encoding"] = "gzip"
+        else:
+            resp = Response(entry.body, mimetype=self.mimetype)
+        return self._headers(resp, entry.version, entry.modified, gz=use_gzip)
+
+    @staticmethod
+    def _headers(resp: Response, version: str, modified: float, gz: bool) -> Response:
+        # Strong ETag khác nhau theo encoding (RFC 9110)
+        resp.headers["ETag"] = f'"{version}-gz"' if gz else f'"{version}"'
+        resp.headers["Last-Modified"] = http_date(modified)
+        resp.headers["Cache-Control"] = "private, no-cache"
+        resp.headers["Vary"] = "Accept-Encoding, Cookie"
+        return resp
+
+    def stats(self) -> Dict[str, int]:
+        return {"renders": self.renders, "hits": self.hits, "not_modified": self.not_modified}
+
+
+_conditional_stats = {"renders": 0, "not_modified": 0}
+
+
+def conditional(request: Request, key: str, render: Callable[[], Response],
+                tracker: ChangeTracker = changes) -> Response:
+    """
+    ETag "<version>-<hash(key)>" (key = filter / cursor / scope của request):
+    khớp If-None-Match → 304, không render. Version đổi trong lúc render (vd
+    lần đầu nạp state store) → render lại, như VersionedResponseCache.
+    """
+    digest = hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+    version, _ = tracker.current()
+    inm = request.headers.get("If-None-Match")
+    if inm and f"{version}-{digest}" in {t.strip().removeprefix("W/").strip('"') for t in inm.split(",")}:
+        _conditional_stats["not_modified"] += 1
+        resp = Response(status=304)
+    else:
+        for _ in range(VersionedResponseCache.RENDER_ATTEMPTS):
+            _conditional_stats["renders"] += 1
+            resp = render()
+            now, _ = tracker.current()
+            if now == version:
+                break
+            tag, version = version, now
+        else:
+            version = tag  # vẫn đổi liên tục: ETag cũ hơn body → client tải lại lần sau
+    resp.headers["ETag"] = f'"{version}-{digest}"'
+    resp.headers["Cache-Control"] = "private, no-cache"
+    resp.headers["Vary"] = "Cookie, Authorization"
+    return resp
+
+
+def conditional_stats() -> Dict[str, int]:
+    return dict(_conditional_stats)
+
+
+status_cache = VersionedResponseCache()
+status_summary_cache = VersionedResponseCache()  # /dashboard/status?devices=0
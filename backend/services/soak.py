@@ -0,0 +1,462 @@
+# backend/services/soak.py
+"""
+Soak test: server thật (in-process, threading) + thiết bị giả + fault injection,
+chạy hàng giờ, lấy mẫu định kỳ rồi FAIL nếu có chỉ số tăng không giới hạn.
+
+    python -m backend.services.soak --duration 2h --devices 50 \\
+        --faults "db.latency=0.1:0.02,db.error=0.005,emit.drop=0.02,ack.drop=0.05,reconnect.storm=0.3:300"
+
+- DB SQLite tạm, tự bật FAULT_INJECTION (chỉ trong process này)
+- Thiết bị giả: socketio.AsyncClient, heartbeat bằng call() (đo RTT), ack
+  command (ack.drop / ack.latency), reconnect storm theo spec
+- Driver queue command ngẫu nhiên qua dm.queue_command (quota, coalescing thật)
+- Mỗi --sample giây: bộ nhớ (tracemalloc + RSS), session còn mở / đang giữ
+  transaction, connection pool đang checkout, hàng đợi scheduler, command
+  pending/sent trong DB, in-flight của DB executor, p99 heartbeat / dispatch
+- Exception không bắt trong background thread (vd lỗi DB giả lập làm chết
+  replay_pending) được đếm theo (thread, loại lỗi) trong report
+- Phán định: bỏ --warmup đầu, chia phần còn lại làm ba; chỉ số bị coi là
+  tăng không giới hạn khi median ba đoạn tăng dần VÀ mức tăng vượt ngưỡng
+  (tuyệt đối + tương đối) của chỉ số đó → exit code 1, kèm top dòng code
+  (backend/) cấp phát tăng nhiều nhất theo tracemalloc
+"""
+import argparse
+import asyncio
+import contextlib
+import gc
+import json
+import os
+import random
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+# chỉ số: (ngưỡng tăng tuyệt đối, ngưỡng tăng tương đối)
+GROWTH_LIMITS = {
+    "traced_kb": (2048, 0.10),
+    "rss_kb": (16384, 0.10),
+    "sessions_alive": (4, 0.0),
+    "sessions_in_tx": (2, 0.0),
+    "pool_checked_out": (2, 0.0),
+    "scheduler_queued": (50, 0.5),
+    "outstanding_commands": (50, 0.5),
+    "db_in_flight": (4, 0.0),
+    "hb_p99_ms": (25, 0.5),
+    "dispatch_p99_ms": (100, 0.5),
+}
+COMMANDS = ("LED_ON", "LED_OFF", "start", "stop")
+
+
+def _seconds(value: str) -> float:
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    value = value.strip().lower()
+    return float(value[:-1]) * units[value[-1]] if value[-1] in units else float(value)
+
+
+def _p99_ms(samples: List[float]) -> Optional[float]:
+    if not samples:
+        return None
+    s = sorted(samples)
+    return round(s[min(len(s) - 1, int(0.99 * len(s)))] * 1000, 3)
+
+
+def _rss_kb() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+# ========= VERDICT =========
+def unbounded(values: List[float], abs_limit: float, rel_limit: float) -> bool:
+    """Median ba đoạn tăng dần và tổng mức tăng vượt cả hai ngưỡng (cần >= 4 mẫu / đoạn)."""
+    values = [v for v in values if v is not None]
+    if len(values) < 12:
+        return False
+    k = len(values) // 3
+    m1 = statistics.median(values[:k])
+    m2 = statistics.median(values[k:2 * k])
+    m3 = statistics.median(values[2 * k:])
+    growth = m3 - m1
+    return m3 > m2 > m1 and growth > abs_limit and (m1 <= 0 or growth / m1 > rel_limit)
+
+
+def slope_per_hour(ts: List[float], values: List[Optional[float]]) -> Optional[float]:
+    pts = [(t, v) for t, v in zip(ts, values) if v is not None]
+    if len(pts) < 2:
+        return None
+    mt = sum(t for t, _ in pts) / len(pts)
+    mv = sum(v for _, v in pts) / len(pts)
+    var = sum((t - mt) ** 2 for t, _ in pts)
+    if not var:
+        return 0.0
+    return round(sum((t - mt) * (v - mv) for t, v in pts) / var * 3600, 3)
+
+
+def analyze(samples: List[Dict[str, Any]], warmup: float) -> Dict[str, Any]:
+    steady = [s for s in samples if s["t"] >= warmup]
+    ts = [s["t"] for s in steady]
+    verdicts = {}
+    for metric, (abs_limit, rel_limit) in GROWTH_LIMITS.items():
+        values = [s.get(metric) for s in steady]
+        present = [v for v in values if v is not None]
+        verdicts[metric] = {
+            "first": present[0] if present else None,
+            "last": present[-1] if present else None,
+            "max": max(present) if present else None,
+            "slope_per_hour": slope_per_hour(ts, values),
+            "unbounded": unbounded(values, abs_limit, rel_limit),
+        }
+    return verdicts
+
+
+# ========= SIMULATED DEVICES =========
+class SimDevice:
+    def __init__(self, soak: "Soak", uid: str, token: str) -> None:
+        import socketio
+
+        self.soak = soak
+        self.uid = uid
+        self.token = token
+        self.sio = socketio.AsyncClient(reconnection=False)
+        self.sio.on("device_command", self._on_command)
+        self.sio.on("device_commands", self._on_commands)
+        self.sio.on("device_broadcast", self._on_broadcast)
+
+    async def connect(self) -> None:
+        if self.sio.connected:
+            return
+        try:
+            await self.sio.connect(self.soak.url, auth={"device_uid": self.uid, "token": self.token},
+                                   transports=["websocket"], wait_timeout=10)
+            self.soak.counters["connects"] += 1
+        except Exception:
+            self.soak.counters["connect_errors"] += 1
+
+    async def disconnect(self) -> None:
+        if self.sio.connected:
+            await self.sio.disconnect()
+
+    async def heartbeat_loop(self, interval: float) -> None:
+        await asyncio.sleep(random.random() * interval)
+        while self.soak.running:
+            if self.sio.connected:
+                started = time.perf_counter()
+                try:
+                    await self.sio.call("device_heartbeat", {}, timeout=10)
+                    self.soak.hb.append(time.perf_counter() - started)
+                except Exception:
+                    self.soak.counters["heartbeat_errors"] += 1
+            await asyncio.sleep(interval)
+
+    async def _on_commands(self, data: Dict[str, Any]) -> None:
+        for item in data.get("commands") or []:
+            await self._on_command(item)
+
+    async def _on_broadcast(self, data: Dict[str, Any]) -> None:
+        cid = (data.get("targets") or {}).get(self.uid)
+        if cid is not None:
+            await self._on_command({"id": cid})
+
+    async def _on_command(self, data: Dict[str, Any]) -> None:
+        cid = data.get("id")
+        if cid is None:
+            return
+        self.soak.command_received(cid)
+        injector = self.soak.injector
+        if injector.hit("ack.drop"):
+            return
+        fault = injector.hit("ack.latency")
+        if fault:
+            await asyncio.sleep(fault.value)
+        try:
+            await self.sio.call("device_command_ack", {"command_id": cid}, timeout=10)
+        except Exception:
+            self.soak.counters["ack_errors"] += 1
+
+
+# ========= RUNNER =========
+class Soak:
+    def __init__(self, devices: int, duration: float, sample: float, warmup: float, faults: str,
+                 hb_interval: float, command_interval: float, users: int, seed: int) -> None:
+        self.n_devices = devices
+        self.duration = duration
+        self.sample_every = sample
+        self.warmup = warmup
+        self.faults = faults
+        self.hb_interval = hb_interval
+        self.command_interval = command_interval
+        self.users = users
+        self.rng = random.Random(seed)
+        self.seed = seed
+        self.running = True
+        self.counters: Counter = Counter()
+        self.hb: List[float] = []
+        self.dispatch: List[float] = []
+        self.issued: Dict[int, float] = {}
+        self.samples: List[Dict[str, Any]] = []
+        self.thread_exceptions: Counter = Counter()
+        self.url = ""
+        self.injector = None
+
+    # ----- server -----
+    def _start_server(self) -> None:
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+
+        import backend.app as A
+        from backend.database import SessionLocal
+        from backend.models import Device, User
+        from backend.services.container import dm
+        from backend.services.faults import fault_injector
+
+        app = A.app
+        with SessionLocal() as db:
+            users = [User(username=f"soak-{i}", password_hash="!", role="user") for i in range(self.users)]
+            db.add_all(users)
+            db.commit()
+            self.user_ids = [u.id for u in users]
+            devices = [Device(device_uid=f"soak-{i:05d}", name=f"soak-{i}", type="raspberry_pi",
+                              owner_id=self.user_ids[i % self.users]) for i in range(self.n_devices)]
+            db.add_all(devices)
+            db.commit()
+            self.device_ids = [d.id for d in devices]
+            self.uids = [d.device_uid for d in devices]
+        self.dm = dm
+        self.injector = fault_injector.install(self.faults)  # sau khi seed dữ liệu
+        threading.Thread(target=lambda: A.socketio.run(app, host="127.0.0.1", port=port,
+                                                       allow_unsafe_werkzeug=True, log_output=False),
+                         daemon=True).start()
+        time.sleep(1.0)
+
+    # ----- commands -----
+    def command_received(self, cid: int) -> None:
+        issued = self.issued.pop(cid, None)
+        if issued is not None:
+            self.dispatch.append(time.perf_counter() - issued)
+
+    def _queue_one(self) -> None:
+        from backend.services.command_scheduler import CommandRejected
+
+        device_id = self.rng.choice(self.device_ids)
+        user_id = self.rng.choice(self.user_ids)
+        started = time.perf_counter()
+        try:
+            cid, _ = self.dm.queue_command(device_id, user_id, self.rng.choice(COMMANDS))
+            self.issued[cid] = started
+            self.counters["commands"] += 1
+        except CommandRejected:
+            self.counters["commands_rejected"] += 1
+        except Exception:
+            self.counters["command_errors"] += 1
+
+    async def _command_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self.running:
+            await loop.run_in_executor(None, self._queue_one)
+            await asyncio.sleep(self.command_interval)
+
+    async def _storm_loop(self, devices: List[SimDevice]) -> None:
+        storm = self.injector.rule("reconnect.storm")
+        if storm is None or storm.value <= 0:
+            return
+        while self.running:
+            await asyncio.sleep(storm.value)
+            victims = [d for d in devices if self.rng.random() < storm.probability]
+            await asyncio.gather(*(d.disconnect() for d in victims))
+            await asyncio.gather(*(d.connect() for d in victims))
+            self.counters["storms"] += 1
+            self.injector.injected["reconnect.storm"] += len(victims)
+
+    # ----- sampling -----
+    def _sample(self, t: float) -> Dict[str, Any]:
+        from sqlalchemy import text
+        from sqlalchemy.orm import Session
+
+        from backend.database import engine
+        from backend.services.command_scheduler import command_scheduler
+        from backend.services.db_executor import db_executor
+
+        sessions = [o for o in gc.get_objects() if isinstance(o, Session)]
+        sched = command_scheduler.stats()
+        try:
+            # Connection.execute: không qua do_orm_execute → không dính fault
+            with engine.connect() as c:
+                outstanding = c.execute(text(
+                    "SELECT count(*) FROM command_queue WHERE status IN ('pending', 'sent')"
+                )).scalar()
+        except Exception:
+            outstanding = None
+        hb, self.hb = self.hb, []
+        dispatch, self.dispatch = self.dispatch, []
+        # command không bao giờ tới thiết bị (emit.drop, coalesce) → bỏ, tránh soak tự leak
+        cutoff = time.perf_counter() - 300
+        for cid in [cid for cid, at in list(self.issued.items()) if at < cutoff]:
+            self.issued.pop(cid, None)
+        pool = engine.pool
+        return {
+            "t": round(t, 1),
+            "traced_kb": tracemalloc.get_traced_memory()[0] // 1024,
+            "rss_kb": _rss_kb(),
+            "sessions_alive": len(sessions),
+            "sessions_in_tx": sum(1 for s in sessions if s.in_transaction()),
+            "pool_checked_out": pool.checkedout() if hasattr(pool, "checkedout") else None,
+            "scheduler_queued": sum(c["queued"] for c in sched["classes"].values()),
+            "outstanding_commands": outstanding,
+            "db_in_flight": db_executor.stats()["in_flight"],
+            "hb_p99_ms": _p99_ms(hb),
+            "dispatch_p99_ms": _p99_ms(dispatch),
+            "heartbeats": len(hb),
+            "dispatched": len(dispatch),
+        }
+
+    async def _sample_loop(self, out) -> None:
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        while self.running:
+            await asyncio.sleep(self.sample_every)
+            t = time.monotonic() - started
+            sample = await loop.run_in_executor(None, self._sample, t)
+            self.samples.append(sample)
+            if self.baseline is None and t >= self.warmup:
+                self.baseline = tracemalloc.take_snapshot()
+            print(f"[soak {t:7.0f}s] mem={sample['traced_kb']}KB sessions={sample['sessions_alive']}"
+                  f" queued={sample['scheduler_queued']} outstanding={sample['outstanding_commands']}"
+                  f" hb_p99={sample['hb_p99_ms']}ms dispatch_p99={sample['dispatch_p99_ms']}ms", file=out, flush=True)
+
+    async def _fetch_device_tokens(self) -> List[str]:
+        """Token thiết bị qua GET /<device_id>/token bằng bearer của chủ thiết bị, như thiết bị thật."""
+        import aiohttp
+        from backend.security.identity import UserPrincipal, issue_token
+
+        bearer = {uid: issue_token(UserPrincipal(uid, f"soak-{i}", "user")) for i, uid in enumerate(self.user_ids)}
+
+        async def fetch(http, i: int) -> str:
+            headers = {"Authorization": f"Bearer {bearer[self.user_ids[i % self.users]]}"}
+            for attempt in range(10):  # db.error được inject cả vào route này
+                try:
+                    async with http.get(f"{self.url}/{self.device_ids[i]}/token", headers=headers) as resp:
+                        if resp.status == 200:
+                            return (await resp.json())["token"]
+                except aiohttp.ClientError:
+                    pass  # 500 do lỗi giả lập đôi khi kèm đóng connection
+                await asyncio.sleep(0.1 * (attempt + 1))
+            raise RuntimeError(f"no device token for {self.uids[i]}")
+
+        async with aiohttp.ClientSession() as http:
+            return await asyncio.gather(*(fetch(http, i) for i in range(self.n_devices)))
+
+    async def _main(self, out) -> None:
+        tokens = await self._fetch_device_tokens()
+        devices = [SimDevice(self, uid, token) for uid, token in zip(self.uids, tokens)]
+        await asyncio.gather(*(d.connect() for d in devices))
+        tasks = [asyncio.ensure_future(d.heartbeat_loop(self.hb_interval)) for d in devices]
+        tasks += [asyncio.ensure_future(self._command_loop()),
+                  asyncio.ensure_future(self._storm_loop(devices)),
+                  asyncio.ensure_future(self._sample_loop(out))]
+        await asyncio.sleep(self.duration)
+        self.running = False
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.gather(*(d.disconnect() for d in devices))
+
+    def _excepthook(self, args) -> None:
+        name = (args.thread.name if args.thread else "?").split(" ", 1)[-1].strip("()")
+        self.thread_exceptions[f"{name}: {args.exc_type.__name__}"] += 1
+        self._orig_excepthook(args)
+
+    def run(self, out=sys.stdout) -> Dict[str, Any]:
+        tracemalloc.start(1)
+        self._orig_excepthook = threading.excepthook
+        threading.excepthook = self._excepthook
+        self._start_server()
+        self.baseline = None
+        try:
+            asyncio.run(self._main(out))
+        finally:
+            threading.excepthook = self._orig_excepthook
+        verdicts = analyze(self.samples, self.warmup)
+        top = []
+        if self.baseline is not None:
+            marker = f"{os.sep}backend{os.sep}"
+            for stat in tracemalloc.take_snapshot().compare_to(self.baseline, "lineno"):
+                frame = stat.traceback[0]
+                if marker in frame.filename and stat.size_diff > 0:
+                    top.append({"where": f"{frame.filename.split(marker, 1)[1]}:{frame.lineno}",
+                                "size_diff_kb": round(stat.size_diff / 1024, 1), "count_diff": stat.count_diff})
+                if len(top) >= 10:
+                    break
+        tracemalloc.stop()
+        failed = sorted(m for m, v in verdicts.items() if v["unbounded"])
+        return {
+            "ok": not failed,
+            "unbounded": failed,
+            "duration_s": self.duration,
+            "devices": self.n_devices,
+            "faults": self.faults,
+            "seed": self.seed,
+            "injected": dict(self.injector.injected),
+            "counters": dict(self.counters),
+            "thread_exceptions": dict(self.thread_exceptions),
+            "verdicts": verdicts,
+            "top_allocation_growth": top,
+            "samples": self.samples,
+        }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m backend.services.soak")
+    parser.add_argument("--duration", default="1h", help="vd 90s, 30m, 4h")
+    parser.add_argument("--devices", type=int, default=50)
+    parser.add_argument("--users", type=int, default=5)
+    parser.add_argument("--faults", default="", help="FAULT_SPEC, xem backend/services/faults.py")
+    parser.add_argument("--sample", default="30s", help="chu kỳ lấy mẫu")
+    parser.add_argument("--warmup", type=float, default=0.2, help="tỉ lệ thời gian đầu bỏ qua khi phán định")
+    parser.add_argument("--hb-interval", type=float, default=3.0)
+    parser.add_argument("--command-interval", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="ghi report JSON (kèm toàn bộ sample)")
+    parser.add_argument("--verbose", action="store_true", help="giữ log của server")
+    args = parser.parse_args(argv)
+
+    # Process riêng cho soak: DB tạm + bật fault injection trước khi import backend
+    workdir = tempfile.mkdtemp(prefix="soak-")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'soak.db')}"
+    os.environ.setdefault("ANALYTICS_DIR", os.path.join(workdir, "analytics"))
+    os.environ.setdefault("FIRMWARE_DIR", os.path.join(workdir, "firmware"))
+    os.environ["FAULT_INJECTION"] = "1"
+    os.environ["FAULT_SPEC"] = ""  # soak tự install với --faults
+    if args.seed is not None:
+        os.environ["FAULT_SEED"] = str(args.seed)
+
+    duration = _seconds(args.duration)
+    soak = Soak(args.devices, duration, _seconds(args.sample), duration * args.warmup, args.faults,
+                args.hb_interval, args.command_interval, args.users, args.seed)
+    out = sys.stdout
+    with contextlib.ExitStack() as stack:
+        if not args.verbose:
+            devnull = stack.enter_context(open(os.devnull, "w"))
+            stack.enter_context(contextlib.redirect_stdout(devnull))
+        report = soak.run(out)
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps({k: v for k, v in report.items() if k != "samples"}, indent=2))
+    print("SOAK PASSED" if report["ok"] else f"SOAK FAILED: unbounded growth in {', '.join(report['unbounded'])}")
+    return 0 if report["ok"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
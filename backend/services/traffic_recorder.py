@@ -0,0 +1,122 @@
+# backend/services/traffic_recorder.py
+"""
+Ghi lại traffic thật (Socket.IO + HTTP) để replay ở local (traffic_replay.py).
+
+- Bật bằng TRAFFIC_RECORD_PATH; tắt → record() trả về ngay
+- Đường nóng chỉ append một tuple vào list (không encode, không I/O);
+  background task mỗi TRAFFIC_RECORD_FLUSH_INTERVAL giây encode + ghi
+  thêm một member gzip vào file (JSON lines, gzip.open đọc liền mạch)
+- Không ghi header/cookie/token: replay tự đăng nhập bằng tài khoản của nó
+
+Record (JSON array, phần tử đầu là epoch seconds):
+  [t, "meta", {...}]                      đầu mỗi lần process bắt đầu ghi
+  [t, "connect", uid, wire]               thiết bị connect (wire: json/msgpack/struct)
+  [t, "disconnect", uid]
+  [t, "hb", uid]                          device_heartbeat
+  [t, "ack", uid, command_id]             device_command_ack
+  [t, "http", method, endpoint, path, query, body, status, ms, uid]
+      uid: thiết bị trong URL / body (device_id) → replay map sang id mới
+"""
+import atexit
+import gzip
+import os
+import socket
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+from backend.config import Config
+from backend.extensions import socketio
+from backend.serializer import dumps, loads
+
+
+class TrafficRecorder:
+    def __init__(self, path: str, endpoints: List[str], flush_interval: float, max_body: int) -> None:
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_body = max_body
+        self._exact = {e for e in endpoints if not e.endswith(".*")}
+        self._prefixes = tuple(e[:-1] for e in endpoints if e.endswith(".*"))
+        self._matches: Dict[str, bool] = {}
+        self._buf: deque = deque()
+        self._lock = threading.Lock()
+        self._flusher_started = False
+        self.recorded = 0
+        self.written = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def wants(self, endpoint: Optional[str]) -> bool:
+        """Endpoint có nằm trong danh sách ghi không (kết quả cache theo endpoint)."""
+        if not endpoint:
+            return False
+        hit = self._matches.get(endpoint)
+        if hit is None:
+            hit = endpoint in self._exact or endpoint.startswith(self._prefixes)
+            self._matches[endpoint] = hit
+        return hit
+
+    def record(self, kind: str, *fields: Any) -> None:
+        if not self.path:
+            return
+        self._buf.append((time.time(), kind) + fields)  # deque.append thread-safe, không cần lock
+        self.recorded += 1
+        if not self._flusher_started:
+            self._start()
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._flusher_started:
+                return
+            self._flusher_started = True
+            self._buf.appendleft((time.time(), "meta", {
+                "version": 1,
+                "host": socket.gethostname(),
+                "pid": os.getpid(),
+                "async_mode": getattr(socketio.server, "async_mode", None),
+            }))
+        socketio.start_background_task(self._flush_loop)
+        atexit.register(self.flush)
+
+    def flush(self) -> int:
+        with self._lock:
+            buf = [self._buf.popleft() for _ in range(len(self._buf))]
+            if not buf:
+                return 0
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            data = "".join(dumps(list(r)) + "\n" for r in buf).encode()
+            with gzip.open(self.path, "ab", compresslevel=6) as f:
+                f.write(data)
+            self.written += len(buf)
+        return len(buf)
+
+    def _flush_loop(self) -> None:
+        while True:
+            socketio.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"⚠️ traffic record flush failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {"path": self.path or None, "recorded": self.recorded, "written": self.written,
+                "buffered": len(self._buf)}
+
+
+def load(path: str) -> List[list]:
+    """Đọc toàn bộ record (mọi member gzip), sắp theo thời gian."""
+    with gzip.open(path, "rt") as f:
+        records = [loads(line) for line in f if line.strip()]
+    records.sort(key=lambda r: r[0])
+    return records
+
+
+traffic_recorder = TrafficRecorder(
+    Config.TRAFFIC_RECORD_PATH,
+    endpoints=Config.TRAFFIC_RECORD_ENDPOINTS,
+    flush_interval=Config.TRAFFIC_RECORD_FLUSH_INTERVAL,
+    max_body=Config.TRAFFIC_RECORD_MAX_BODY,
+)
@@ -0,0 +1,428 @@
+# backend/services/traffic_replay.py
+"""
+Replay traffic log (traffic_recorder.py) vào một server local + so sánh hai build.
+
+    # build A
+    python -m backend.services.traffic_replay run traffic.jsonl.gz --url http://127.0.0.1:5000 \\
+        --speed 1 --scale 1 --provision --out a.json
+    # build B (cùng log, cùng tham số) rồi so sánh
+    python -m backend.services.traffic_replay compare a.json b.json --threshold 0.2
+
+- --speed 1 = đúng nhịp gốc, N = nhanh N lần, max = không chờ (giữ thứ tự)
+- --scale K: mỗi thiết bị nhân K bản (uid, uid~r1, ...), HTTP gắn với thiết bị
+  cũng nhân theo; HTTP không gắn thiết bị (vd /dashboard/status) giữ nguyên
+- Thiết bị: socketio.AsyncClient thật, heartbeat / ack gửi bằng call() để đo
+  round-trip; ack dùng command_id thật nhận được (cũ nhất chưa ack), không có
+  thì gửi id gốc trong log (server vẫn phải xử lý như ack trùng)
+- dispatch: từ lúc gửi /dashboard/control tới khi thiết bị đích nhận command
+- --provision: tạo user/thiết bị còn thiếu trực tiếp trong DB (cùng DATABASE_URL
+  với server); token thiết bị tính bằng SECRET_KEY như DeviceManager.device_token
+- HTTP dashboard đăng nhập bằng --admin-password, route thiết bị dùng --token
+  (Bearer); log không chứa credential nào
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import re
+import sys
+import time
+from collections import Counter, defaultdict, deque
+from typing import Any, Dict, List, Optional, Tuple
+
+from backend.config import Config
+from backend.services.traffic_recorder import load
+
+_DIGITS = re.compile(r"/\d+(?=/|$)")
+_QUEUED_ACTIONS = ("start", "stop", "watchdog_reset")
+
+
+def _device_token(uid: str) -> str:
+    # giống DeviceManager.device_token (HMAC(SECRET_KEY, uid))
+    return hmac.new(Config.SECRET_KEY.encode(), uid.encode(), hashlib.sha256).hexdigest()
+
+
+def clone_uid(uid: str, k: int) -> str:
+    return uid if k == 0 else f"{uid}~r{k}"
+
+
+def summarize(samples: List[float], errors: int = 0) -> Dict[str, Any]:
+    """samples tính bằng giây → ms."""
+    s = sorted(samples)
+    pct = lambda q: round(s[min(len(s) - 1, int(q * len(s)))] * 1000, 3) if s else None
+    return {
+        "count": len(s),
+        "errors": errors,
+        "mean": round(sum(s) / len(s) * 1000, 3) if s else None,
+        "p50": pct(0.5), "p95": pct(0.95), "p99": pct(0.99), "max": pct(1.0),
+    }
+
+
+# ========= PLAN =========
+def build_plan(records: List[list], scale: int) -> Tuple[List[tuple], List[str]]:
+    """
+    Log → danh sách (t, seq, actor, op, args) theo thời gian.
+    actor = uid thiết bị (đã clone) hoặc None (HTTP).
+    Thiết bị có event nhưng không có connect trước đó (đã online lúc bắt
+    đầu ghi) → connect ở thời điểm đầu log.
+    """
+    body = [r for r in records if r[1] != "meta"]
+    if not body:
+        return [], []
+    t_first = body[0][0]
+    plan: List[tuple] = []
+    uids: List[str] = []
+    connected: Dict[str, bool] = {}
+    seq = 0
+    for r in body:
+        t, kind = r[0] - t_first, r[1]
+        if kind == "http":
+            uid = r[9]
+            for k in range(scale if uid else 1):
+                plan.append((t, seq, None, "http", (r, clone_uid(uid, k) if uid else None)))
+                seq += 1
+            continue
+        uid = r[2]
+        if uid not in connected:
+            uids.append(uid)
+            if kind != "connect":
+                for k in range(scale):
+                    plan.append((0.0, seq, clone_uid(uid, k), "connect", ()))
+                    seq += 1
+        connected[uid] = kind != "disconnect"
+        args = (r[3],) if kind == "ack" else ()
+        for k in range(scale):
+            plan.append((t, seq, clone_uid(uid, k), kind, args))
+            seq += 1
+    plan.sort(key=lambda p: (p[0], p[1]))
+    return plan, [clone_uid(u, k) for u in uids for k in range(scale)]
+
+
+def provision(uids: List[str]) -> Tuple[int, Dict[str, int]]:
+    """Tạo user "replay" + thiết bị còn thiếu (ghi thẳng DB của server) → (số tạo mới, uid → id)."""
+    from backend.database import SessionLocal
+    from backend.models import Device, User
+
+    with SessionLocal() as db:
+        owner = db.query(User).filter_by(username="replay").first()
+        if owner is None:
+            owner = User(username="replay", password_hash="!", role="user")
+            db.add(owner)
+            db.commit()
+        existing = {u for (u,) in db.query(Device.device_uid).filter(Device.device_uid.in_(uids))} if uids else set()
+        missing = [u for u in uids if u not in existing]
+        for uid in missing:
+            db.add(Device(device_uid=uid, name=uid, type="raspberry_pi", owner_id=owner.id))
+        db.commit()
+        ids = dict(db.query(Device.device_uid, Device.id).filter(Device.device_uid.in_(uids))) if uids else {}
+    return len(missing), ids
+
+
+# ========= ACTORS =========
+class _Device:
+    def __init__(self, replayer: "Replayer", uid: str) -> None:
+        import socketio
+
+        self.replayer = replayer
+        self.uid = uid
+        self.lock = asyncio.Lock()  # giữ thứ tự event của từng thiết bị
+        self.unacked: deque = deque()
+        self.sio = socketio.AsyncClient(reconnection=False)
+        self.sio.on("device_command", self._on_command)
+        self.sio.on("device_commands", self._on_commands)
+        self.sio.on("device_broadcast", self._on_broadcast)
+
+    async def _on_command(self, data: Dict[str, Any]) -> None:
+        # device_command emit tới đúng sid → chỉ command của thiết bị này
+        cid = data.get("id")
+        if cid is None or cid in self.unacked:
+            return  # gửi lại lúc reconnect (command còn pending)
+        self.unacked.append(cid)
+        self.replayer.command_received(self.uid, (data.get("cmd") or "").lower())
+
+    async def _on_commands(self, data: Dict[str, Any]) -> None:
+        for item in data.get("commands") or []:
+            await self._on_command(item)
+
+    async def _on_broadcast(self, data: Dict[str, Any]) -> None:
+        cid = (data.get("targets") or {}).get(self.uid)
+        if cid is not None:
+            await self._on_command({"id": cid, "cmd": data.get("cmd")})
+
+    async def run(self, op: str, args: tuple) -> None:
+        r = self.replayer
+        if op == "connect":
+            if self.sio.connected:
+                return
+            await r.timed("connect", self.sio.connect(
+                r.url, auth={"device_uid": self.uid, "token": _device_token(self.uid), "wire": "json"},
+                transports=["websocket"], wait_timeout=r.timeout,
+            ))
+        elif op == "disconnect":
+            if self.sio.connected:
+                await self.sio.disconnect()
+        elif not self.sio.connected:
+            r.skipped[op] += 1
+        elif op == "hb":
+            await r.timed("heartbeat", self.sio.call("device_heartbeat", {}, timeout=r.timeout))
+        elif op == "ack":
+            cid = self.unacked.popleft() if self.unacked else args[0]
+            await r.timed("ack", self.sio.call("device_command_ack", {"command_id": cid}, timeout=r.timeout))
+
+
+class Replayer:
+    def __init__(self, url: str, speed: float, timeout: float, concurrency: int,
+                 admin_password: str, token: Optional[str]) -> None:
+        self.url = url.rstrip("/")
+        self.speed = speed
+        self.timeout = timeout
+        self.sem = asyncio.Semaphore(concurrency)
+        self.admin_password = admin_password
+        self.token = token
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Counter = Counter()
+        self.skipped: Counter = Counter()
+        self.status: Dict[str, Counter] = defaultdict(Counter)
+        self.lag: List[float] = []
+        self.devices: Dict[str, _Device] = {}
+        self.ids: Dict[str, int] = {}
+        self.pending_dispatch: Dict[Tuple[str, str], deque] = defaultdict(deque)  # (uid, cmd) → lúc gửi
+        self.http = None
+
+    async def timed(self, name: str, coro) -> Any:
+        started = time.perf_counter()
+        try:
+            result = await coro
+        except Exception:
+            self.errors[name] += 1
+            return None
+        self.samples[name].append(time.perf_counter() - started)
+        return result
+
+    def command_received(self, uid: str, cmd: str) -> None:
+        pending = self.pending_dispatch.get((uid, cmd))
+        if pending:
+            self.samples["dispatch"].append(time.perf_counter() - pending.popleft())
+
+    # ----- HTTP -----
+    async def _login(self) -> None:
+        import aiohttp
+
+        self.http = aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True),
+                                          timeout=aiohttp.ClientTimeout(total=self.timeout))
+        async with self.http.post(f"{self.url}/auth/login",
+                                  data={"username": "admin", "password": self.admin_password}) as resp:
+            await resp.read()
+        async with self.http.get(f"{self.url}/dashboard/status") as resp:
+            if resp.status != 200:
+                raise RuntimeError(f"dashboard login failed ({resp.status})")
+            snapshot = await resp.json()
+        # Thiết bị chưa từng connect có thể chưa có trong snapshot → giữ map từ provision
+        self.ids.update({d["device_uid"]: d["id"] for d in snapshot["devices"]})
+
+    async def _http(self, rec: list, uid: Optional[str]) -> None:
+        _, _, method, endpoint, path, query, body, _, _, _ = rec[:10]
+        if uid is not None:
+            new_id = self.ids.get(uid)
+            if new_id is None:
+                self.skipped["http"] += 1
+                return
+            path = _DIGITS.sub(f"/{new_id}", path, count=1)
+            if isinstance(body, dict) and "device_id" in body:
+                body = {**body, "device_id": new_id}
+        headers = {"Authorization": f"Bearer {self.token}"} if self.token and endpoint.startswith("device.") else {}
+        name = f"{method} {endpoint}"
+        url = f"{self.url}{path}" + (f"?{query}" if query else "")
+        action = body.get("action", "") if isinstance(body, dict) else ""
+        started = time.perf_counter()
+        try:
+            async with self.http.request(method, url, json=body, headers=headers, allow_redirects=False) as resp:
+                await resp.read()
+                code = resp.status
+        except Exception:
+            self.errors[name] += 1
+            return
+        elapsed = time.perf_counter() - started
+        self.status[name][str(code)] += 1
+        if code >= 500:
+            self.errors[name] += 1
+            return
+        self.samples[name].append(elapsed)
+        if uid is not None and code == 200 and (action in _QUEUED_ACTIONS or action.startswith("cmd:")):
+            cmd = action.split("cmd:", 1)[1] if action.startswith("cmd:") else action
+            self.pending_dispatch[(uid, cmd.lower())].append(started)
+
+    # ----- driver -----
+    async def _do(self, actor: Optional[str], op: str, args: tuple) -> None:
+        async with self.sem:
+            if actor is None:
+                await self._http(*args)
+                return
+            dev = self.devices[actor]
+            async with dev.lock:
+                await dev.run(op, args)
+
+    async def run(self, plan: List[tuple], uids: List[str], drain: float,
+                  ids: Optional[Dict[str, int]] = None) -> Dict[str, Any]:
+        self.ids = dict(ids or {})
+        await self._login()
+        self.devices = {uid: _Device(self, uid) for uid in uids}
+        tasks = []
+        started = time.perf_counter()
+        for t, _, actor, op, args in plan:
+            if self.speed > 0:
+                due = started + t / self.speed
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                self.lag.append(max(0.0, time.perf_counter() - due))
+            tasks.append(asyncio.ensure_future(self._do(actor, op, args)))
+            if len(tasks) >= 4096:
+                tasks = [x for x in tasks if not x.done()]
+        await asyncio.gather(*tasks)
+        duration = time.perf_counter() - started
+        await asyncio.sleep(drain)  # chờ command còn đang dispatch
+        for dev in self.devices.values():
+            if dev.sio.connected:
+                await dev.sio.disconnect()
+        await self.http.close()
+        ops = {name: summarize(s, self.errors[name]) for name, s in sorted(self.samples.items())}
+        for name, n in self.errors.items():
+            ops.setdefault(name, summarize([], n))
+        done = sum(v["count"] for k, v in ops.items() if k != "dispatch")
+        return {
+            "duration_s": round(duration, 3),
+            "operations": done,
+            "throughput_ops": round(done / duration, 2) if duration else None,
+            "ops": ops,
+            "status": {k: dict(v) for k, v in self.status.items()},
+            "skipped": dict(self.skipped),
+            "undelivered_commands": sum(len(q) for q in self.pending_dispatch.values()),
+            "driver_lag": summarize(self.lag),
+        }
+
+
+def replay(log: str, url: str, speed: float = 1.0, scale: int = 1, do_provision: bool = False,
+           admin_password: str = "1234", token: Optional[str] = None, timeout: float = 10.0,
+           concurrency: int = 512, drain: float = 2.0, label: str = "") -> Dict[str, Any]:
+    records = load(log)
+    plan, uids = build_plan(records, scale)
+    created, ids = provision(uids) if do_provision else (0, {})
+
+    async def main():
+        # Semaphore / Lock phải tạo trong event loop của asyncio.run
+        replayer = Replayer(url, speed, timeout, concurrency, admin_password, token)
+        return await replayer.run(plan, uids, drain, ids)
+
+    result = asyncio.run(main())
+    meta = next((r[2] for r in records if r[1] == "meta"), {})
+    return {
+        "label": label,
+        "log": log,
+        "recorded": meta,
+        "url": url,
+        "speed": speed or "max",
+        "scale": scale,
+        "records": len(records),
+        "devices": len(uids),
+        "provisioned": created,
+        **result,
+    }
+
+
+# ========= COMPARE =========
+def compare(a: Dict[str, Any], b: Dict[str, Any], threshold: float = 0.2,
+            min_ms: float = 1.0) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """
+    So sánh từng op (b so với a). Regression: p95 tăng > threshold (và > min_ms),
+    tỉ lệ lỗi tăng > 1 điểm %, throughput giảm > threshold.
+    """
+    rows, regressions = [], []
+    for name in sorted(set(a["ops"]) | set(b["ops"])):
+        x, y = a["ops"].get(name), b["ops"].get(name)
+        row = {"op": name, "a": x, "b": y}
+        if x and y and x["p95"] is not None and y["p95"] is not None:
+            row["p95_change"] = round((y["p95"] - x["p95"]) / x["p95"], 4) if x["p95"] else None
+            if y["p95"] - x["p95"] > min_ms and y["p95"] > x["p95"] * (1 + threshold):
+                regressions.append(f"{name}: p95 {x['p95']}ms → {y['p95']}ms")
+        if x and y:
+            err = lambda s: s["errors"] / max(1, s["count"] + s["errors"])
+            if err(y) - err(x) > 0.01:
+                regressions.append(f"{name}: error rate {err(x):.1%} → {err(y):.1%}")
+        rows.append(row)
+    ta, tb = a.get("throughput_ops"), b.get("throughput_ops")
+    if ta and tb and tb < ta * (1 - threshold):
+        regressions.append(f"throughput {ta} → {tb} ops/s")
+    return rows, regressions
+
+
+def _print_compare(a, b, rows, regressions) -> None:
+    fmt = lambda v: "-" if v is None else f"{v:g}"
+    speed = lambda r: r["speed"] if r["speed"] == "max" else f"{r['speed']:g}x"
+    print(f"A: {a.get('label') or a['url']}  ({speed(a)}, scale {a['scale']}, {a['duration_s']}s)")
+    print(f"B: {b.get('label') or b['url']}  ({speed(b)}, scale {b['scale']}, {b['duration_s']}s)")
+    print(f"{'op':<40} {'count A/B':>15} {'p50 A→B ms':>18} {'p95 A→B ms':>18} {'Δp95':>8} {'p99 A→B ms':>18} {'err A/B':>9}")
+    for r in rows:
+        x = r["a"] or summarize([])
+        y = r["b"] or summarize([])
+        change = r.get("p95_change")
+        print(f"{r['op']:<40} {x['count']:>7}/{y['count']:<7} {fmt(x['p50']):>8}→{fmt(y['p50']):<9} "
+              f"{fmt(x['p95']):>8}→{fmt(y['p95']):<9} {'-' if change is None else f'{change:+.0%}':>8} "
+              f"{fmt(x['p99']):>8}→{fmt(y['p99']):<9} {x['errors']:>4}/{y['errors']:<4}")
+    print(f"{'throughput ops/s':<40} {fmt(a.get('throughput_ops'))} → {fmt(b.get('throughput_ops'))}")
+    print()
+    if regressions:
+        print("REGRESSIONS:")
+        for line in regressions:
+            print(f"  - {line}")
+    else:
+        print("no regressions")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m backend.services.traffic_replay")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    run = sub.add_parser("run", help="replay a traffic log against a server")
+    run.add_argument("log")
+    run.add_argument("--url", default="http://127.0.0.1:5000")
+    run.add_argument("--speed", default="1", help="1 = real time, N = N times faster, max = no waiting")
+    run.add_argument("--scale", type=int, default=1, help="clone every device K times")
+    run.add_argument("--provision", action="store_true", help="create missing devices in the server DB")
+    run.add_argument("--admin-password", default="1234")
+    run.add_argument("--token", help="Bearer token for device.* routes")
+    run.add_argument("--timeout", type=float, default=10.0)
+    run.add_argument("--concurrency", type=int, default=512)
+    run.add_argument("--drain", type=float, default=2.0)
+    run.add_argument("--label", default="")
+    run.add_argument("--out", help="write the JSON report here")
+
+    cmp_ = sub.add_parser("compare", help="compare two replay reports (B against A)")
+    cmp_.add_argument("a")
+    cmp_.add_argument("b")
+    cmp_.add_argument("--threshold", type=float, default=0.2)
+
+    args = parser.parse_args(argv)
+    if args.cmd == "run":
+        speed = 0.0 if args.speed == "max" else float(args.speed)
+        result = replay(args.log, args.url, speed, args.scale, args.provision, args.admin_password,
+                        args.token, args.timeout, args.concurrency, args.drain, args.label)
+        text = json.dumps(result, indent=2)
+        if args.out:
+            with open(args.out, "w") as f:
+                f.write(text)
+        print(text)
+        return 0
+
+    with open(args.a) as f:
+        a = json.load(f)
+    with open(args.b) as f:
+        b = json.load(f)
+    rows, regressions = compare(a, b, args.threshold)
+    _print_compare(a, b, rows, regressions)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
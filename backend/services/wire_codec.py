@@ -0,0 +1,301 @@
+# backend/services/wire_codec.py
+"""
+Wire protocol nhị phân (tuỳ chọn) cho traffic thiết bị.
+
+JSON vẫn là mặc định. Thiết bị có thể xin "msgpack" hoặc "struct" khi connect
+(auth={"device_uid": ..., "wire": "struct"}); server cấp một handle số nhỏ (u16)
+thay cho device_uid, frame nhị phân đi qua event "device_bin".
+
+Message (dạng dict trung gian, giống nhau cho mọi codec):
+    {"type": "heartbeat", "handle": 3}
+    {"type": "ack", "handle": 3, "command_id": 42}
+    {"type": "command", "handle": 3, "command_id": 42, "cmd": "LED_ON"}
+    {"type": "batch", "handle": 3, "events": [<message>, ...]}  (server → room: handle 0)
+
+Layout "struct" (little-endian, cho Arduino):
+    header  = <B type><H handle>
+    ack     = header + <I command_id>
+    command = header + <I command_id><B len><cmd bytes>
+    batch   = header + <B count> + count * (<H len><sub-frame>)
+
+Benchmark bytes/message và thời gian encode/decode từng codec:
+benchmarks/wire_codec.py.
+"""
+import json
+import struct
+import threading
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import msgpack
+except ImportError:  # msgpack là optional
+    msgpack = None
+
+
+MSG_HEARTBEAT = 1
+MSG_ACK = 2
+MSG_COMMAND = 3
+MSG_BATCH = 4
+
+TYPE_CODES = {
+    "heartbeat": MSG_HEARTBEAT,
+    "ack": MSG_ACK,
+    "command": MSG_COMMAND,
+    "batch": MSG_BATCH,
+}
+TYPE_NAMES = {v: k for k, v in TYPE_CODES.items()}
+
+
+class CodecError(ValueError):
+    """Frame nhị phân không hợp lệ."""
+
+
+class JsonCodec:
+    name = "json"
+
+    def encode(self, msg: Dict[str, Any]) -> bytes:
+        return json.dumps(msg, separators=(",", ":")).encode()
+
+    def decode(self, data: bytes) -> Dict[str, Any]:
+        try:
+            return json.loads(data)
+        except ValueError as e:
+            raise CodecError(str(e)) from e
+
+
+class MsgpackCodec:
+    """MessagePack với key rút gọn: t=type, h=handle, c=command_id, x=cmd, b=events."""
+
+    name = "msgpack"
+
+    def _pack(self, msg: Dict[str, Any]) -> Dict[str, Any]:
+        out: Dict[str, Any] = {"t": TYPE_CODES[msg["type"]], "h": msg.get("handle", 0)}
+        if "command_id" in msg:
+            out["c"] = msg["command_id"]
+        if "cmd" in msg:
+            out["x"] = msg["cmd"]
+        if "events" in msg:
+            out["b"] = [self._pack(e) for e in msg["events"]]
+        return out
+
+    def _unpack(self, raw: Dict[str, Any]) -> Dict[str, Any]:
+        try:
+            msg: Dict[str, Any] = {"type": TYPE_NAMES[raw["t"]], "handle": raw.get("h", 0)}
+        except (KeyError, TypeError) as e:
+            raise CodecError("bad msgpack frame") from e
+        if "c" in raw:
+            msg["command_id"] = raw["c"]
+        if "x" in raw:
+            msg["cmd"] = raw["x"]
+        if "b" in raw:
+            msg["events"] = [self._unpack(e) for e in raw["b"]]
+        return msg
+
+    def encode(self, msg: Dict[str, Any]) -> bytes:
+        return msgpack.packb(self._pack(msg), use_bin_type=True)
+
+    def decode(self, data: bytes) -> Dict[str, Any]:
+        try:
+            raw = msgpack.unpackb(data, raw=False)
+        except Exception as e:
+            raise CodecError(str(e)) from e
+        return self._unpack(raw)
+
+
+class StructCodec:
+    """Layout cố định (xem docstring module), không cần thư viện ngoài."""
+
+    name = "struct"
+
+    _HEADER = struct.Struct("<BH")
+    _U32 = struct.Struct("<I")
+    _U16 = struct.Struct("<H")
+    _U8 = struct.Struct("<B")
+
+    def encode(self, msg: Dict[str, Any]) -> bytes:
+        t = TYPE_CODES[msg["type"]]
+        out = [self._HEADER.pack(t, msg.get("handle", 0))]
+        if t == MSG_ACK:
+            out.append(self._U32.pack(msg["command_id"]))
+        elif t == MSG_COMMAND:
+            cmd = msg.get("cmd", "").encode()[:255]
+            out.append(self._U32.pack(msg["command_id"]))
+            out.append(self._U8.pack(len(cmd)))
+            out.append(cmd)
+        elif t == MSG_BATCH:
+            events = msg.get("events", [])[:255]
+            out.append(self._U8.pack(len(events)))
+            for e in events:
+                sub = self.encode(e)
+                out.append(self._U16.pack(len(sub)))
+                out.append(sub)
+        return b"".join(out)
+
+    def decode(self, data: bytes) -> Dict[str, Any]:
+        msg, _ = self._decode_at(memoryview(data), 0)
+        return msg
+
+    def _decode_at(self, buf: memoryview, pos: int) -> Tuple[Dict[str, Any], int]:
+        try:
+            t, handle = self._HEADER.unpack_from(buf, pos)
+            pos += self._HEADER.size
+            if t not in TYPE_NAMES:
+                raise CodecError(f"unknown message type {t}")
+            msg: Dict[str, Any] = {"type": TYPE_NAMES[t], "handle": handle}
+            if t == MSG_ACK:
+                msg["command_id"] = self._U32.unpack_from(buf, pos)[0]
+                pos += 4
+            elif t == MSG_COMMAND:
+                msg["command_id"] = self._U32.unpack_from(buf, pos)[0]
+                n = buf[pos + 4]
+                msg["cmd"] = bytes(buf[pos + 5:pos + 5 + n]).decode()
+                pos += 5 + n
+            elif t == MSG_BATCH:
+                count = buf[pos]
+                pos += 1
+                events: List[Dict[str, Any]] = []
+                for _ in range(count):
+                    size = self._U16.unpack_from(buf, pos)[0]
+                    pos += 2
+                    sub, _ = self._decode_at(buf[pos:pos + size], 0)
+                    events.append(sub)
+                    pos += size
+                msg["events"] = events
+            return msg, pos
+        except (struct.error, IndexError, UnicodeDecodeError) as e:
+            raise CodecError("truncated struct frame") from e
+
+
+def available_formats() -> List[str]:
+    formats = ["json", "struct"]
+    if msgpack is not None:
+        formats.append("msgpack")
+    return formats
+
+
+def get_codec(fmt: str):
+    if fmt == "struct":
+        return StructCodec()
+    if fmt == "msgpack":
+        if msgpack is None:
+            raise CodecError("msgpack is not installed")
+        return MsgpackCodec()
+    return JsonCodec()
+
+
+class WireRegistry:
+    """
+    Trạng thái negotiate theo từng connection: sid → (format, handle, device_uid).
+    Handle là số u16 (1..65535, 0 dành cho frame broadcast / batch), cấp lúc
+    connect và dùng chung cho mọi sid của cùng thiết bị; sid cuối unbind → trả
+    handle về free-list. Hết handle → bind trả None (connection dùng JSON).
+    """
+
+    MAX_HANDLE = 0xFFFF
+
+    def __init__(self) -> None:
+        self._by_sid: Dict[str, Tuple[str, int, str]] = {}
+        self._handle_by_uid: Dict[str, int] = {}
+        self._sids_by_uid: Dict[str, int] = {}
+        self._free: deque = deque()  # handle đã trả, cấp lại trước
+        self._next_handle = 1
+        self._codecs: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def _allocate(self) -> Optional[int]:
+        if self._free:
+            return self._free.popleft()
+        if self._next_handle > self.MAX_HANDLE:
+            return None
+        handle = self._next_handle
+        self._next_handle += 1
+        return handle
+
+    def bind(self, sid: str, device_uid: str, fmt: str) -> Optional[int]:
+        """Đăng ký connection binary; trả về handle, hoặc None nếu format không hỗ trợ / hết handle."""
+        if fmt not in available_formats() or fmt == "json":
+            return None
+        with self._lock:
+            if sid in self._by_sid:
+                self._release(sid)
+            handle = self._handle_by_uid.get(device_uid)
+            if handle is None:
+                handle = self._allocate()
+                if handle is None:
+                    return None
+                self._handle_by_uid[device_uid] = handle
+            if fmt not in self._codecs:
+                self._codecs[fmt] = get_codec(fmt)
+            self._by_sid[sid] = (fmt, handle, device_uid)
+            self._sids_by_uid[device_uid] = self._sids_by_uid.get(device_uid, 0) + 1
+            return handle
+
+    def warm(self) -> None:
+        """Tạo sẵn codec cho mọi format hỗ trợ (import msgpack, compile struct)."""
+        with self._lock:
+            for fmt in available_formats():
+                if fmt != "json" and fmt not in self._codecs:
+                    self._codecs[fmt] = get_codec(fmt)
+
+    def unbind(self, sid: str) -> None:
+        with self._lock:
+            self._release(sid)
+
+    def _release(self, sid: str) -> None:
+        entry = self._by_sid.pop(sid, None)
+        if entry is None:
+            return
+        _, handle, uid = entry
+        left = self._sids_by_uid.get(uid, 1) - 1
+        if left > 0:
+            self._sids_by_uid[uid] = left
+            return
+        self._sids_by_uid.pop(uid, None)
+        if self._handle_by_uid.get(uid) == handle:
+            del self._handle_by_uid[uid]
+            self._free.append(handle)
+
+    def codec_for(self, sid: str):
+        entry = self._by_sid.get(sid)
+        return self._codecs[entry[0]] if entry else None
+
+    def uid_for(self, sid: str, handle: int) -> Optional[str]:
+        """uid theo handle trong frame; handle phải khớp với connection đã bind."""
+        entry = self._by_sid.get(sid)
+        if not entry or entry[1] != handle:
+            return None
+        return entry[2]
+
+    def format_for(self, sid: str) -> Optional[str]:
+        entry = self._by_sid.get(sid)
+        return entry[0] if entry else None
+
+    def handle_for(self, device_uid: str) -> Optional[int]:
+        return self._handle_by_uid.get(device_uid)
+
+    def active_formats(self) -> List[str]:
+        return sorted({fmt for fmt, _, _ in self._by_sid.values()})
+
+    def encode(self, fmt: str, msg: Dict[str, Any]) -> bytes:
+        codec = self._codecs.get(fmt) or get_codec(fmt)
+        return codec.encode(msg)
+
+
+def message_to_event(msg: Dict[str, Any], device_uid: str) -> Tuple[str, Dict[str, Any]]:
+    """Chuyển message nhị phân → (event, payload JSON) để tái dùng handler hiện có."""
+    t = msg["type"]
+    if t == "ack":
+        return "device_command_ack", {"device_uid": device_uid, "command_id": msg["command_id"]}
+    if t == "batch":
+        events = []
+        for sub in msg.get("events", []):
+            ev, data = message_to_event(sub, device_uid)
+            events.append({"event": ev, "data": data})
+        return "device_batch", {"device_uid": device_uid, "events": events}
+    if t == "command":
+        return "device_command", {"id": msg["command_id"], "cmd": msg.get("cmd", "")}
+    return "device_heartbeat", {"device_uid": device_uid}
+
+
+wire_registry = WireRegistry()
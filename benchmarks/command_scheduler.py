@@ -0,0 +1,86 @@
+# benchmarks/command_scheduler.py
+"""
+Mô phỏng (đồng hồ giả) 1 user spam vs vài user thường + STOP chen ngang:
+FIFO một hàng vs fair-share (backend/services/command_scheduler.py).
+
+    python benchmarks/command_scheduler.py
+"""
+import os
+import sys
+from collections import deque
+from typing import Deque, Dict, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.services.command_scheduler import CommandScheduler, WaitHistogram  # noqa: E402
+
+
+def main(rate: float = 50.0, spam: int = 600, users: int = 3, seconds: float = 10.0) -> None:
+    """
+    Mô phỏng (đồng hồ giả): user 1 đẩy `spam` command ngay t=0, `users` user
+    khác mỗi người 1 command / 0.5s, instructor gửi STOP ở t=2s.
+    So sánh FIFO một hàng (như trước) với scheduler này.
+    """
+    def new_scheduler(max_inflight: int) -> CommandScheduler:
+        sch = CommandScheduler(["safety", "instructor", "student"], ["stop"], ["instructor"], {},
+                               rate, max_queued=10 ** 6, max_inflight=max_inflight, inflight_timeout=1e9)
+        sch._ensure_worker = lambda: None  # không chạy dispatcher thật
+        sch.role_of = lambda uid: "instructor" if uid == 100 else "student"  # không tra DB
+        return sch
+
+    arrivals: List[Tuple[float, int, str]] = [(0.0, 1, "led_on")] * spam
+    for u in range(2, users + 2):
+        arrivals += [(i * 0.5 + u * 0.01, u, "led_on") for i in range(int(seconds / 0.5))]
+    arrivals.append((2.0, 100, "stop"))
+    arrivals.sort(key=lambda a: a[0])
+
+    def simulate(fair: bool) -> Tuple[Dict[int, WaitHistogram], float]:
+        sch = new_scheduler(max_inflight=10 ** 6)
+        fifo: Deque[Tuple[float, int, str]] = deque()
+        waits: Dict[int, WaitHistogram] = {}
+        stop_wait = -1.0
+        i, t, cid = 0, 0.0, 0
+        while t < seconds * 20 and (i < len(arrivals) or fifo or sch._queued_ids):
+            while i < len(arrivals) and arrivals[i][0] <= t:
+                at, uid, cmd = arrivals[i]
+                cid += 1
+                if fair:
+                    sch._weights[uid] = 1.0
+                    sch.submit(cid, 1, uid, cmd, sch.classify(cmd, uid))
+                    sch._queued_ids[cid].enqueued = at
+                else:
+                    fifo.append((at, uid, cmd))
+                i += 1
+            if fair:
+                item = sch._pop_next()
+                picked = (item.enqueued, item.user_id, item.command) if item else None
+                if item:
+                    sch.on_ack(item.command_id, item.user_id)
+            else:
+                picked = fifo.popleft() if fifo else None
+            if picked:
+                at, uid, cmd = picked
+                waits.setdefault(uid, WaitHistogram()).observe((t - at) * 1000)
+                if cmd == "stop":
+                    stop_wait = (t - at) * 1000
+            t += 1.0 / rate
+        return waits, stop_wait
+
+    print(f"dispatch {rate:.0f} cmd/s, user 1 floods {spam} commands at t=0, "
+          f"{users} users send 2 cmd/s, STOP at t=2s")
+    print(f"{'':<12} {'spammer p50':>12} {'others p50':>11} {'others p99':>11} {'STOP wait':>10}")
+    for name, fair in (("FIFO", False), ("fair-share", True)):
+        waits, stop_wait = simulate(fair)
+        others = WaitHistogram()
+        for uid, h in waits.items():
+            if uid not in (1, 100):
+                for b, c in enumerate(h.counts):
+                    others.counts[b] += c
+                others.count += h.count
+                others.max_ms = max(others.max_ms, h.max_ms)
+        print(f"{name:<12} {waits[1].quantile(0.5):>10.0f}ms {others.quantile(0.5):>9.0f}ms "
+              f"{others.quantile(0.99):>9.0f}ms {stop_wait:>8.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
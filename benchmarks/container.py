@@ -0,0 +1,101 @@
+# benchmarks/container.py
+"""
+Cold start: import / create_app / time-to-first-heartbeat trong process mới
+(có/không schema check, có/không warm-up; backend/services/container.py).
+
+    python benchmarks/container.py
+"""
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_BENCH_CHILD = r"""
+import json, os, sys, threading, time, asyncio
+import socketio as sio_client  # client của benchmark, không tính vào thời gian khởi động
+t0 = time.perf_counter()
+import backend.app as A
+t_import = time.perf_counter()
+app = A.create_app()
+t_app = time.perf_counter()
+
+first = threading.Event()
+orig = A.dm.handle_heartbeat
+def handle(conn):
+    ok = orig(conn)
+    first.set()
+    return ok
+A.dm.handle_heartbeat = handle
+
+port = int(sys.argv[1])
+threading.Thread(target=lambda: A.socketio.run(app, port=port, allow_unsafe_werkzeug=True, log_output=False),
+                 daemon=True).start()
+
+async def device():
+    c = sio_client.AsyncClient()
+    uid = os.environ["BENCH_DEVICE_UID"]
+    for _ in range(200):
+        try:
+            await c.connect(f"http://127.0.0.1:{port}", auth={"device_uid": uid, "token": A.dm.device_token(uid)})
+            break
+        except Exception:
+            await asyncio.sleep(0.01)
+    await c.emit("device_heartbeat", {})
+    while not first.is_set():
+        await asyncio.sleep(0.001)
+    await c.disconnect()
+asyncio.run(device())
+t_hb = time.perf_counter()
+print("\nBENCH " + json.dumps({"import_ms": (t_import - t0) * 1000, "create_app_ms": (t_app - t_import) * 1000,
+                  "first_heartbeat_ms": (t_hb - t0) * 1000}), flush=True)
+os._exit(0)
+"""
+
+
+def main(runs: int = 7) -> None:
+    """Đo import / create_app / time-to-first-heartbeat trong process mới (cold start)."""
+    db_path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    base_env = dict(os.environ, DATABASE_URL=f"sqlite:///{db_path}", PYTHONPATH=ROOT,
+                    BENCH_DEVICE_UID="bench-dev-1", SKIP_SCHEMA_CHECK="0", WARMUP_ON_START="0")
+
+    # Chuẩn bị DB: 1 user + 1 thiết bị + vài nghìn thiết bị khác cho warm-up có việc làm
+    seed = (
+        "from backend.database import engine, SessionLocal\n"
+        "from backend.models import Base, User, Device\n"
+        "Base.metadata.create_all(bind=engine)\n"
+        "with SessionLocal() as db:\n"
+        "    u = User(username='bench', password_hash='x'); db.add(u); db.commit()\n"
+        "    db.add_all([Device(device_uid=f'bench-dev-{i}', name=f'd{i}', type='raspberry_pi', owner_id=u.id)"
+        " for i in range(1, 5001)]); db.commit()\n"
+    )
+    subprocess.run([sys.executable, "-c", seed], env=base_env, check=True)
+
+    def free_port() -> int:
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            return s.getsockname()[1]
+
+    print(f"cold start, {runs} runs each (median ms)")
+    print(f"{'config':<28} {'import':>8} {'create_app':>11} {'1st heartbeat':>14}")
+    for label, skip, warm in (
+        ("schema check, no warm-up", "0", "0"),
+        ("skip schema, no warm-up", "1", "0"),
+        ("skip schema, warm-up", "1", "1"),
+    ):
+        env = dict(base_env, SKIP_SCHEMA_CHECK=skip, WARMUP_ON_START=warm)
+        samples = []
+        for _ in range(runs):
+            out = subprocess.run([sys.executable, "-c", _BENCH_CHILD, str(free_port())], env=env,
+                                 capture_output=True, text=True, timeout=60)
+            line = next(ln for ln in out.stdout.splitlines() if ln.startswith("BENCH "))
+            samples.append(json.JSONDecoder().raw_decode(line[6:])[0])  # log của thread khác có thể dính sau
+        med = lambda k: sorted(s[k] for s in samples)[len(samples) // 2]
+        print(f"{label:<28} {med('import_ms'):>8.1f} {med('create_app_ms'):>11.1f} {med('first_heartbeat_ms'):>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# benchmarks/firmware.py
+"""
+Kích thước truyền firmware: full vs delta + dedup khi cả lớp upload cùng sketch
+(backend/services/firmware.py, backend/services/delta.py).
+
+    python benchmarks/firmware.py
+"""
+import hashlib
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.config import Config  # noqa: E402
+from backend.services.firmware import FirmwareStore  # noqa: E402
+
+
+def main(size: int = 512 * 1024, devices: int = 40) -> None:
+    """Kích thước truyền: full vs delta (sửa vài chỗ / chèn giữa file) + dedup khi cả lớp upload."""
+    rnd = random.Random(42)
+    root = tempfile.mkdtemp()
+    try:
+        store = FirmwareStore(root, Config.FIRMWARE_CHUNK_SIZE, Config.FIRMWARE_DELTA_BLOCK,
+                              Config.FIRMWARE_DELTA_MAX_SIZE, Config.FIRMWARE_DELTA_MIN_SAVING)
+        v1 = bytes(rnd.getrandbits(8) for _ in range(size))
+        edits = bytearray(v1)
+        for off in (1000, size // 3, size // 2, size - 5000):
+            edits[off:off + 64] = bytes(rnd.getrandbits(8) for _ in range(64))
+        cases = {
+            "4 small edits": bytes(edits),
+            "insert 1KB at middle": v1[:size // 2] + bytes(1024) + v1[size // 2:],
+            "append 8KB": v1 + bytes(rnd.getrandbits(8) for _ in range(8192)),
+            "unrelated build": bytes(rnd.getrandbits(8) for _ in range(size)),
+        }
+        base, _, _ = store.put_stream(io.BytesIO(v1), size * 2)
+        print(f"firmware {size // 1024} KB, block {store.delta_block}")
+        print(f"{'change':<22} {'full':>9} {'delta':>9} {'sent':>6} {'compute ms':>11}")
+        for name, data in cases.items():
+            sha, full, _ = store.put_stream(io.BytesIO(data), size * 2)
+            t0 = time.perf_counter()
+            encoding, _, sent = store.payload_for(base, sha)
+            ms = (time.perf_counter() - t0) * 1000
+            dsize = os.path.getsize(store.delta_path(base, sha))
+            print(f"{name:<22} {full:>9} {dsize:>9} {encoding:>6} {ms:>11.1f}")
+
+        # Cả lớp upload cùng sketch: một object trên đĩa, delta tính một lần
+        created = sum(store.put_stream(io.BytesIO(bytes(edits)), size * 2)[2] for _ in range(devices))
+        sha = hashlib.sha256(bytes(edits)).hexdigest()
+        t0 = time.perf_counter()
+        for _ in range(devices):
+            store.payload_for(base, sha)
+        objects = sum(len(files) for _, _, files in os.walk(os.path.join(root, "objects")))
+        print(f"{devices} uploads of the same sketch → {created} new objects ({objects} on disk total), "
+              f"{devices} payload lookups in {(time.perf_counter() - t0) * 1000:.1f} ms (delta cached)")
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
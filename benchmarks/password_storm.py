@@ -0,0 +1,176 @@
+# benchmarks/password_storm.py
+"""
+Độ trễ heartbeat Socket.IO của thiết bị trong một đợt đăng ký dồn dập:
+hash mật khẩu inline (trên event loop) vs process pool (backend.security.passwords).
+
+    python benchmarks/password_storm.py --devices 40 --registrations 16
+
+Mỗi chế độ chạy server thật ở process con (socketio.run như backend/app.py →
+eventlet nếu đã cài, không thì threading), DB SQLite tạm. Thiết bị giả
+(socketio.AsyncClient) lấy token qua GET /<device_id>/token, gửi
+device_heartbeat bằng call() và đo RTT; giữa chừng bắn --registrations
+POST /auth/register cùng lúc. In p50 / p99 / max RTT lúc yên và trong đợt đăng ký.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# ========= SERVER (process con) =========
+def serve(port: int, devices: int, inline: bool) -> None:
+    sys.path.insert(0, ROOT)
+    import backend.app as A
+    from backend.config import Config
+    from backend.database import SessionLocal
+    from backend.models import Device, User
+
+    app = A.app
+    if inline:
+        from werkzeug.security import generate_password_hash
+
+        import backend.routes.auth as auth
+        auth.hash_password = lambda pw: generate_password_hash(pw, method=Config.PASSWORD_HASH_METHOD)
+
+    with SessionLocal() as db:
+        owner = User(username="bench-owner", password_hash="!", role="user")
+        db.add(owner)
+        db.commit()
+        rows = [Device(device_uid=f"bench-{i:04d}", name=f"bench-{i}", type="raspberry_pi", owner_id=owner.id)
+                for i in range(devices)]
+        db.add_all(rows)
+        db.commit()
+        seed = {"owner": owner.id, "devices": [[d.id, d.device_uid] for d in rows]}
+    print(json.dumps(seed), flush=True)
+    A.socketio.run(app, host="127.0.0.1", port=port, allow_unsafe_werkzeug=True, log_output=False)
+
+
+# ========= DRIVER =========
+def _percentiles(samples: List[float]) -> Tuple[float, float, float]:
+    if not samples:
+        return 0.0, 0.0, 0.0
+    s = sorted(samples)
+    p = lambda q: s[min(len(s) - 1, int(q * len(s)))] * 1000
+    return p(0.5), p(0.99), s[-1] * 1000
+
+
+async def _drive(url: str, seed: Dict, args) -> Dict[str, Tuple[float, float, float]]:
+    import aiohttp
+    import socketio
+
+    from backend.security.identity import UserPrincipal, issue_token
+
+    bearer = {"Authorization": f"Bearer {issue_token(UserPrincipal(seed['owner'], 'bench-owner', 'user'))}"}
+    phase = "idle"
+    rtt: Dict[str, List[float]] = {"idle": [], "storm": []}
+    running = True
+
+    async with aiohttp.ClientSession() as http:
+        async def token(device_id: int) -> str:
+            async with http.get(f"{url}/{device_id}/token", headers=bearer) as resp:
+                resp.raise_for_status()
+                return (await resp.json())["token"]
+
+        clients = []
+        for device_id, uid in seed["devices"]:
+            c = socketio.AsyncClient(reconnection=False)
+            await c.connect(url, auth={"device_uid": uid, "token": await token(device_id)},
+                            transports=["websocket"], wait_timeout=10)
+            clients.append(c)
+
+        async def heartbeat(c, offset: float) -> None:
+            await asyncio.sleep(offset)
+            while running:
+                started = time.perf_counter()
+                await c.call("device_heartbeat", {}, timeout=30)
+                rtt[phase].append(time.perf_counter() - started)
+                await asyncio.sleep(args.hb_interval)
+
+        async def register(i: int) -> int:
+            body = {"username": f"storm-{i}", "password": f"pw-{i}"}
+            async with http.post(f"{url}/auth/register", json=body) as resp:
+                return resp.status
+
+        n = len(clients)
+        tasks = [asyncio.ensure_future(heartbeat(c, args.hb_interval * i / n)) for i, c in enumerate(clients)]
+        await asyncio.sleep(args.idle)
+        phase = "storm"
+        t0 = time.perf_counter()
+        statuses = await asyncio.gather(*(register(i) for i in range(args.registrations)))
+        elapsed = time.perf_counter() - t0
+        running = False
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for c in clients:
+            await c.disconnect()
+
+    return {"idle": _percentiles(rtt["idle"]), "storm": _percentiles(rtt["storm"]),
+            "elapsed": elapsed, "statuses": sorted(set(statuses))}
+
+
+def run_mode(inline: bool, args) -> Dict:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    workdir = tempfile.mkdtemp(prefix="pwstorm-")
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+               ANALYTICS_DIR=os.path.join(workdir, "analytics"), WARMUP_ON_START="0",
+               PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")])))
+    cmd = [sys.executable, os.path.abspath(__file__), "--serve", str(port), "--devices", str(args.devices)]
+    if inline:
+        cmd.append("--inline")
+    proc = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    try:
+        seed = json.loads(proc.stdout.readline())
+        url = f"http://127.0.0.1:{port}"
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        return asyncio.run(_drive(url, seed, args))
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", type=int, default=40)
+    parser.add_argument("--registrations", type=int, default=16)
+    parser.add_argument("--hb-interval", type=float, default=0.5, help="giây, policy device_heartbeat = 2/s")
+    parser.add_argument("--idle", type=float, default=2.0, help="giây đo lúc yên trước đợt đăng ký")
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--inline", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        serve(args.serve, args.devices, args.inline)
+        return 0
+
+    sys.path.insert(0, ROOT)
+    from backend.config import Config
+
+    print(f"{args.devices} devices, {args.registrations} registrations, method={Config.PASSWORD_HASH_METHOD}, "
+          f"workers={Config.PASSWORD_HASH_WORKERS}")
+    print(f"{'mode':<8} {'storm s':>8} {'idle p99':>9} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}  status")
+    for name, inline in (("inline", True), ("pool", False)):
+        r = run_mode(inline, args)
+        p50, p99, worst = r["storm"]
+        print(f"{name:<8} {r['elapsed']:>8.2f} {r['idle'][1]:>9.2f} {p50:>8.2f} {p99:>8.2f} {worst:>8.2f}  {r['statuses']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
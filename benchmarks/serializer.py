@@ -0,0 +1,81 @@
+# benchmarks/serializer.py
+"""
+Serialize snapshot n thiết bị: stdlib / orjson / fragment pre-encode (backend/serializer.py).
+
+    python benchmarks/serializer.py
+"""
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.serializer import BACKEND, orjson  # noqa: E402
+from backend.services.device_state import DeviceState  # noqa: E402
+
+
+def main(n: int = 10000, rounds: int = 5) -> None:
+    """So sánh serialize snapshot n thiết bị: stdlib / orjson / fragment pre-encode."""
+    class _Row:
+        def __init__(self, i: int) -> None:
+            self.id = i
+            self.device_uid = f"dev-{i:06d}"
+            self.name = f"Lab bench {i} “Pi”"
+            self.type = "raspberry_pi" if i % 2 else "arduino_uno"
+            self.slot = str(i % 16)
+            self.owner_id = i % 50
+            self.code_uploaded = bool(i % 3)
+            self.code_uploaded_at = None
+            self.status = ("online", "running", "stopped", "offline")[i % 4]
+            self.last_seen = datetime(2026, 1, 1) + timedelta(seconds=i)
+
+    states = [DeviceState(_Row(i)) for i in range(1, n + 1)]
+
+    def as_dicts():
+        return [
+            {
+                "id": d.device_id,
+                "device_uid": d.device_uid,
+                "name": d.name,
+                "type": d.type,
+                "status": d.status,
+                "code_uploaded": d.code_uploaded,
+                "last_seen": d.last_seen.isoformat() if d.last_seen else None,
+            }
+            for d in states
+        ]
+
+    cases = [("stdlib json (dict + isoformat)", lambda: json.dumps({"devices": as_dicts()}))]
+    if orjson is not None:
+        cases.append(("orjson (dict + isoformat)", lambda: orjson.dumps({"devices": as_dicts()})))
+    fragments = lambda: '{"devices":[' + ",".join(d.to_json() for d in states) + "]}"
+    tick = [0]
+
+    def fragments_churn():
+        # ~10% thiết bị có heartbeat mới giữa hai lần snapshot
+        tick[0] += 1
+        for d in states[tick[0] % 10::10]:
+            d.last_seen += timedelta(seconds=1)
+        return fragments()
+
+    cases.append((f"fragments, 10% changed ({BACKEND})", fragments_churn))
+    cases.append((f"fragments, unchanged ({BACKEND})", fragments))
+
+    fragments()  # phần tĩnh encode một lần, lúc nạp state
+    print(f"snapshot serialization, {n} devices, best of {rounds}")
+    for name, fn in cases:
+        best = min(_timed(fn) for _ in range(rounds))
+        print(f"{name:<34} {best * 1000:>8.2f} ms")
+    assert json.loads(cases[-1][1]()) == json.loads(cases[0][1]())
+
+
+def _timed(fn) -> float:
+    t0 = time.perf_counter()
+    fn()
+    return time.perf_counter() - t0
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+# benchmarks/wire_codec.py
+"""
+Bytes/message và thời gian encode/decode của từng codec (backend/services/wire_codec.py).
+
+    python benchmarks/wire_codec.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.services.wire_codec import available_formats, get_codec  # noqa: E402
+
+
+def main(n: int = 20000) -> None:
+    uid = "pi-lab-b-0042"
+    json_samples = {
+        "heartbeat": {"device_uid": uid},
+        "ack": {"device_uid": uid, "command_id": 123456},
+        "command": {"id": 123456, "cmd": "LED_ON"},
+        "batch": {"device_uid": uid, "events": [
+            {"event": "device_command_ack", "data": {"device_uid": uid, "command_id": 123456 + i}}
+            for i in range(20)
+        ]},
+    }
+    bin_samples = {
+        "heartbeat": {"type": "heartbeat", "handle": 42},
+        "ack": {"type": "ack", "handle": 42, "command_id": 123456},
+        "command": {"type": "command", "handle": 0, "command_id": 123456, "cmd": "LED_ON"},
+        "batch": {"type": "batch", "handle": 42, "events": [
+            {"type": "ack", "handle": 42, "command_id": 123456 + i} for i in range(20)
+        ]},
+    }
+
+    print(f"{'format':<8} {'message':<10} {'bytes':>6} {'encode us':>10} {'decode us':>10}")
+    for fmt in available_formats():
+        codec = get_codec(fmt)
+        samples = json_samples if fmt == "json" else bin_samples
+        for kind, msg in samples.items():
+            t0 = time.perf_counter()
+            for _ in range(n):
+                data = codec.encode(msg)
+            t1 = time.perf_counter()
+            for _ in range(n):
+                codec.decode(data)
+            t2 = time.perf_counter()
+            print(f"{fmt:<8} {kind:<10} {len(data):>6} "
+                  f"{(t1 - t0) / n * 1e6:>10.2f} {(t2 - t1) / n * 1e6:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
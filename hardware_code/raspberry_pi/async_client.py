@@ -0,0 +1,524 @@
+# hardware_code/raspberry_pi/async_client.py
+"""
+Thư viện client asyncio cho thiết bị (Raspberry Pi).
+
+- Lệnh phần cứng (GPIO/Serial) chạy trong executor → không chặn event loop
+- Reconnect exponential backoff + full jitter → tránh thundering herd khi server restart
+- Outbox trên đĩa (SQLite): ack/telemetry được giữ lại khi mất kết nối, gửi lại theo batch
+- Heartbeat piggyback: gói tin nào gửi đi cũng mang cờ heartbeat khi tới hạn,
+  heartbeat riêng chỉ gửi khi không có traffic nào khác
+- Wire protocol nhị phân tuỳ chọn (wire_format="msgpack" | "struct"), cần
+  backend/services/wire_codec.py (copy cạnh file này nếu chạy trên Pi)
+- Token thiết bị: truyền token=, hoặc device_id= + api_token= (bearer của chủ
+  thiết bị, từ POST /auth/token) → client tự lấy qua GET /<device_id>/token
+- Nhận firmware theo chunk (full hoặc delta so với bản hiện tại), resume từ
+  file .part sau khi mất kết nối, kiểm sha256 rồi mới báo `firmware_verified`;
+  cần backend/services/delta.py (copy cạnh file này nếu chạy trên Pi)
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import socketio
+
+
+class Backoff:
+    """Exponential backoff với full jitter: delay ~ U(0, min(cap, base * 2^n))."""
+
+    def __init__(self, base: float = 1.0, cap: float = 60.0) -> None:
+        self.base = base
+        self.cap = cap
+        self.attempt = 0
+
+    def next_delay(self) -> float:
+        ceiling = min(self.cap, self.base * (2 ** self.attempt))
+        self.attempt += 1
+        return random.uniform(0, ceiling)
+
+    def reset(self) -> None:
+        self.attempt = 0
+
+
+class Outbox:
+    """Hàng đợi FIFO trên đĩa cho các event chưa gửi được."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " event TEXT NOT NULL,"
+            " payload TEXT NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def put(self, event: str, payload: Dict[str, Any]) -> None:
+        self._conn.execute(
+            "INSERT INTO outbox (event, payload, created_at) VALUES (?, ?, ?)",
+            (event, json.dumps(payload), time.time()),
+        )
+        self._conn.commit()
+
+    def peek(self, limit: int) -> List[Tuple[int, str, Dict[str, Any]]]:
+        rows = self._conn.execute(
+            "SELECT id, event, payload FROM outbox ORDER BY id ASC LIMIT ?", (limit,)
+        ).fetchall()
+        return [(r[0], r[1], json.loads(r[2])) for r in rows]
+
+    def remove(self, ids: List[int]) -> None:
+        if not ids:
+            return
+        self._conn.executemany("DELETE FROM outbox WHERE id = ?", [(i,) for i in ids])
+        self._conn.commit()
+
+    def __len__(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+def _load_codec(fmt: str):
+    try:
+        from backend.services.wire_codec import get_codec
+    except ImportError:
+        from wire_codec import get_codec
+    return get_codec(fmt)
+
+
+def _load_delta():
+    try:
+        from backend.services import delta
+    except ImportError:
+        import delta
+    return delta
+
+
+def _sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for buf in iter(lambda: f.read(64 * 1024), b""):
+            h.update(buf)
+    return h.hexdigest()
+
+
+class AsyncDeviceClient:
+    """Client Socket.IO bất đồng bộ cho một thiết bị."""
+
+    FIRMWARE_WINDOW = 4  # số chunk firmware xin song song
+    FLUSH_RETRY_CAP = 30.0  # s, backoff tối đa khi server bận / drop batch
+
+    def __init__(
+        self,
+        server_url: str,
+        device_uid: str,
+        *,
+        heartbeat_interval: float = 3.0,
+        outbox_path: Optional[str] = None,
+        batch_size: int = 50,
+        batch_rate: float = 4.0,
+        executor_workers: int = 2,
+        backoff_base: float = 1.0,
+        backoff_cap: float = 60.0,
+        transports: Tuple[str, ...] = ("websocket",),
+        wire_format: str = "json",
+        token: Optional[str] = None,
+        device_id: Optional[int] = None,
+        api_token: Optional[str] = None,
+        firmware_dir: Optional[str] = None,
+        on_firmware: Optional[Callable[[str, str], Any]] = None,
+    ) -> None:
+        self.server_url = server_url
+        self.device_uid = device_uid
+        self.heartbeat_interval = heartbeat_interval
+        self.batch_size = batch_size
+        # Server giới hạn device_batch 5/s (vượt → disconnect) → flush outbox chậm hơn mức đó
+        self.batch_rate = batch_rate
+        self.transports = list(transports)
+        self.wire_format = wire_format
+        self.token = token
+        self.device_id = device_id
+        self.api_token = api_token
+        self._codec = _load_codec(wire_format) if wire_format != "json" else None
+        self._handle: Optional[int] = None  # handle server cấp khi negotiate binary
+        # Firmware: <dir>/current (+ current.sha256); on_firmware(path, sha256) để flash, chạy trong executor
+        self.firmware_dir = firmware_dir or os.path.join(os.getcwd(), f"firmware-{device_uid}")
+        self.on_firmware = on_firmware
+        self._firmware_task: Optional[asyncio.Task] = None
+        self._flush_task: Optional[asyncio.Task] = None
+
+        self.sio = socketio.AsyncClient(reconnection=False)
+        self.outbox = Outbox(outbox_path or os.path.join(os.getcwd(), f"outbox-{device_uid}.db"))
+        self.backoff = Backoff(backoff_base, backoff_cap)
+        self.executor = ThreadPoolExecutor(max_workers=executor_workers)
+
+        self._handlers: Dict[str, Callable[[Dict[str, Any]], Any]] = {}
+        self._last_heartbeat = 0.0
+        self._connected = asyncio.Event()
+        self._disconnected = asyncio.Event()
+        self._stopping = False
+
+        self.sio.on("connect", self._on_connect)
+        self.sio.on("disconnect", self._on_disconnect)
+        self.sio.on("device_command", self._on_device_command)
+        self.sio.on("device_broadcast", self._on_device_broadcast)
+        self.sio.on("device_commands", self._on_device_commands)
+        self.sio.on("heartbeat_config", self._on_heartbeat_config)
+        self.sio.on("wire_config", self._on_wire_config)
+        self.sio.on("device_bin", self._on_device_bin)
+        self.sio.on("firmware_offer", self._on_firmware_offer)
+
+    # ========= HANDLER REGISTRATION =========
+    def command(self, name: str):
+        """Decorator đăng ký hàm (blocking) xử lý một command, vd @client.command("led_on")."""
+        def decorator(fn: Callable[[Dict[str, Any]], Any]):
+            self._handlers[name.lower()] = fn
+            return fn
+        return decorator
+
+    # ========= SEND / OUTBOX =========
+    def _stamp(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """Gắn cờ heartbeat (piggyback) nếu heartbeat đã tới hạn.
+
+        Không cần device_uid trong payload: server đã bind sid → thiết bị lúc connect.
+        """
+        payload = dict(payload)
+        now = time.monotonic()
+        if now - self._last_heartbeat >= self.heartbeat_interval / 2:
+            payload["heartbeat"] = True
+            self._last_heartbeat = now
+        return payload
+
+    def _to_message(self, event: str, payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Event JSON → message nhị phân; None nếu event không có dạng binary."""
+        if event == "device_heartbeat":
+            return {"type": "heartbeat", "handle": self._handle}
+        if event == "device_command_ack" and payload.get("command_id") is not None:
+            return {"type": "ack", "handle": self._handle, "command_id": int(payload["command_id"])}
+        if event == "device_batch":
+            events = [self._to_message(e["event"], e["data"]) for e in payload["events"]]
+            if all(events):
+                return {"type": "batch", "handle": self._handle, "events": events}
+        return None
+
+    async def _emit(self, event: str, payload: Dict[str, Any], call: bool = False) -> Any:
+        """Emit qua binary nếu đã negotiate và event hỗ trợ, ngược lại JSON."""
+        if self._codec is not None and self._handle is not None:
+            msg = self._to_message(event, payload)
+            if msg is not None:
+                # Frame binary nào server cũng tính là heartbeat
+                self._last_heartbeat = time.monotonic()
+                frame = self._codec.encode(msg)
+                if call:
+                    return await self.sio.call("device_bin", frame, timeout=10)
+                return await self.sio.emit("device_bin", frame)
+        if call:
+            return await self.sio.call(event, self._stamp(payload), timeout=10)
+        return await self.sio.emit(event, self._stamp(payload))
+
+    async def send(self, event: str, payload: Dict[str, Any]) -> None:
+        """Gửi ngay nếu đang kết nối, ngược lại ghi vào outbox."""
+        if self._connected.is_set():
+            try:
+                await self._emit(event, payload)
+                return
+            except socketio.exceptions.SocketIOError:
+                pass
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.outbox.put, event, payload)
+
+    async def ack(self, command_id: int, **extra: Any) -> None:
+        await self.send("device_command_ack", {"command_id": command_id, **extra})
+
+    async def telemetry(self, data: Dict[str, Any]) -> None:
+        await self.send("device_telemetry", {"data": data, "ts": time.time()})
+
+    async def _flush_outbox(self) -> int:
+        """
+        Gửi lại outbox theo batch (1 frame `device_batch` / batch_size event), tối đa batch_rate batch/s.
+        Server bận / drop (None) → thử lại với backoff khi vẫn còn kết nối; "busy" kèm
+        processed → bỏ các event đầu đã xử lý, không gửi trùng.
+        """
+        loop = asyncio.get_running_loop()
+        interval = 1.0 / self.batch_rate
+        retry = Backoff(interval, self.FLUSH_RETRY_CAP)
+        sent = 0
+        while self._connected.is_set():
+            rows = await loop.run_in_executor(self.executor, self.outbox.peek, self.batch_size)
+            if not rows:
+                break
+            batch = {"events": [{"event": ev, "data": data} for _, ev, data in rows]}
+            try:
+                resp = await self._emit("device_batch", batch, call=True)
+            except (socketio.exceptions.SocketIOError, asyncio.TimeoutError):
+                resp = None
+            ok = isinstance(resp, dict) and resp.get("ok") is True
+            done = len(rows) if ok else 0
+            if isinstance(resp, dict) and not ok and isinstance(resp.get("processed"), int):
+                done = max(0, min(resp["processed"], len(rows)))
+            if done:
+                await loop.run_in_executor(self.executor, self.outbox.remove, [r[0] for r in rows[:done]])
+                sent += done
+            if ok:
+                retry.reset()
+                await asyncio.sleep(interval)
+            else:
+                await asyncio.sleep(interval + retry.next_delay())
+        return sent
+
+    def _start_flush(self) -> None:
+        """Một task flush tại một thời điểm; giữ tham chiếu để task không bị GC, log lỗi."""
+        if self._flush_task is not None and not self._flush_task.done():
+            return
+        self._flush_task = asyncio.create_task(self._flush_outbox())
+        self._flush_task.add_done_callback(self._flush_done)
+
+    @staticmethod
+    def _flush_done(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Outbox flush failed: {task.exception()!r}")
+
+    # ========= SOCKET EVENTS =========
+    async def _on_connect(self) -> None:
+        print(f"Connected to server as {self.device_uid}")
+        self.backoff.reset()
+        self._disconnected.clear()
+        self._connected.set()
+        self._last_heartbeat = 0.0
+        await self._emit("device_heartbeat", {})
+        self._start_flush()
+
+    async def _on_disconnect(self, *args: Any) -> None:
+        print("Disconnected from server")
+        self._handle = None
+        self._connected.clear()
+        self._disconnected.set()
+
+    async def _on_heartbeat_config(self, data: Dict[str, Any]) -> None:
+        """Server điều chỉnh heartbeat interval (adaptive, theo tải + watchdog)."""
+        try:
+            interval = float(data.get("interval"))
+        except (TypeError, ValueError):
+            return
+        if interval > 0:
+            self.heartbeat_interval = interval
+
+    async def _on_wire_config(self, data: Dict[str, Any]) -> None:
+        """Kết quả negotiate: server trả format + handle (hoặc ép về JSON)."""
+        if data.get("format") == self.wire_format and self._codec is not None:
+            self._handle = data.get("handle")
+        else:
+            self._handle = None
+
+    async def _on_device_bin(self, frame: bytes) -> None:
+        if self._codec is None:
+            return
+        try:
+            msg = self._codec.decode(frame)
+        except ValueError:
+            return
+        if msg.get("type") == "command":
+            if msg.get("handle") != self._handle:
+                return  # command của thiết bị khác
+            await self._on_device_command({"id": msg["command_id"], "cmd": msg.get("cmd", "")})
+        elif msg.get("type") == "batch":
+            # Broadcast theo nhóm: chỉ lấy command có handle của mình
+            for sub in msg.get("events", []):
+                if sub.get("type") == "command" and sub.get("handle") == self._handle:
+                    await self._on_device_command({"id": sub["command_id"], "cmd": sub.get("cmd", "")})
+
+    async def _on_device_commands(self, data: Dict[str, Any]) -> None:
+        """Batch replay backlog sau khi reconnect: chạy tuần tự theo thứ tự server gửi."""
+        for item in data.get("commands") or []:
+            await self._on_device_command(item)
+
+    async def _on_device_broadcast(self, data: Dict[str, Any]) -> None:
+        """Broadcast theo nhóm: 1 frame cho cả room, mỗi thiết bị có command_id riêng."""
+        cmd_id = (data.get("targets") or {}).get(self.device_uid)
+        if cmd_id is not None:
+            await self._on_device_command({"id": cmd_id, "cmd": data.get("cmd", "")})
+
+    async def _on_device_command(self, data: Dict[str, Any]) -> None:
+        cmd_id = data.get("id")
+        cmd = (data.get("cmd") or data.get("action") or "").lower()
+        handler = self._handlers.get(cmd)
+        if handler is None:
+            return
+        # Chạy phần cứng trong executor, không chặn việc nhận heartbeat/command khác
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self.executor, handler, data)
+        except Exception as e:
+            print(f"Command {cmd} failed: {e}")
+            return
+        if cmd_id:
+            await self.ack(cmd_id)
+
+    # ========= FIRMWARE =========
+    def firmware_sha(self) -> Optional[str]:
+        try:
+            with open(os.path.join(self.firmware_dir, "current.sha256")) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    async def _on_firmware_offer(self, data: Dict[str, Any]) -> None:
+        # Offer mới (hoặc offer lại sau reconnect) thay cho lần tải đang dở
+        if self._firmware_task is not None and not self._firmware_task.done():
+            self._firmware_task.cancel()
+        self._firmware_task = asyncio.create_task(self._fetch_firmware(data))
+
+    def _prepare_part(self, part: str, chunk_size: int) -> int:
+        """Giữ phần đã tải (bội số chunk) của file .part, trả về chunk tiếp theo cần xin."""
+        os.makedirs(self.firmware_dir, exist_ok=True)
+        have = os.path.getsize(part) if os.path.exists(part) else 0
+        start = have // chunk_size
+        with open(part, "ab") as f:
+            f.truncate(start * chunk_size)
+        return start
+
+    @staticmethod
+    def _append(part: str, data: bytes) -> None:
+        with open(part, "ab") as f:
+            f.write(data)
+
+    def _install(self, part: str, encoding: str, sha: str) -> bool:
+        """Dựng bản mới (full / delta + bản hiện tại), kiểm sha256, thay current."""
+        current = os.path.join(self.firmware_dir, "current")
+        staged = os.path.join(self.firmware_dir, f"{sha}.new")
+        if encoding == "delta":
+            _load_delta().apply_delta(current, part, staged)
+            os.remove(part)
+        else:
+            os.replace(part, staged)
+        if _sha256_file(staged) != sha:
+            os.remove(staged)
+            return False
+        os.replace(staged, current)
+        with open(os.path.join(self.firmware_dir, "current.sha256"), "w") as f:
+            f.write(sha)
+        if self.on_firmware is not None:
+            self.on_firmware(current, sha)
+        return True
+
+    async def _fetch_firmware(self, offer: Dict[str, Any]) -> None:
+        sha, encoding = offer["sha256"], offer.get("encoding", "full")
+        chunk_size, chunks = int(offer["chunk_size"]), int(offer["chunks"])
+        if encoding == "delta" and self.firmware_sha() != offer.get("base"):
+            await self.sio.emit("firmware_failed", {"sha256": sha, "reason": "base_mismatch"})
+            return
+
+        loop = asyncio.get_running_loop()
+        part = os.path.join(self.firmware_dir, f"{sha}.{encoding}.part")
+        index = await loop.run_in_executor(self.executor, self._prepare_part, part, chunk_size)
+
+        async def fetch(i: int) -> Optional[bytes]:
+            for attempt in range(1, 21):
+                resp = await self.sio.call("firmware_chunk", {"sha256": sha, "index": i}, timeout=30)
+                if isinstance(resp, dict):
+                    return resp["data"] if resp.get("ok") else None
+                await asyncio.sleep(min(2.0, 0.1 * attempt))  # bị rate limit drop → thử lại
+            return None
+
+        # Giữ FIRMWARE_WINDOW request chunk đang bay, ghi ra .part đúng thứ tự
+        pending: Dict[int, asyncio.Task] = {}
+        try:
+            while index < chunks:
+                for i in range(index, min(chunks, index + self.FIRMWARE_WINDOW)):
+                    if i not in pending:
+                        pending[i] = asyncio.create_task(fetch(i))
+                data = await pending.pop(index)
+                if data is None:
+                    for task in pending.values():
+                        task.cancel()
+                    return  # transfer không còn (deploy bản khác) → chờ offer mới
+                await loop.run_in_executor(self.executor, self._append, part, data)
+                index += 1
+        except (socketio.exceptions.SocketIOError, asyncio.TimeoutError):
+            for task in pending.values():
+                task.cancel()
+            return  # mất kết nối: giữ .part, resume khi server offer lại
+
+        try:
+            ok = await loop.run_in_executor(self.executor, self._install, part, encoding, sha)
+        except Exception as e:
+            await self.sio.emit("firmware_failed", {"sha256": sha, "reason": f"install_error: {e}"})
+            return
+        if not ok:
+            await self.sio.emit("firmware_failed", {"sha256": sha, "reason": "checksum_mismatch"})
+            return
+        print(f"Firmware {sha[:12]} installed ({encoding})")
+        await self.sio.emit("firmware_verified", {"sha256": sha})
+
+    # ========= DEVICE TOKEN =========
+    async def fetch_token(self) -> str:
+        """GET /<device_id>/token bằng bearer token của chủ thiết bị → token connect Socket.IO."""
+        import aiohttp  # dependency của socketio.AsyncClient
+
+        url = f"{self.server_url.rstrip('/')}/{self.device_id}/token"
+        async with aiohttp.ClientSession() as http:
+            async with http.get(url, headers={"Authorization": f"Bearer {self.api_token}"}) as resp:
+                data = await resp.json(content_type=None)
+                if resp.status != 200:
+                    raise ConnectionError(f"device token: HTTP {resp.status} {data.get('error')}")
+        if data.get("device_uid") != self.device_uid:
+            raise ValueError(f"device {self.device_id} is {data.get('device_uid')}, not {self.device_uid}")
+        self.token = data["token"]
+        return self.token
+
+    # ========= LOOPS =========
+    async def _heartbeat_loop(self) -> None:
+        while not self._stopping:
+            await self._connected.wait()
+            due = self._last_heartbeat + self.heartbeat_interval
+            delay = due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            # Không có traffic nào mang heartbeat trong interval → gửi heartbeat riêng
+            try:
+                await self._emit("device_heartbeat", {})
+            except socketio.exceptions.SocketIOError:
+                await asyncio.sleep(self.heartbeat_interval)
+
+    async def run(self) -> None:
+        """Vòng kết nối chính: connect → chờ disconnect → backoff có jitter → connect lại."""
+        hb_task = asyncio.create_task(self._heartbeat_loop())
+        try:
+            while not self._stopping:
+                try:
+                    if self.token is None and self.api_token and self.device_id is not None:
+                        await self.fetch_token()
+                    await self.sio.connect(
+                        self.server_url,
+                        transports=self.transports,
+                        auth={"device_uid": self.device_uid, "token": self.token, "wire": self.wire_format},
+                    )
+                    await self._disconnected.wait()
+                except (socketio.exceptions.ConnectionError, ConnectionError, OSError, ValueError) as e:
+                    print(f"Connect failed: {e}")
+                if self._stopping:
+                    break
+                delay = self.backoff.next_delay()
+                print(f"Reconnecting in {delay:.1f}s (attempt {self.backoff.attempt})")
+                await asyncio.sleep(delay)
+        finally:
+            hb_task.cancel()
+
+    async def stop(self) -> None:
+        self._stopping = True
+        self._disconnected.set()
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        if self.sio.connected:
+            await self.sio.disconnect()
+        self.executor.shutdown(wait=False)
+        self.outbox.close()
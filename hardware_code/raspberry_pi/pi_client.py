@@ -1,39 +1,45 @@
-import socketio
+import asyncio
+import os
 import time
-import requests
 
-sio = socketio.Client()
-DEVICE_UID = "pi-001"   # đổi theo DB
+from async_client import AsyncDeviceClient
 
-@sio.event
-def connect():
-    print("Connected to server")
-    # gửi heartbeat định kỳ ở thread khác hoặc đơn giản ở đây
-    sio.emit("device_heartbeat", {"device_uid": DEVICE_UID})
+DEVICE_UID = os.getenv("DEVICE_UID", "pi-001")   # đổi theo DB
+SERVER_URL = os.getenv("SERVER_URL", "http://<SERVER-IP>:5000")
+# Token thiết bị: đặt DEVICE_TOKEN trực tiếp, hoặc DEVICE_ID + API_TOKEN (bearer của chủ
+# thiết bị từ POST /auth/token) để client tự lấy qua GET /<device_id>/token
+DEVICE_TOKEN = os.getenv("DEVICE_TOKEN") or None
+DEVICE_ID = int(os.environ["DEVICE_ID"]) if os.getenv("DEVICE_ID") else None
+API_TOKEN = os.getenv("API_TOKEN") or None
 
-@sio.on("device_command")
-def on_device_command(data):
+client = AsyncDeviceClient(
+    SERVER_URL, DEVICE_UID,
+    token=DEVICE_TOKEN, device_id=DEVICE_ID, api_token=API_TOKEN,
+    heartbeat_interval=3.0,
+)
+
+
+# TODO: thực thi phần cứng (GPIO/Serial)
+# Các handler chạy trong thread pool nên có thể blocking mà không chặn heartbeat
+@client.command("start")
+@client.command("stop")
+@client.command("led_on")
+@client.command("led_off")
+@client.command("watchdog_reset")
+def simulate(data):
     print("Received command:", data)
-    cmd_id = data.get("id")
-    cmd = (data.get("cmd") or data.get("action") or "").lower()
-
-    # TODO: thực thi phần cứng (GPIO/Serial)
-    # ví dụ test:
-    if cmd in ("start", "stop", "led_on", "led_off", "watchdog_reset"):
-        time.sleep(0.5)  # giả lập
-        if cmd_id:
-            sio.emit("device_command_ack", {"device_uid": DEVICE_UID, "command_id": cmd_id})
-
-def main():
-    sio.connect("http://<SERVER-IP>:5000", transports=["websocket"])
+    time.sleep(0.5)  # giả lập
+
+
+async def main():
     try:
-        while True:
-            time.sleep(3)
-            sio.emit("device_heartbeat", {"device_uid": DEVICE_UID})
-    except KeyboardInterrupt:
-        pass
+        await client.run()
     finally:
-        sio.disconnect()
+        await client.stop()
+
 
 if __name__ == "__main__":
-    main()
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,69 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# backend.config đọc env lúc import → DB / thư mục dữ liệu tạm, không đụng iotlab.db
+_workdir = tempfile.mkdtemp(prefix="iotlab-test-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_workdir, 'test.db')}"
+os.environ["DATABASE_READ_URL"] = ""
+os.environ["ANALYTICS_DIR"] = os.path.join(_workdir, "analytics")
+os.environ["FIRMWARE_DIR"] = os.path.join(_workdir, "firmware")
+os.environ["WARMUP_ON_START"] = "0"
+
+import itertools  # noqa: E402
+
+import pytest  # noqa: E402
+
+_seq = itertools.count(1)
+
+
+@pytest.fixture(scope="session")
+def app():
+    from backend.app import create_app
+
+    app = create_app()
+    app.config["TESTING"] = True
+    return app
+
+
+@pytest.fixture
+def make_user(app):
+    """make_user(role) → user_id; username không trùng giữa các test (bucket rate limit riêng)."""
+    from backend.database import SessionLocal
+    from backend.models import User
+
+    def make(role: str = "user") -> int:
+        with SessionLocal() as db:
+            user = User(username=f"test-user-{next(_seq)}", password_hash="!", role=role)
+            db.add(user)
+            db.commit()
+            return user.id
+
+    return make
+
+
+@pytest.fixture
+def make_devices(app):
+    """make_devices(owner_id, n, type) → [device_id]; nạp luôn vào state store in-memory."""
+    from backend.database import SessionLocal
+    from backend.models import Device
+    from backend.services.container import dm
+
+    def make(owner_id: int, n: int, type: str = "arduino_uno") -> list:
+        with SessionLocal() as db:
+            devices = []
+            for _ in range(n):
+                k = next(_seq)
+                devices.append(Device(device_uid=f"test-dev-{k}", name=f"dev-{k:06d}", type=type, owner_id=owner_id))
+            db.add_all(devices)
+            db.commit()
+            ids = [d.id for d in devices]
+        dm.states.load()
+        for device_id in ids:
+            dm.states.refresh(device_id)
+        return ids
+
+    return make
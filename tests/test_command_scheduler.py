@@ -0,0 +1,205 @@
+"""
+CommandScheduler: class / weight tra từ role trong DB, quota theo user, và
+broadcast đi qua queue + giới hạn in-flight như command đơn lẻ.
+
+Scheduler riêng cho mỗi test, không chạy worker: test tự gọi _pop_next()
+thay cho dispatcher để thấy đúng thứ tự và số command được phát.
+"""
+import threading
+import uuid
+
+import pytest
+
+from backend.config import Config
+from backend.database import SessionLocal
+from backend.models import User
+from backend.services.command_scheduler import CommandRejected, CommandScheduler
+from backend.services.connection_registry import DeviceConnection
+from backend.services.container import dm
+
+CLASSES = ["safety", "instructor", "student"]
+USER_BURST = 30  # policy "command_user": burst 30
+
+
+def _scheduler(role_weights=None, **opts):
+    kw = dict(rate=100.0, max_queued=100, max_inflight=100, inflight_timeout=30.0)
+    kw.update(opts)
+    sch = CommandScheduler(CLASSES, ["stop"], ["admin", "instructor"],
+                           role_weights if role_weights is not None else {"admin": 2.0, "instructor": 2.0}, **kw)
+    sch._ensure_worker = lambda: None
+    return sch
+
+
+def _drain(sch, limit=1000):
+    items = []
+    while len(items) < limit:
+        item = sch._pop_next()
+        if item is None:
+            break
+        items.append(item)
+    return items
+
+
+# ========= CLASSIFY / ADMIT =========
+def test_classify_uses_role_from_db(make_user):
+    sch = _scheduler()
+    student, teacher = make_user("user"), make_user("instructor")
+
+    assert sch.classify("led_on", student) == "student"
+    assert sch.classify("led_on", teacher) == "instructor"
+    assert sch.classify("STOP", student) == "safety"
+    assert sch.admit(teacher, "led_on") == "instructor"
+    assert sch._weights[teacher] == 2.0
+    sch.admit(student, "led_on")
+    assert sch._weights[student] == 1.0
+
+
+def test_register_ignores_role_in_body(app):
+    username = f"reg-{uuid.uuid4().hex[:8]}"
+    res = app.test_client().post("/auth/register", json={"username": username, "password": "pw", "role": "admin"})
+    assert res.status_code == 201
+    with SessionLocal() as db:
+        user = db.query(User).filter_by(username=username).one()
+        assert user.role == "user"
+        user_id = user.id
+    assert _scheduler().classify("led_on", user_id) == "student"
+
+
+def test_weighted_share_within_class(make_user):
+    # admin weight 2, instructor weight 1, cùng class "instructor" → admin được 2 phần
+    sch = _scheduler({"admin": 2.0})
+    heavy, light = make_user("admin"), make_user("instructor")
+    cid = 0
+    for user_id in (heavy, light):
+        klass = sch.admit(user_id, "led_on", cost=6)
+        for _ in range(6):
+            cid += 1
+            sch.submit(cid, cid, user_id, "led_on", klass)
+
+    first = _drain(sch, limit=6)
+    assert [i.user_id for i in first].count(heavy) == 4
+    assert [i.user_id for i in first].count(light) == 2
+
+
+def test_class_priority(make_user):
+    sch = _scheduler()
+    student, teacher = make_user(), make_user("instructor")
+    sch.submit(1, 1, student, "led_on", sch.admit(student, "led_on"))
+    sch.submit(2, 2, teacher, "led_on", sch.admit(teacher, "led_on"))
+    sch.submit(3, 3, student, "stop", sch.admit(student, "stop"))
+
+    assert [i.command_id for i in _drain(sch)] == [3, 2, 1]
+
+
+def test_admit_rate_quota(make_user):
+    sch = _scheduler()
+    user_id = make_user()
+
+    sch.admit(user_id, "led_on", cost=USER_BURST)
+    with pytest.raises(CommandRejected) as e:
+        sch.admit(user_id, "led_on")
+    assert e.value.reason == "rate"
+    assert e.value.retry_after > 0
+    assert sch.admit(user_id, "stop", cost=USER_BURST) == "safety"  # STOP không bị chặn
+    assert sch.stats()["rejected"] == {"rate": 1}
+
+
+def test_admit_queue_quota(make_user):
+    sch = _scheduler(max_queued=3)
+    user_id = make_user()
+    for cid in range(1, 4):
+        sch.submit(cid, cid, user_id, "led_on", sch.admit(user_id, "led_on"))
+
+    with pytest.raises(CommandRejected) as e:
+        sch.admit(user_id, "led_on")
+    assert e.value.reason == "queue_full"
+
+    sch.discard([1])
+    sch.admit(user_id, "led_on")  # còn chỗ lại sau khi bớt 1
+
+
+def test_inflight_limit_and_ack(make_user):
+    sch = _scheduler(max_inflight=2)
+    sch._wake = threading.Event()
+    user_id = make_user()
+    for cid in range(1, 5):
+        sch.submit(cid, cid, user_id, "led_on", sch.admit(user_id, "led_on"))
+
+    sent = _drain(sch)
+    assert [i.command_id for i in sent] == [1, 2]
+    sch._wake.clear()
+    sch.on_ack(1, user_id)
+    assert sch._wake.is_set()  # dispatcher đang chờ được đánh thức ngay
+    assert [i.command_id for i in _drain(sch)] == [3]
+
+
+# ========= BROADCAST =========
+@pytest.fixture
+def scheduler(monkeypatch):
+    sch = _scheduler(max_inflight=2)
+    sch.bind(dm._dispatch_scheduled)
+    monkeypatch.setattr(dm, "scheduler", sch)
+    return sch
+
+
+@pytest.fixture
+def tagged_group(make_user, make_devices):
+    """4 thiết bị cùng tag, 3 đang connect."""
+    owner = make_user()
+    tag = f"grp-{uuid.uuid4().hex[:8]}"
+    ids = make_devices(owner, 4)
+    channels = Config.SOCKETIO_CHANNELS
+    sids = []
+    for device_id in ids:
+        dm.set_device_tags(device_id, [tag])
+    for device_id in ids[:3]:
+        st = dm.device_state(device_id)
+        sid = f"sid-{uuid.uuid4().hex}"
+        dm.connections.bind(DeviceConnection(sid, device_id, st.device_uid, st.type,
+                                             channels[device_id % len(channels)]))
+        sids.append(sid)
+    yield owner, tag, ids
+    for sid in sids:
+        dm.connections.unbind(sid)
+
+
+def test_broadcast_goes_through_scheduler(app, scheduler, tagged_group):
+    owner, tag, ids = tagged_group
+
+    progress = dm.broadcast_command(owner, "led_on", {"tag": tag})
+    assert progress["targets"] == 4
+    assert progress["counts"] == {"pending": 4}
+    user = scheduler.stats()["users"][owner]
+    assert (user["queued"], user["inflight"]) == (3, 0)  # chỉ thiết bị đang connect, chưa phát
+
+    # Dispatcher: tối đa max_inflight command của user tới khi có ack
+    sent = _drain(scheduler)
+    assert len(sent) == 2
+    assert {i.device_id for i in sent} < set(ids[:3])
+    assert scheduler.stats()["users"][owner]["inflight"] == 2
+
+    scheduler.on_ack(sent[0].command_id, owner)
+    assert len(_drain(scheduler)) == 1
+    assert scheduler.stats()["users"][owner]["queued"] == 0
+
+
+def test_broadcast_quota_counts_targets(app, scheduler, tagged_group):
+    owner, tag, _ = tagged_group
+    scheduler.admit(owner, "led_on", cost=USER_BURST - 2)  # còn 2 token, nhóm có 4 thiết bị
+
+    with pytest.raises(CommandRejected):
+        dm.broadcast_command(owner, "led_on", {"tag": tag})
+    assert scheduler.stats()["users"].get(owner, {}).get("queued", 0) == 0
+
+
+def test_safety_broadcast_is_sent_and_tracked(app, scheduler, tagged_group):
+    owner, tag, _ = tagged_group
+
+    progress = dm.broadcast_command(owner, "stop", {"tag": tag})
+    assert progress["counts"] == {"sent": 3, "pending": 1}
+    user = scheduler.stats()["users"][owner]
+    assert (user["queued"], user["inflight"]) == (0, 3)  # phát ngay nhưng vẫn giữ chỗ in-flight
+
+    # Command thường của user chờ tới khi các STOP được ack
+    scheduler.submit(10**9, 1, owner, "led_on", "student")
+    assert _drain(scheduler) == []
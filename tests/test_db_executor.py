@@ -0,0 +1,129 @@
+"""
+Event loop không bị chặn khi query DB chậm chạy qua db_executor.
+
+Một "heartbeat" tick mỗi TICK giây trong lúc vài query SQLite chậm chạy;
+độ trễ của tick là độ trễ mà heartbeat của thiết bị phải chịu.
+"""
+import threading
+import time
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import NullPool
+
+from backend.services.db_executor import DBBusy, DBExecutor
+
+SLOW_QUERIES = 4
+SLOW_SECONDS = 0.25
+TICK = 0.01
+MAX_P99_MS = 50.0
+
+# CTE đệ quy lặp lại → giữ thread trong SQLite, giống fsync / lock chậm
+_SLOW_SQL = text(
+    "WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n WHERE x < 20000) SELECT count(*) FROM n"
+)
+
+
+@pytest.fixture
+def slow_query(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'slow.db'}", poolclass=NullPool, future=True)
+
+    def run() -> None:
+        deadline = time.perf_counter() + SLOW_SECONDS
+        with engine.connect() as c:
+            while time.perf_counter() < deadline:
+                c.execute(_SLOW_SQL).scalar()
+
+    yield run
+    engine.dispose()
+
+
+def _p99(lateness):
+    lateness = sorted(lateness)
+    return lateness[min(len(lateness) - 1, int(0.99 * len(lateness)))]
+
+
+def _eventlet_lateness(eventlet, run, job):
+    """Độ trễ (ms) của greenlet tick trong lúc SLOW_QUERIES greenlet gọi run(job)."""
+    lateness = []
+    done = []
+
+    def ticker():
+        while not done:
+            t0 = time.perf_counter()
+            eventlet.sleep(TICK)
+            lateness.append((time.perf_counter() - t0 - TICK) * 1000)
+
+    t = eventlet.spawn(ticker)
+    eventlet.sleep(TICK * 3)
+    pool = eventlet.GreenPool()
+    for _ in range(SLOW_QUERIES):
+        pool.spawn(run, job)
+    pool.waitall()
+    done.append(True)
+    t.wait()
+    return lateness
+
+
+def test_eventlet_hub_stays_responsive(slow_query):
+    eventlet = pytest.importorskip("eventlet")
+    executor = DBExecutor(workers=SLOW_QUERIES, max_queue=16, timeout=30)
+    executor._mode = "eventlet"
+
+    inline = _eventlet_lateness(eventlet, lambda fn: fn(), slow_query)
+    pooled = _eventlet_lateness(eventlet, executor.run, slow_query)
+
+    # inline chặn hub cả thời gian query → phép đo đủ nhạy
+    assert max(inline) > SLOW_SECONDS * 1000 * 0.8
+    assert _p99(pooled) < MAX_P99_MS
+    assert executor.stats()["completed"] == SLOW_QUERIES
+
+
+def test_threading_mode_stays_responsive(slow_query):
+    executor = DBExecutor(workers=SLOW_QUERIES, max_queue=16, timeout=30)
+    executor._mode = "threading"
+    lateness = []
+    done = threading.Event()
+
+    def ticker():
+        while not done.is_set():
+            t0 = time.perf_counter()
+            time.sleep(TICK)
+            lateness.append((time.perf_counter() - t0 - TICK) * 1000)
+
+    t = threading.Thread(target=ticker)
+    t.start()
+    callers = [threading.Thread(target=executor.run, args=(slow_query,)) for _ in range(SLOW_QUERIES)]
+    for c in callers:
+        c.start()
+    for c in callers:
+        c.join()
+    done.set()
+    t.join()
+    executor.shutdown()
+
+    assert _p99(lateness) < MAX_P99_MS
+    assert executor.stats()["completed"] == SLOW_QUERIES
+
+
+def test_full_queue_rejects_with_dbbusy():
+    executor = DBExecutor(workers=1, max_queue=0, timeout=5)
+    executor._mode = "threading"
+    release = threading.Event()
+    started = threading.Event()
+
+    def blocker():
+        started.set()
+        release.wait(5)
+
+    t = threading.Thread(target=executor.run, args=(blocker,))
+    t.start()
+    started.wait(5)
+    try:
+        with pytest.raises(DBBusy):
+            executor.run(lambda: None)
+    finally:
+        release.set()
+        t.join()
+        executor.shutdown()
+    assert executor.stats()["rejected"] == 1